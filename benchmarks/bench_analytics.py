@@ -0,0 +1,101 @@
+"""
+Fleet analytics cost per poll cycle as the number of rooms grows.
+
+Fills HASS_Hysen_Fleet_Analytics with N thermostats and times
+async_record for every room plus the once per cycle async_cycle_done, against
+the same metrics computed room by room in Python.
+
+    python benchmarks/bench_analytics.py
+"""
+import os
+import random
+import sys
+import time
+import timeit
+
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.hysen import climate  # noqa: E402
+
+ROOMS = (10, 100, 1000, 10000)
+
+
+def random_status():
+    room_temp = random.randint(30, 50) / 2
+    return (room_temp, room_temp - random.randint(0, 8) / 2, random.randint(36, 46) / 2,
+            random.randint(0, 1), 1)
+
+
+def room_by_room(entity_ids, statuses, updated, state, alpha, stale_after):
+    """The same metrics, stale check and per room values, one Python pass over the rooms."""
+    now = time.monotonic()
+    setpoint_error, duty_cycle, spread, time_to_setpoint = [], [], [], []
+    heating_now = warming_up = 0
+    for entity_id, (room_temp, external_temp, target_temp, active, power), polled, room in zip(
+            entity_ids, statuses, updated, state):
+        if now - polled > stale_after:
+            continue
+        room[0] = active if room[0] is None else room[0] + alpha * (active - room[0])
+        duty_cycle.append((entity_id, room[0] * 100))
+        heating_now += active == 1
+        if external_temp > 0:
+            spread.append((entity_id, external_temp - room_temp))
+        if power == climate.HYSEN_POWERON:
+            setpoint_error.append((entity_id, room_temp - target_temp))
+            if room_temp < target_temp:
+                if room[1] is None:
+                    room[1] = now
+            elif room[1] is not None:
+                room[2] = now - room[1]
+        if not (power == climate.HYSEN_POWERON and room_temp < target_temp):
+            room[1] = None
+        warming_up += room[1] is not None
+        if room[2] is not None:
+            time_to_setpoint.append((entity_id, room[2] / 60))
+
+    def summary(rooms, magnitude=False):
+        if not rooms:
+            return {'mean': None, 'max': None, 'max_room': None, 'rooms': {}}
+        size = (lambda room: abs(room[1])) if magnitude else (lambda room: room[1])
+        furthest = max(rooms, key=size)
+        return {'mean': round(sum(map(size, rooms)) / len(rooms), 2),
+                'max': round(furthest[1], 2), 'max_room': furthest[0],
+                'rooms': {entity_id: round(value, 2) for entity_id, value in rooms}}
+    metrics = {
+        'setpoint_error': summary(setpoint_error, magnitude=True),
+        'heating_duty_cycle': summary(duty_cycle),
+        'temperature_spread': summary(spread, magnitude=True),
+        'time_to_setpoint': summary(time_to_setpoint),
+    }
+    metrics['heating_duty_cycle']['heating_now'] = heating_now
+    metrics['time_to_setpoint']['warming_up'] = warming_up
+    return metrics
+
+
+def main():
+    print('%8s %14s %14s %16s' % ('rooms', 'record us/room', 'cycle us', 'room by room us'))
+    for rooms in ROOMS:
+        analytics = climate.HASS_Hysen_Fleet_Analytics(timedelta(seconds=30))
+        entity_ids = ['climate.room_%d' % index for index in range(rooms)]
+        statuses = [random_status() for _ in range(rooms)]
+        for entity_id, status in zip(entity_ids, statuses):
+            analytics.async_record(entity_id, *status)
+
+        def record():
+            for entity_id, status in zip(entity_ids, statuses):
+                analytics.async_record(entity_id, *status)
+        number = max(1, 10000 // rooms)
+        record_time = min(timeit.repeat(record, number=number, repeat=3)) / number / rooms
+        cycle_time = min(timeit.repeat(analytics.async_cycle_done, number=number, repeat=3)) / number
+        updated = [time.monotonic()] * rooms
+        state = [[None, None, None] for _ in range(rooms)]
+        python_time = min(timeit.repeat(lambda: room_by_room(entity_ids, statuses, updated, state, 1 / 120, 90),
+                                        number=number, repeat=3)) / number
+        print('%8d %14.2f %14.1f %16.1f' % (rooms, record_time * 1e6, cycle_time * 1e6, python_time * 1e6))
+
+
+if __name__ == '__main__':
+    random.seed(time.time())
+    main()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark for the per-packet CRC16 and 0xbeaf checksum cost.
+
+Compares the previous table-per-call calculate_crc16 and byte-by-byte checksum
+loops with the module-level table and sum() based versions in climate.py,
+for the two CRC calls and two checksums of one get_full_status round trip.
+
+    python benchmarks/bench_crc16.py
+"""
+import os
+import sys
+import timeit
+from ctypes import c_ushort
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.hysen.climate import broadlink_checksum, hysen_crc16  # noqa: E402
+
+
+def calculate_crc16_previous(input_data):
+    crc16_tab = []
+    crc16_constant = 0xA001
+    for i in range(0, 256):
+        crc = c_ushort(i).value
+        for j in range(0, 8):
+            if (crc & 0x0001):
+                crc = c_ushort(crc >> 1).value ^ crc16_constant
+            else:
+                crc = c_ushort(crc >> 1).value
+        crc16_tab.append(hex(crc))
+    crcValue = 0xffff
+    for c in input_data:
+        tmp = crcValue ^ c
+        rotated = c_ushort(crcValue >> 8).value
+        crcValue = rotated ^ int(crc16_tab[(tmp & 0x00ff)], 0)
+    return crcValue
+
+
+def checksum_previous(data):
+    checksum = 0xbeaf
+    for b in data:
+        checksum = (checksum + b) & 0xffff
+    return checksum
+
+
+REQUEST = bytes([0x01, 0x03, 0x00, 0x00, 0x00, 0x16])
+RESPONSE = bytearray(range(49))          # 0x16 register read, length + 45 bytes + crc
+PACKET = bytearray(range(0x38 + 0x10))    # header + one encrypted block
+
+
+def per_packet_previous():
+    calculate_crc16_previous(REQUEST)
+    calculate_crc16_previous(bytes(RESPONSE[2:47]))
+    checksum_previous(PACKET[0x38:])
+    checksum_previous(PACKET)
+
+
+def per_packet_current():
+    hysen_crc16(REQUEST)
+    hysen_crc16(memoryview(RESPONSE)[2:47])
+    broadlink_checksum(memoryview(PACKET)[0x38:])
+    broadlink_checksum(PACKET)
+
+
+def main():
+    assert calculate_crc16_previous(bytes(RESPONSE[2:47])) == hysen_crc16(memoryview(RESPONSE)[2:47])
+    assert checksum_previous(PACKET) == broadlink_checksum(PACKET)
+    number = 2000
+    results = {}
+    for name, func in (('previous', per_packet_previous), ('current', per_packet_current)):
+        best = min(timeit.repeat(func, number=number, repeat=5)) / number
+        results[name] = best
+        print('%-8s %8.2f us per round trip' % (name, best * 1e6))
+    print('speedup  %8.1fx' % (results['previous'] / results['current']))
+
+
+if __name__ == '__main__':
+    main()
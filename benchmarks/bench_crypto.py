@@ -0,0 +1,60 @@
+"""
+Crypto cost per 1000 status polls.
+
+A status poll encrypts one 16 byte request and decrypts one 64 byte response.
+The previous code built a Cipher per key and an encryptor/decryptor context per
+packet; climate.py now reuses one broadlink_aes_session per key.
+
+    python benchmarks/bench_crypto.py
+"""
+import os
+import sys
+import timeit
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.hysen.climate import BROADLINK_IV, get_broadlink_aes_session  # noqa: E402
+
+KEY = os.urandom(16)
+REQUEST = os.urandom(16)
+RESPONSE = os.urandom(64)
+POLLS = 1000
+
+
+def polls_previous():
+    aes = Cipher(algorithms.AES(KEY), modes.CBC(BROADLINK_IV), backend=default_backend())
+    for _ in range(POLLS):
+        encryptor = aes.encryptor()
+        encryptor.update(REQUEST) + encryptor.finalize()
+        decryptor = aes.decryptor()
+        decryptor.update(RESPONSE) + decryptor.finalize()
+
+
+def polls_current():
+    aes = get_broadlink_aes_session(KEY)
+    for _ in range(POLLS):
+        aes.encrypt(REQUEST)
+        aes.decrypt(RESPONSE)
+
+
+def main():
+    reference = Cipher(algorithms.AES(KEY), modes.CBC(BROADLINK_IV), backend=default_backend())
+    encryptor = reference.encryptor()
+    decryptor = reference.decryptor()
+    session = get_broadlink_aes_session(KEY)
+    assert session.encrypt(RESPONSE) == encryptor.update(RESPONSE) + encryptor.finalize()
+    assert session.decrypt(RESPONSE) == decryptor.update(RESPONSE) + decryptor.finalize()
+
+    results = {}
+    for name, func in (('previous', polls_previous), ('current', polls_current)):
+        best = min(timeit.repeat(func, number=5, repeat=5)) / 5
+        results[name] = best
+        print('%-8s %8.2f ms per %d polls' % (name, best * 1e3, POLLS))
+    print('speedup  %8.1fx' % (results['previous'] / results['current']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+End-to-end fleet benchmark against the Hysen simulator on localhost.
+
+Starts benchmarks/hysen_simulator.py in a separate process (so its CPU is
+not counted), authenticates N simulated thermostats and measures, for the
+client side only:
+
+  * round-trip latency of a status poll (p50 / p95 / p99 / max)
+  * polls per second with a bounded number of polls in flight
+  * client CPU time per poll
+
+--mode send exercises broadlink_hysen_climate_device.async_get_full_status
+(async_send_packet, crypto, CRC, decode), --mode live the 8 register
+async_get_live_status read; --mode update runs the entity async_update path
+on top of them.
+
+--mode poller runs --rounds cycles of the fleet poller itself, at --scan-interval
+and --concurrency, and prints the poller stats shown on the
+sensor.hysen_fleet_poll_cycle sensor: cycle wall time, queue depth and circuit
+breaker counts. It exits with an error when the stats do not add up to the fleet.
+
+    python benchmarks/bench_fleet.py --devices 200 --rounds 5
+    python benchmarks/bench_fleet.py --devices 200 --rounds 3 --mode poller --scan-interval 10
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import os
+import subprocess
+import sys
+import time
+
+from datetime import timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+
+from homeassistant.core import HomeAssistant  # noqa: E402
+
+from custom_components.hysen import climate  # noqa: E402
+
+
+def start_simulator(args):
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, 'hysen_simulator.py'),
+               '--devices', str(args.devices), '--latency', str(args.latency), '--loss', str(args.loss)]
+    simulator = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    hosts = []
+    for _ in range(args.devices):
+        mac, address = simulator.stdout.readline().split()
+        host, port = address.rsplit(':', 1)
+        hosts.append((bytes.fromhex(mac.replace(':', '')), (host, int(port))))
+    return simulator, hosts
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def run(args, hosts):
+    devices = [climate.broadlink_hysen_climate_device(host, mac, timeout=args.timeout) for mac, host in hosts]
+    # Devices that do not answer the auth under --loss are authenticated again by the polls
+    await asyncio.gather(*(device.async_auth() for device in devices), return_exceptions=True)
+
+    if args.mode in ('update', 'poller'):
+        # async_update without its util.Throttle wrappers, every call should reach the device
+        async_update = inspect.unwrap(climate.HASS_Hysen_Climate_Device.async_update)
+        hass = HomeAssistant(os.path.join(BENCHMARK_DIR, '.bench_config'))
+        # The shared poller, stores and discovery, as async_setup_platform sets them up
+        hysen_data = await climate.async_setup_hysen_data(hass, timedelta(seconds=args.scan_interval), args.concurrency, [])
+        entities = [climate.HASS_Hysen_Climate_Device(
+                        'climate.bench_%d' % index, hass, 'bench %d' % index, device, 20, 0.5,
+                        climate.SUPPORT_OPERATION_MODES, False, -1, False, 0.5, 0.5, 5, 3)
+                    for index, device in enumerate(devices)]
+        if args.mode == 'poller':
+            await run_poller(args, hysen_data[climate.DATA_POLLER], entities, async_update)
+            return
+        polls = [functools.partial(async_update, entity) for entity in entities]
+    elif args.mode == 'live':
+        statuses = await asyncio.gather(*(device.async_get_full_status() for device in devices))
+        polls = [functools.partial(device.async_get_live_status, status) for device, status in zip(devices, statuses)]
+    else:
+        polls = [device.async_get_full_status for device in devices]
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = 0
+
+    async def poll(func):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await func()
+            except Exception:
+                failures += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    # one warm up round, not measured
+    await asyncio.gather(*(poll(func) for func in polls))
+    latencies.clear()
+    failures = 0
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(args.rounds):
+        await asyncio.gather(*(poll(func) for func in polls))
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+    total = len(latencies)
+    print('mode %s, %d devices, %d rounds, concurrency %d' % (args.mode, len(devices), args.rounds, args.concurrency))
+    print('polls          %8d (%d failed)' % (total, failures))
+    print('polls/s        %8.0f' % (total / wall))
+    print('cpu per poll   %8.1f us' % (cpu / max(total, 1) * 1e6))
+    if total:
+        print('latency p50    %8.2f ms' % (percentile(latencies, 0.50) * 1e3))
+        print('latency p95    %8.2f ms' % (percentile(latencies, 0.95) * 1e3))
+        print('latency p99    %8.2f ms' % (percentile(latencies, 0.99) * 1e3))
+        print('latency max    %8.2f ms' % (latencies[-1] * 1e3))
+    climate.close_hysen_shared_socket()
+
+
+class poll_target():
+    """What the fleet poller polls of an entity, the update without writing to the HA state machine."""
+
+    def __init__(self, entity, async_update):
+        self.entity_id = entity.entity_id
+        self.circuit_breaker = entity.circuit_breaker
+        self.async_poll = functools.partial(async_update, entity)
+
+
+async def run_poller(args, poller, entities, async_update):
+    cycle_done = asyncio.Event()
+    poller.async_add_cycle_listener(cycle_done.set)
+    cpu_start = time.process_time()
+    for entity in entities:
+        poller.async_add_entity(poll_target(entity, async_update))
+    cycle_times = []
+    for _ in range(args.rounds):
+        await cycle_done.wait()
+        cycle_done.clear()
+        cycle_times.append(poller.stats['last_cycle_time'])
+    cpu = time.process_time() - cpu_start
+    poller.async_stop()
+    climate.close_hysen_shared_socket()
+
+    stats = poller.stats
+    print('mode poller, %d devices, %d cycles, scan interval %ss, concurrency %d' % (
+        len(entities), args.rounds, args.scan_interval, args.concurrency))
+    print('cycle time         %6.2f s max, %.2f s last' % (max(cycle_times), stats['last_cycle_time']))
+    print('cpu per cycle      %6.1f ms' % (cpu / args.rounds * 1e3))
+    for name in ('cycle_count', 'last_cycle_polls', 'last_cycle_skipped', 'max_queue_depth', 'queue_depth', 'in_flight'):
+        print('%-18s %6d' % (name, stats[name]))
+    print('breakers           %s' % ', '.join('%s %d' % state for state in stats['breakers'].items()))
+
+    problems = []
+    if stats['devices'] != len(entities):
+        problems.append('devices %d, expected %d' % (stats['devices'], len(entities)))
+    if stats['cycle_count'] != args.rounds:
+        problems.append('cycle_count %d, expected %d' % (stats['cycle_count'], args.rounds))
+    if stats['last_cycle_polls'] + stats['last_cycle_skipped'] != len(entities):
+        problems.append('last cycle polled %d and skipped %d of %d devices' % (
+            stats['last_cycle_polls'], stats['last_cycle_skipped'], len(entities)))
+    if sum(stats['breakers'].values()) != len(entities):
+        problems.append('breaker states %s do not cover %d devices' % (stats['breakers'], len(entities)))
+    if not 0 <= stats['max_queue_depth'] <= len(entities) or stats['in_flight'] > args.concurrency:
+        problems.append('queue depth %d, in flight %d' % (stats['max_queue_depth'], stats['in_flight']))
+    if problems:
+        sys.exit('poller stats do not add up: ' + '; '.join(problems))
+    print('poller stats           ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hysen fleet benchmark against the local simulator')
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=climate.DEFAULT_MAX_CONCURRENT_POLLS)
+    parser.add_argument('--mode', choices=('send', 'live', 'update', 'poller'), default='send')
+    parser.add_argument('--scan-interval', type=float, default=climate.MIN_TIME_BETWEEN_SCANS.total_seconds(),
+                        help='poller mode scan interval in seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated device response delay in seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='simulated datagram loss ratio')
+    parser.add_argument('--timeout', type=float, default=climate.DEFAULT_TIMEOUT)
+    args = parser.parse_args()
+
+    simulator, hosts = start_simulator(args)
+    try:
+        asyncio.run(run(args, hosts))
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+
+if __name__ == '__main__':
+    main()
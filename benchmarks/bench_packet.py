@@ -0,0 +1,128 @@
+"""
+Packets built per second, and response parsing cost.
+
+Compares the previous build_packet, which set every header byte one at a time
+and appended the ciphertext byte by byte, with the header template and struct
+based builder in climate.py that reuses one buffer per device, with and without
+the AES encryption that dominates both. Also times parse_request_response
+against the previous version that copied the response and the plaintext.
+
+    python benchmarks/bench_packet.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.hysen import climate  # noqa: E402
+
+MAC = bytes([0x34, 0xea, 0x34, 0x00, 0x00, 0x01])
+KEY = os.urandom(16)
+DEVICE_ID = os.urandom(4)
+PACKETS = 10000
+
+
+def build_packet_previous(device, command, payload):
+    device.count = (device.count + 1) & 0xffff
+    packet = bytearray(0x38)
+    packet[0x00] = 0x5a
+    packet[0x01] = 0xa5
+    packet[0x02] = 0xaa
+    packet[0x03] = 0x55
+    packet[0x04] = 0x5a
+    packet[0x05] = 0xa5
+    packet[0x06] = 0xaa
+    packet[0x07] = 0x55
+    packet[0x24] = device.devtype & 0xff
+    packet[0x25] = device.devtype >> 8
+    packet[0x26] = command
+    packet[0x28] = device.count & 0xff
+    packet[0x29] = device.count >> 8
+    for i in range(6):
+        packet[0x2a + i] = device.mac[i]
+    for i in range(4):
+        packet[0x30 + i] = device.id[i]
+    if payload:
+        payload += bytearray((16 - len(payload)) % 16)
+    checksum = climate.broadlink_checksum(payload)
+    packet[0x34] = checksum & 0xff
+    packet[0x35] = checksum >> 8
+    payload = device.encrypt(payload)
+    for i in range(len(payload)):
+        packet.append(payload[i])
+    checksum = climate.broadlink_checksum(packet)
+    packet[0x20] = checksum & 0xff
+    packet[0x21] = checksum >> 8
+    return packet
+
+
+def parse_request_response_previous(device, response):
+    device.check_error(response[0x22:0x24])
+    response_payload = bytearray(device.decrypt(bytes(response[0x38:])))
+    response_payload_len = response_payload[0]
+    crc = climate.hysen_crc16(memoryview(response_payload)[2:response_payload_len])
+    if (response_payload[response_payload_len] == crc & 0xFF) and (
+            response_payload[response_payload_len + 1] == (crc >> 8) & 0xFF):
+        return response_payload[2:response_payload_len]
+    raise ValueError('hysen_response_error', 'CRC check on response failed')
+
+
+def new_device(encrypt=True):
+    device = climate.broadlink_hysen_climate_device(('127.0.0.1', 80), MAC)
+    device.set_session(DEVICE_ID, KEY)
+    device.count = 0
+    if not encrypt:
+        # framing only
+        device.encrypt = bytes
+    return device
+
+
+def status_response(device):
+    """A get_full_status answer as the device sends it."""
+    registers = bytes(range(0x2c))
+    body = bytes([0x01, 0x03, len(registers)]) + registers
+    crc = climate.hysen_crc16(body)
+    plain = bytes([len(body) + 2, 0]) + body + bytes([crc & 0xff, crc >> 8])
+    plain += bytes(-len(plain) % 16)
+    response = bytearray(0x38)
+    response[0x26] = 0xee
+    return bytes(response + device.encrypt(plain))
+
+
+def main():
+    device_request = new_device().build_request_payload(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x16]))
+
+    previous_device, current_device = new_device(), new_device()
+    for command, payload in ((0x6a, device_request), (0x65, bytearray(0x50)), (0x6a, bytearray(0x1f))):
+        expected = build_packet_previous(previous_device, command, bytearray(payload))
+        assert bytes(current_device.build_packet(command, bytearray(payload))) == bytes(expected)
+
+    response = status_response(current_device)
+    assert current_device.parse_request_response(response) == parse_request_response_previous(current_device, response)
+
+    results = {}
+    cases = (
+        ('build previous', True, lambda device: build_packet_previous(device, 0x6a, bytearray(device_request))),
+        ('build current', True, lambda device: device.build_packet(0x6a, device_request)),
+        ('frame previous', False, lambda device: build_packet_previous(device, 0x6a, bytearray(device_request))),
+        ('frame current', False, lambda device: device.build_packet(0x6a, device_request)),
+        ('parse previous', True, lambda device: parse_request_response_previous(device, response)),
+        ('parse current', True, lambda device: device.parse_request_response(response)),
+    )
+    for name, encrypt, func in cases:
+        device = new_device(encrypt)
+
+        def run():
+            for _ in range(PACKETS):
+                func(device)
+        best = min(timeit.repeat(run, number=1, repeat=5))
+        results[name] = best
+        print('%-15s %9.0f packets/s %6.2f us per packet' % (name, PACKETS / best, best / PACKETS * 1e6))
+    print('build speedup   %9.1fx' % (results['build previous'] / results['build current']))
+    print('frame speedup   %9.1fx' % (results['frame previous'] / results['frame current']))
+    print('parse speedup   %9.1fx' % (results['parse previous'] / results['parse current']))
+
+
+if __name__ == '__main__':
+    main()
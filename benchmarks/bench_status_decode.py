@@ -0,0 +1,102 @@
+"""
+Decode cost and size of one full status poll.
+
+Compares the previous get_full_status dict decoder (24 keys plus 8 nested
+schedule dicts per poll) with the hysen_status record in climate.py, and
+the cost of telling an unchanged poll from a changed one.
+
+    python benchmarks/bench_status_decode.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.hysen.climate import hysen_status  # noqa: E402
+
+PAYLOAD = bytearray([0x01, 0x03, 0x2c, 0x00, 0x11, 42, 40, 0x11, 0, 42, 1, 35, 5, 0xff, 0xfe, 1, 1, 0, 38,
+                     12, 0, 0, 1, 6, 0, 8, 0, 11, 30, 12, 30, 17, 0, 22, 0, 8, 0, 23, 0,
+                     40, 30, 30, 40, 40, 30, 40, 30])
+NEXT_PAYLOAD = bytearray(PAYLOAD)
+NEXT_PAYLOAD[21] = 30    # only the clock seconds moved
+
+
+def decode_previous(payload):
+    data = {}
+    data['remote_lock'] = payload[3] & 1
+    data['power'] = payload[4] & 1
+    data['active'] = (payload[4] >> 4) & 1
+    data['temp_manual'] = (payload[4] >> 6) & 1
+    data['room_temp'] = (payload[5] & 255) / 2.0
+    data['thermostat_temp'] = (payload[6] & 255) / 2.0
+    data['auto_mode'] = payload[7] & 15
+    data['loop_mode'] = (payload[7] >> 4) & 15
+    data['sensor'] = payload[8]
+    data['osv'] = payload[9]
+    data['dif'] = payload[10]
+    data['svh'] = payload[11]
+    data['svl'] = payload[12]
+    data['room_temp_adj'] = ((payload[13] << 8) + payload[14]) / 2.0
+    if data['room_temp_adj'] > 32767:
+        data['room_temp_adj'] = 32767 - data['room_temp_adj']
+    data['fre'] = payload[15]
+    data['poweron'] = payload[16]
+    data['unknown'] = payload[17]
+    data['external_temp'] = (payload[18] & 255) / 2.0
+    data['hour'] = payload[19]
+    data['min'] = payload[20]
+    data['sec'] = payload[21]
+    data['dayofweek'] = payload[22]
+    weekday = []
+    for i in range(0, 6):
+        weekday.append(
+            {'start_hour': payload[2 * i + 23], 'start_minute': payload[2 * i + 24], 'temp': payload[i + 39] / 2.0})
+    data['weekday'] = weekday
+    weekend = []
+    for i in range(6, 8):
+        weekend.append(
+            {'start_hour': payload[2 * i + 23], 'start_minute': payload[2 * i + 24], 'temp': payload[i + 39] / 2.0})
+    data['weekend'] = weekend
+    return data
+
+
+def unchanged_previous(old, new):
+    return all(old[key] == new[key] for key in old if key not in ('hour', 'min', 'sec', 'dayofweek'))
+
+
+def deep_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(item) for item in value.values())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+
+def main():
+    record = hysen_status.decode(PAYLOAD)
+    previous = decode_previous(PAYLOAD)
+    current = record.as_dict()
+    # the previous decoder got negative room temp adjust wrong, everything else must match
+    assert current.pop('room_temp_adj') == -1.0
+    assert previous.pop('room_temp_adj') == 32767.0
+    assert current == previous
+
+    number = 20000
+    rows = (
+        ('decode dict', lambda: decode_previous(PAYLOAD)),
+        ('decode record', lambda: hysen_status.decode(PAYLOAD)),
+        ('unchanged dict', lambda: unchanged_previous(decode_previous(PAYLOAD), decode_previous(NEXT_PAYLOAD))),
+        ('unchanged record', lambda: hysen_status.decode(NEXT_PAYLOAD).same_settings(record)),
+    )
+    for name, func in rows:
+        best = min(timeit.repeat(func, number=number, repeat=5)) / number
+        print('%-18s %8.2f us' % (name, best * 1e6))
+    # rough footprint of what one poll keeps alive, keys excluded
+    print('%-18s %8d bytes' % ('size dict', deep_size(decode_previous(PAYLOAD))))
+    print('%-18s %8d bytes' % ('size record', deep_size(hysen_status.decode(PAYLOAD))))
+
+
+if __name__ == '__main__':
+    main()
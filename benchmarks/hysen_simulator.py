@@ -0,0 +1,219 @@
+"""
+Pure-Python UDP simulator for Broadlink Hysen (0x4EAD) thermostats.
+Answers discovery, auth (0x65) and the 0x6a Modbus-style register reads/writes
+used by custom_components/hysen/climate.py, with the same CRC16 and AES framing.
+
+Run standalone to put a few simulated thermostats on localhost:
+    python benchmarks/hysen_simulator.py --devices 10
+"""
+import argparse
+import asyncio
+import ipaddress
+import os
+import random
+import struct
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+HYSEN_DEVTYPE = 0x4EAD
+DEFAULT_KEY = bytes([0x09, 0x76, 0x28, 0x34, 0x3f, 0xe9, 0x9e, 0x23, 0x76, 0x5c, 0x15, 0x13, 0xac, 0xcf, 0x8b, 0x02])
+IV = bytes([0x56, 0x2e, 0x17, 0x99, 0x6d, 0x09, 0x3d, 0x28, 0xdd, 0xb3, 0xba, 0x69, 0x5a, 0x2e, 0x6f, 0x58])
+REGISTER_COUNT = 0x16
+
+
+def crc16(data):
+    crc = 0xffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def checksum(data):
+    return (0xbeaf + sum(data)) & 0xffff
+
+
+def aes_encrypt(key, payload):
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(IV)).encryptor()
+    return encryptor.update(payload) + encryptor.finalize()
+
+
+def aes_decrypt(key, payload):
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(IV)).decryptor()
+    return decryptor.update(payload) + decryptor.finalize()
+
+
+class simulated_hysen_device(asyncio.DatagramProtocol):
+    """One simulated thermostat bound to its own (host, port)."""
+
+    def __init__(self, mac, name='Hysen simulator', latency=0.0, loss=0.0):
+        self.mac = bytes(mac)
+        self.name = name
+        self.latency = latency
+        self.loss = loss
+        self.online = True
+        self.key = DEFAULT_KEY
+        self.id = os.urandom(4)
+        self.transport = None
+        self.requests = 0
+        # 22 registers, two bytes each, laid out as read by get_full_status
+        self.registers = bytearray(REGISTER_COUNT * 2)
+        self.registers[0:2] = bytes([0, 0x01])           # remote lock, power/active/manual
+        self.registers[2:4] = bytes([42, 40])            # room temp, setpoint (x2)
+        self.registers[4:6] = bytes([0x11, 0])           # loop/auto mode, sensor
+        self.registers[6:8] = bytes([42, 1])             # osv, dif
+        self.registers[8:10] = bytes([35, 5])            # svh, svl
+        self.registers[10:12] = bytes([0, 0])            # room temp adjust
+        self.registers[12:14] = bytes([1, 1])            # fre, poweron
+        self.registers[14:16] = bytes([0, 38])           # unknown, external temp
+        self.registers[16:20] = bytes([12, 0, 0, 1])     # hour, min, sec, day of week
+        self.registers[20:36] = bytes([6, 0, 8, 0, 11, 30, 12, 30, 17, 0, 22, 0, 8, 0, 23, 0])
+        self.registers[36:44] = bytes([40, 30, 30, 40, 40, 30, 40, 30])
+        self.update_active()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def update_active(self):
+        power = self.registers[1] & 1
+        active = 1 if power and self.registers[2] < self.registers[3] else 0
+        self.registers[1] = (self.registers[1] & ~0x10) | (active << 4)
+
+    def datagram_received(self, data, addr):
+        if not self.online or (self.loss and random.random() < self.loss):
+            return
+        self.requests += 1
+        if len(data) == 0x30 and data[0x26] == 6:
+            response = self.discovery_response()
+        elif len(data) >= 0x38 and data[0x26] in (0x65, 0x6a):
+            response = self.command_response(data)
+        else:
+            return
+        if response is None:
+            return
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+    def discovery_response(self):
+        packet = bytearray(0x80)
+        packet[0x34:0x36] = struct.pack('<H', HYSEN_DEVTYPE)
+        packet[0x3a:0x40] = self.mac[::-1]
+        name = self.name.encode('utf-8')[:0x3f]
+        packet[0x40:0x40 + len(name)] = name
+        packet[0x20:0x22] = struct.pack('<H', checksum(packet))
+        return bytes(packet)
+
+    def reboot(self):
+        """Forget the session, like a power cycle: the next 0x6a gets error 0xfffe until auth."""
+        self.key = DEFAULT_KEY
+        self.id = os.urandom(4)
+
+    def error_response(self, request, error_code):
+        response = bytearray(request[0:0x38])
+        response[0x20:0x24] = bytes(2) + struct.pack('<H', error_code)
+        response[0x26] = 0xee
+        response[0x20:0x22] = struct.pack('<H', checksum(response))
+        return bytes(response)
+
+    def command_response(self, request):
+        command = request[0x26]
+        if command == 0x6a and bytes(request[0x30:0x34]) != self.id:
+            return self.error_response(request, 0xfffe)
+        key = DEFAULT_KEY if command == 0x65 else self.key
+        payload = aes_decrypt(key, bytes(request[0x38:]))
+        if command == 0x65:
+            self.key = os.urandom(16)
+            plain = bytearray(0x20)
+            plain[0x00:0x04] = self.id[::-1]
+            plain[0x04:0x14] = self.key
+        else:
+            plain = self.modbus_response(payload)
+            if plain is None:
+                return None
+        plain = bytes(plain) + bytes((16 - len(plain)) % 16)
+        response = bytearray(request[0:0x38])
+        response[0x20:0x24] = bytes(4)
+        response[0x26] = command + 0x0a if command == 0x65 else 0xee
+        response[0x34:0x36] = struct.pack('<H', checksum(plain))
+        response += aes_encrypt(key, plain)
+        response[0x20:0x22] = struct.pack('<H', checksum(response))
+        return bytes(response)
+
+    def modbus_response(self, payload):
+        length = payload[0]
+        modbus = payload[2:length]
+        if len(modbus) < 6 or payload[length] | payload[length + 1] << 8 != crc16(modbus):
+            return None
+        function = modbus[1]
+        start = modbus[2] << 8 | modbus[3]
+        if function == 0x03:
+            count = modbus[4] << 8 | modbus[5]
+            body = bytes([0x01, 0x03, count * 2]) + bytes(self.registers[start * 2:(start + count) * 2])
+        elif function == 0x06:
+            self.write_registers(start, modbus[4:6])
+            body = bytes(modbus[0:6])
+        elif function == 0x10:
+            count = modbus[4] << 8 | modbus[5]
+            self.write_registers(start, modbus[7:7 + count * 2])
+            body = bytes(modbus[0:6])
+        else:
+            return None
+        crc = crc16(body)
+        return bytes([len(body) + 2, 0]) + body + bytes([crc & 0xff, crc >> 8])
+
+    def write_registers(self, start, values):
+        for offset, value in enumerate(values):
+            index = start * 2 + offset
+            if index == 1:
+                # only the power bit is writable, active/manual are device state
+                self.registers[1] = (self.registers[1] & ~0x01) | (value & 0x01)
+            elif index == 2:
+                # room temperature is read only
+                continue
+            elif index < len(self.registers):
+                self.registers[index] = value
+        self.update_active()
+
+
+async def start_simulated_devices(count, base_host='127.0.0.1', port=0, latency=0.0, loss=0.0):
+    """Start count simulated thermostats, returning [(device, (host, port))].
+
+    With port 0 every device gets its own ephemeral port on base_host. With a
+    fixed port (80 to answer discovery) each device gets the next address
+    after base_host instead, e.g. 127.0.0.10, 127.0.0.11, ...
+    """
+    loop = asyncio.get_running_loop()
+    base_address = int(ipaddress.IPv4Address(base_host))
+    devices = []
+    for i in range(count):
+        mac = bytes([0x34, 0xea, 0x34, 0x00, (i >> 8) & 0xff, i & 0xff])
+        device = simulated_hysen_device(mac, name='Hysen sim %d' % i, latency=latency, loss=loss)
+        host = base_host if port == 0 else str(ipaddress.IPv4Address(base_address + i))
+        transport, _ = await loop.create_datagram_endpoint(lambda device=device: device,
+                                                           local_addr=(host, port))
+        devices.append((device, transport.get_extra_info('sockname')))
+    return devices
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    args = parser.parse_args()
+    devices = await start_simulated_devices(args.devices, args.host, args.port, args.latency, args.loss)
+    for device, host in devices:
+        print('%s %s:%d' % (':'.join('%02X' % b for b in device.mac), host[0], host[1]), flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,105 @@
+"""
+Replay a Hysen packet capture against the client code, without the devices.
+
+Takes a capture written by the climate.hysen_capture service and answers every
+request of the captured thermostats from it, at the recorded round trip times
+(--speed recorded) or straight away (--speed max). Each device is then polled
+--rounds times: --mode send the async_get_full_status path (async_send_packet,
+crypto, CRC, decode), --mode update the entity async_update path on top of it.
+With --profile the polls run under cProfile and the stats are written to that
+file.
+
+    python benchmarks/replay_capture.py hysen_capture_20240101_120000.bin --speed max --rounds 50
+"""
+import argparse
+import asyncio
+import cProfile
+import functools
+import inspect
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+
+from homeassistant.core import HomeAssistant  # noqa: E402
+
+from custom_components.hysen import climate  # noqa: E402
+
+
+async def run(args):
+    replay = climate.broadlink_hysen_replay_socket(climate.read_hysen_capture(args.capture),
+                                                   realtime=args.speed == 'recorded', timeout=args.timeout)
+    climate.use_hysen_replay_socket(replay)
+    devices = list(replay.devices.values())
+    print('capture %s: %d devices, %d found by discovery' % (args.capture, len(devices), len(replay.discovered)))
+    if not devices:
+        return
+
+    if args.mode == 'update':
+        # async_update without its util.Throttle wrappers, every call should reach the replay
+        async_update = inspect.unwrap(climate.HASS_Hysen_Climate_Device.async_update)
+        hass = HomeAssistant(os.path.join(BENCHMARK_DIR, '.bench_config'))
+        # The shared poller, stores and discovery, as async_setup_platform sets them up
+        await climate.async_setup_hysen_data(hass, climate.MIN_TIME_BETWEEN_SCANS,
+                                             climate.DEFAULT_MAX_CONCURRENT_POLLS, [])
+        polls = [functools.partial(async_update, climate.HASS_Hysen_Climate_Device(
+                    'climate.replay_%d' % index, hass, 'replay %d' % index, device, 20, 0.5,
+                    climate.SUPPORT_OPERATION_MODES, False, -1, False, 0.5, 0.5, 5, 3))
+                 for index, device in enumerate(devices)]
+        for func in polls:
+            # Captures usually start mid session, with no auth to replay: start as connected,
+            # a replayed session error still makes the client authenticate again
+            func.args[0]._available = True
+    else:
+        await asyncio.gather(*(device.async_auth() for device in devices), return_exceptions=True)
+        polls = [device.async_get_full_status for device in devices]
+
+    failures = 0
+
+    async def poll(func):
+        nonlocal failures
+        try:
+            await func()
+        except Exception:
+            failures += 1
+
+    profile = cProfile.Profile() if args.profile else None
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if profile is not None:
+        profile.enable()
+    for _ in range(args.rounds):
+        await asyncio.gather(*(poll(func) for func in polls))
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    total = len(polls) * args.rounds
+    print('mode %s, speed %s, %d rounds' % (args.mode, args.speed, args.rounds))
+    print('polls          %8d (%d failed)' % (total, failures))
+    print('polls/s        %8.0f' % (total / wall))
+    print('cpu per poll   %8.1f us' % (cpu / total * 1e6))
+    print('replayed       %8d answered, %d unanswered' % (replay.answered, replay.unanswered))
+    if profile is not None:
+        print('profile written to %s' % args.profile)
+    climate.close_hysen_shared_socket()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a Hysen packet capture')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', choices=('recorded', 'max'), default='max')
+    parser.add_argument('--mode', choices=('send', 'update'), default='update')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=climate.DEFAULT_TIMEOUT)
+    parser.add_argument('--profile', metavar='PSTATS_FILE')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
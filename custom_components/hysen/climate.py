@@ -10,6 +10,11 @@ Author: Mark Carter
 
 #climate:
 #  - platform: hysen
+#    scan_interval: 30            # the fleet is polled once per interval, spread evenly over it
+#    max_concurrent_polls: 8      # fleet wide limit on device requests in flight
+#    full_status_every: 10        # polls in between only read the live registers, schedule and settings every 10th poll
+#    discovery_networks:          # also look for devices without host/host_dns by unicast over these ranges,
+#      - 192.168.20.0/24          # local subnets are always searched by broadcast
 #    device:
 #      house_thermostat:
 #        name: House Thermostat
@@ -29,13 +34,20 @@ VERSION = '2.3.1'
 
 
 import asyncio
+import contextlib
+import cProfile
+import io
 import logging
 import binascii
+import os
+import pstats
+import sys
 import voluptuous as vol
 import homeassistant.helpers.config_validation as cv
 import socket
 import datetime
 import time
+import numpy
 
 from datetime import timedelta
 from homeassistant import util
@@ -51,7 +63,9 @@ from homeassistant.const import (
     ATTR_UNIT_OF_MEASUREMENT, 
     CONF_NAME, CONF_HOST, 
     CONF_MAC, CONF_TIMEOUT, 
-    CONF_CUSTOMIZE)
+    CONF_CUSTOMIZE,
+    CONF_SCAN_INTERVAL,
+    EVENT_HOMEASSISTANT_STOP)
 
 from homeassistant.components.climate.const import (
     DOMAIN,
@@ -62,7 +76,12 @@ from homeassistant.components.climate.const import (
     HVACAction,
     HVACMode)
 
+from homeassistant.core import SupportsResponse, callback
+from homeassistant.helpers import discovery as ha_discovery
 from homeassistant.helpers.entity import async_generate_entity_id
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
+from homeassistant.setup import async_when_setup
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -74,10 +93,49 @@ SUPPORT_ACTIONS = [HVACAction.HEATING,HVACAction.IDLE] #HVACAction.OFF
 
 MIN_TIME_BETWEEN_SCANS = timedelta(seconds=30)
 MIN_TIME_BETWEEN_FORCED_SCANS = timedelta(milliseconds=100)
+# A poll where only the thermostat clock moved is written to HA at most this often
+MIN_TIME_BETWEEN_CLOCK_UPDATES = timedelta(minutes=15)
 
 DEFAULT_TIMEOUT = 5
 UPDATE_RETRY_BEFORE_ERROR = 3
 
+# Circuit breaker: after this many failed polls in a row a device is only probed
+# now and again, backing off from one scan interval up to BREAKER_MAX_BACKOFF.
+BREAKER_FAILURE_THRESHOLD = UPDATE_RETRY_BEFORE_ERROR
+BREAKER_MAX_BACKOFF = timedelta(minutes=15)
+BREAKER_JITTER = 0.1
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+HYSEN_DOMAIN = 'hysen'
+DATA_POLLER = 'poller'
+DATA_HYSTERESIS_RESTORES = 'hysteresis_restores'
+DATA_STARTUP_REPORT = 'startup_report'
+DATA_SESSION_KEYS = 'session_keys'
+DATA_DISCOVERY = 'discovery'
+DATA_PROFILER = 'profiler'
+DATA_ANALYTICS = 'analytics'
+DATA_SETUP = 'setup'
+
+STORAGE_VERSION = 1
+STORAGE_KEY_HYSTERESIS_RESTORES = 'hysen.hysteresis_restores'
+STORAGE_KEY_SESSION_KEYS = 'hysen.session_keys'
+SESSION_KEYS_SAVE_DELAY = 10
+STORAGE_KEY_DISCOVERED_HOSTS = 'hysen.discovered_hosts'
+DISCOVERED_HOSTS_SAVE_DELAY = 10
+
+# Addresses found by discovery are used without a new sweep for this long
+DISCOVERY_CACHE_TTL = timedelta(days=7)
+# A device found by discovery that stops answering triggers a new sweep, at most this often
+MIN_TIME_BETWEEN_REDISCOVERY = timedelta(minutes=5)
+
+CONF_MAX_CONCURRENT_POLLS = 'max_concurrent_polls'
+DEFAULT_MAX_CONCURRENT_POLLS = 8
+CONF_FULL_STATUS_EVERY = 'full_status_every'
+DEFAULT_FULL_STATUS_EVERY = 10
+CONF_DISCOVERY_NETWORKS = 'discovery_networks'
+
 CONF_WIFI_SSID = "ssid"
 CONF_WIFI_PASSWORD ="password"
 CONF_WIFI_SECTYPE = "sectype"
@@ -178,6 +236,49 @@ SET_TIME_SCHEDULE_SCHEMA = vol.Schema({
     vol.Required(CONFIG_WEEKEND_PERIOD2_TEMP): vol.Coerce(float),
 })
 
+SERVICE_SET_TIME_SCHEDULE_BULK = "hysen_set_timeschedule_bulk"
+CONFIG_SCHEDULE_MAX_CONCURRENT = 'max_concurrent'
+CONFIG_SCHEDULE_FORCE = 'force'
+SET_TIME_SCHEDULE_BULK_SCHEMA = SET_TIME_SCHEDULE_SCHEMA.extend({
+    vol.Optional(ATTR_ENTITY_ID, default="all"): cv.comp_entity_ids,
+    vol.Optional(CONFIG_SCHEDULE_MAX_CONCURRENT): vol.Range(min=1, max=255),
+    vol.Optional(CONFIG_SCHEDULE_FORCE, default=False): cv.boolean,
+})
+
+SERVICE_PROFILE = "hysen_profile"
+CONFIG_PROFILE_MODE = 'mode'
+CONFIG_PROFILE_DURATION = 'duration'
+CONFIG_PROFILE_CYCLES = 'cycles'
+CONFIG_PROFILE_TOP = 'top'
+PROFILE_MODE_DETERMINISTIC = 'deterministic'
+PROFILE_MODE_SAMPLING = 'sampling'
+PROFILE_SAMPLE_INTERVAL = 0.005      # seconds between stack samples of the event loop thread
+PROFILE_SCHEMA = vol.Schema({
+    vol.Optional(CONFIG_PROFILE_MODE, default=PROFILE_MODE_DETERMINISTIC): vol.In([PROFILE_MODE_DETERMINISTIC, PROFILE_MODE_SAMPLING]),
+    vol.Optional(CONFIG_PROFILE_DURATION, default=60): vol.All(vol.Coerce(float), vol.Range(min=1, max=3600)),
+    vol.Optional(CONFIG_PROFILE_CYCLES): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONFIG_PROFILE_TOP, default=20): vol.All(vol.Coerce(int), vol.Range(min=1, max=200)),
+})
+
+SERVICE_CAPTURE = "hysen_capture"
+CONFIG_CAPTURE_DURATION = 'duration'
+CAPTURE_SCHEMA = vol.Schema({
+    vol.Optional(CONFIG_CAPTURE_DURATION, default=300): vol.All(vol.Coerce(float), vol.Range(min=1, max=3600)),
+})
+
+SERVICE_GET_HISTORY = "hysen_get_history"
+CONFIG_HISTORY_HOURS = 'hours'
+GET_HISTORY_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.comp_entity_ids,
+    vol.Optional(CONFIG_HISTORY_HOURS): vol.All(vol.Coerce(float), vol.Range(min=0)),
+})
+
+# The six weekday and two weekend periods of the hysen_set_timeschedule services
+SCHEDULE_WEEKDAY_FIELDS = [(CONFIG_WEEK_PERIOD1_START, CONFIG_WEEK_PERIOD1_TEMP), (CONFIG_WEEK_PERIOD2_START, CONFIG_WEEK_PERIOD2_TEMP),
+                           (CONFIG_WEEK_PERIOD3_START, CONFIG_WEEK_PERIOD3_TEMP), (CONFIG_WEEK_PERIOD4_START, CONFIG_WEEK_PERIOD4_TEMP),
+                           (CONFIG_WEEK_PERIOD5_START, CONFIG_WEEK_PERIOD5_TEMP), (CONFIG_WEEK_PERIOD6_START, CONFIG_WEEK_PERIOD6_TEMP)]
+SCHEDULE_WEEKEND_FIELDS = [(CONFIG_WEEKEND_PERIOD1_START, CONFIG_WEEKEND_PERIOD1_TEMP), (CONFIG_WEEKEND_PERIOD2_START, CONFIG_WEEKEND_PERIOD2_TEMP)]
+
 
 HYSEN_POWERON = 1
 HYSEN_POWEROFF = 0
@@ -193,6 +294,17 @@ DEAFULT_HA_FOR_HYSTERSIS_SAMPLE_COUNT_HIGH = 3
 DEAFULT_HA_FOR_HYSTERSIS_SAMPLE_COUNT_LOW = 5
 DEAFULT_CONF_USE_HA_FOR_HYSTERSIS_BAIS_HIGH = 0.5
 DEAFULT_CONF_USE_HA_FOR_HYSTERSIS_BAIS_LOW = 0.5
+EVENT_HYSEN_COMMAND_ROLLBACK = 'hysen_command_rollback'
+
+# Entity attribute shown for a status field while a command writing it is pending confirmation
+HYSEN_PENDING_ATTRIBUTES = {
+    'remote_lock': '_remote_lock',
+    'power': '_power_state',
+    'thermostat_temp': '_target_temperature',
+    'auto_mode': '_auto_state',
+}
+
+HA_HYSTERSIS_RESTORE_DELAY = 4       # seconds the nudged setpoint is left on the thermostat before it is put back
 
 CONF_DEVICES = 'devices'
 CONF_TARGET_TEMP = 'target_temp_default'
@@ -210,7 +322,17 @@ CONF_HYSTERSIS_BAIS_LOW = "hysteresis_low_temp_bais"
 CONF_DNSHOST = 'host_dns'
 CONF_HOST_PORT = 'host_port'
 
+def discovery_network(value):
+    """Validate an IPv4 network in CIDR notation, e.g. 192.168.2.0/24, host bits may be set."""
+    try:
+        return str(ipaddress.IPv4Network(value, strict=False))
+    except ValueError as error:
+        raise vol.Invalid('invalid discovery network %s: %s' % (value, error))
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
+    vol.Optional(CONF_MAX_CONCURRENT_POLLS, default=DEFAULT_MAX_CONCURRENT_POLLS): vol.Range(min=1, max=255),
+    vol.Optional(CONF_FULL_STATUS_EVERY, default=DEFAULT_FULL_STATUS_EVERY): vol.Range(min=1, max=1000),
+    vol.Optional(CONF_DISCOVERY_NETWORKS, default=[]): vol.All(cv.ensure_list, [vol.All(vol.Match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}/\d{1,2}$"), discovery_network)]),
     vol.Optional(CONF_DEVICES, default={}): {
         cv.string: vol.Schema({
             vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
@@ -232,8 +354,13 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     },
 })
 
-async def devices_from_config(domain_config, hass):
+def devices_from_config(domain_config, hass):
+    """Create an entity for every configured device, without talking to the devices yet.
+
+    Returns (entity, dns_name, ip_port) for each, async_start_hysen_devices does the network part.
+    """
     hass_devices = []
+    full_status_every = domain_config.get(CONF_FULL_STATUS_EVERY, DEFAULT_FULL_STATUS_EVERY)
     for device_id, config in domain_config[CONF_DEVICES].items():
         # Get device-specific parameters
         name = config.get(CONF_NAME)
@@ -249,13 +376,6 @@ async def devices_from_config(domain_config, hass):
         HA_hysteresis_sample_count_target_high = config.get(CONF_HYSTERSIS_SAMPLE_COUNT_HIGH)
         HA_hysteresis_sample_count_target_low = config.get(CONF_HYSTERSIS_SAMPLE_COUNT_LOW)
 
-        if (dns_name != None and ip_addr == None):
-            try:
-                ip_addr = socket.gethostbyname(dns_name)
-                _LOGGER.warning("Discovered Broadlink Hysen Climate device address: %s, from name %s",ip_addr,dns_name)
-            except Exception as error:
-                _LOGGER.error("Failed resolve DNS name to IP for Broadlink Hysen Climate device:%s, error:%s",dns_name,error)
-
         # Get Operation parameters for Hysen Climate device.
         operation_list = SUPPORT_OPERATION_MODES
         target_temp_default = config.get(CONF_TARGET_TEMP)
@@ -264,63 +384,96 @@ async def devices_from_config(domain_config, hass):
         get_current_temp_from_sensor_override = config.get(CONF_GETCURERNTTEMP_FROM_SENSOR)
 
         # Set up the Hysen Climate devices.
-        # If IP and Mac given try to directly connect
-        # If only Mac given try to discover connect
+        # If IP and Mac given the device is used directly,
+        # otherwise the address is looked up from host_dns or discovery at startup.
         try:
-            if (ip_addr != None):
-                blmac_addr = binascii.unhexlify(mac_addr.encode().replace(b':', b''))
-                newhassdevice =  await create_hysen_device(device_id, hass, name,
-                    broadlink_hysen_climate_device((ip_addr, ip_port), blmac_addr,timeout),
-                    target_temp_default, target_temp_step, operation_list,
-                    sync_clock_time_per_day, get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high)    
-                if (newhassdevice is not None):
-                    hass_devices.append(newhassdevice)
-                else:
-                   _LOGGER.error("Failed to add Broadlink Hysen Climate device:%s @%s, %s , to HA",device_id, ip_addr, mac_addr.upper())
-            else:
-                hysen_devices = broadlink_hysen_climate_device_discover(timeout)
-                hysen_devicecount = len(hysen_devices)
-                if hysen_devicecount > 0 :
-                    for hysen_device in hysen_devices:
-                            devicemac = ':'.join(format(x, '02x') for x in hysen_device.mac)
-                            devicemac = devicemac.upper()
-                            if (devicemac == mac_addr.upper()):
-                                newhassdevice =  await create_hysen_device(device_id, hass, name,
-                                    broadlink_hysen_climate_device((hysen_device.host[0], hysen_device.host[1]), devicemac,timeout),
-                                    target_temp_default, target_temp_step, operation_list,
-                                    sync_clock_time_per_day, get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high)    
-                                if (newhassdevice is not None):
-                                    hass_devices.append(newhassdevice)
-                                    _LOGGER.warning("Discovered Broadlink Hysen Climate device : %s, at %s",devicemac,hysen_device.host[0])
-                                else:
-                                   _LOGGER.error("Failed to add Broadlink Hysen Climate device:%s @%s, %s , to HA",device_id, ip_addr, devicemac)
-                            else:
-                                _LOGGER.error("Broadlink Hysen Climate device MAC:%s not found.",mac_addr)
-                else:
-                    _LOGGER.error("No Broadlink Hysen Climate device(s) found.")
-                    return []
+            blmac_addr = binascii.unhexlify(mac_addr.encode().replace(b':', b''))
+            host = (ip_addr, ip_port) if ip_addr is not None else None
+            newhassdevice = create_hysen_device(device_id, hass, name,
+                broadlink_hysen_climate_device(host, blmac_addr, timeout),
+                target_temp_default, target_temp_step, operation_list,
+                sync_clock_time_per_day, get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high,full_status_every=full_status_every)
+            hass_devices.append((newhassdevice, dns_name, ip_port))
         except Exception as error:
-            _LOGGER.error("Failed to connect to Broadlink Hysen Climate device MAC:%s, IP:%s, Error:%s", mac_addr,ip_addr, error)
+            _LOGGER.error("Failed to add Broadlink Hysen Climate device:%s @%s, %s , to HA, Error:%s",device_id, ip_addr, mac_addr.upper(), error)
     return hass_devices
 
 
-async def create_hysen_device(device_id,hass,name,
-                              broadlink_hysen_climate_device,
-                              target_temp_default,target_temp_step,operation_list,
-                              sync_clock_time_per_day,get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high):
-    newhassdevice = None
+def create_hysen_device(device_id,hass,name,
+                        broadlink_hysen_climate_device,
+                        target_temp_default,target_temp_step,operation_list,
+                        sync_clock_time_per_day,get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high,
+                        full_status_every=DEFAULT_FULL_STATUS_EVERY):
     entity_id = async_generate_entity_id(ENTITY_ID_FORMAT, device_id, hass=hass)
-    
-    try:
-        if (broadlink_hysen_climate_device.auth() == False):
-            raise Exception('broadlink_response_error:','Inital auth failed for device')
-        newhassdevice = HASS_Hysen_Climate_Device(entity_id,
+    return HASS_Hysen_Climate_Device(entity_id,
                                      hass, name, broadlink_hysen_climate_device,
                                      target_temp_default,target_temp_step,operation_list,
-                                     sync_clock_time_per_day,get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high)
-    except Exception as error:
-        _LOGGER.error("Failed to Authenticate with Broadlink Hysen Climate device:%s , %s ",entity_id, error)
-    return newhassdevice
+                                     sync_clock_time_per_day,get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high,
+                                     full_status_every=full_status_every)
+
+
+async def async_start_hysen_devices(hass, hass_devices, max_concurrent):
+    """Resolve, authenticate and read the first status of every device, max_concurrent at a time.
+
+    The entities are already added as unavailable, each one fills in as its device answers.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    discovery = hass.data[HYSEN_DOMAIN][DATA_DISCOVERY]
+    report = {}
+    startup_time = time.monotonic()
+
+    async def async_start(entity, dns_name, ip_port):
+        device = entity.broadlink_hysen_climate_device
+        async with semaphore:
+            started = time.monotonic()
+            if device.host is None and dns_name is not None:
+                try:
+                    ip_addr = await hass.async_add_executor_job(socket.gethostbyname, dns_name)
+                    device.host = (ip_addr, ip_port)
+                    _LOGGER.warning("Discovered Broadlink Hysen Climate device address: %s, from name %s",ip_addr,dns_name)
+                except Exception as error:
+                    _LOGGER.error("Failed resolve DNS name to IP for Broadlink Hysen Climate device:%s, error:%s",dns_name,error)
+            cached_host = False
+            if device.host is None:
+                # Address from the last discovery, or from the one sweep shared by every
+                # device configured without host or host_dns, as soon as the device answers.
+                discovery.async_track(entity)
+                device.host = discovery.get(entity.mac_address)
+                cached_host = device.host is not None
+                if device.host is None:
+                    device.host = await discovery.async_find(entity.mac_address, device.timeout)
+                    if device.host is not None:
+                        _LOGGER.warning("Discovered Broadlink Hysen Climate device : %s, at %s",entity.mac_address,device.host[0])
+            if device.host is None:
+                _LOGGER.error("Broadlink Hysen Climate device MAC:%s not found.",entity.mac_address)
+                result = 'not found'
+            else:
+                await entity.async_startup(hass.data[HYSEN_DOMAIN][DATA_SESSION_KEYS].get(entity.mac_address))
+                result = 'ok' if entity.available else 'unavailable'
+                if cached_host and not entity.available:
+                    # Nothing at the cached address, a sweep moves the device if it is elsewhere now
+                    discovery.async_device_lost(entity.mac_address)
+            report[entity.entity_id] = (round(time.monotonic() - started, 3), result)
+
+    await asyncio.gather(*(async_start(*hass_device) for hass_device in hass_devices))
+    hass.data[HYSEN_DOMAIN][DATA_STARTUP_REPORT].update(report)
+
+    # Startup timing report, slowest device first
+    failed = [entity_id for entity_id, (seconds, result) in report.items() if result != 'ok']
+    _LOGGER.info("Broadlink Hysen startup of %s devices took %.1fs, %s not available",
+                 len(report), time.monotonic() - startup_time, len(failed))
+    for entity_id, (seconds, result) in sorted(report.items(), key=lambda item: -item[1][0]):
+        _LOGGER.info("Broadlink Hysen startup %s: %.2fs %s", entity_id, seconds, result)
+    if failed:
+        _LOGGER.warning("Broadlink Hysen Climate device(s) not available after startup: %s", ', '.join(failed))
+
+
+def schedule_from_service_data(data):
+    """Return the (weekday, weekend) period lists of a hysen_set_timeschedule service call."""
+    def periods(fields):
+        return [{'start_hour': data[start].hour, 'start_minute': data[start].minute, 'temp': float(data[temp])}
+                for start, temp in fields]
+    return periods(SCHEDULE_WEEKDAY_FIELDS), periods(SCHEDULE_WEEKEND_FIELDS)
 
 
 async def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
@@ -349,13 +502,13 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
                 sectype  = service.data.get(CONF_WIFI_SECTYPE)
                 timeout = service.data.get(CONF_WIFI_TIMEOUT)
                 try:
-                  broadlink_hysen_climate_device_setup(ssid, password, sectype)
+                  await hass.async_add_executor_job(broadlink_hysen_climate_device_setup, ssid, password, sectype)
                 except Exception as error:
                   _LOGGER.error("Failed to send Wifi setup to Broadlink Hysen Climate device(s):%s",error)
                   return False
                 _LOGGER.warning("Wifi setup to Broadlink Hysen Climate device(s) sent.")
                 try:
-                  hysen_devices = broadlink_hysen_climate_device_discover(timeout)
+                  hysen_devices = await hass.data[HYSEN_DOMAIN][DATA_DISCOVERY].async_sweep(timeout)
                   hysen_devicecount = len(hysen_devices)
                   if hysen_devicecount > 0 :
                      for hysen_device in hysen_devices:
@@ -402,7 +555,7 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
                 anti_freeze_function = service.data.get(CONFIG_ADVANCED_ANTIFREEZE)
                 poweron_mem = service.data.get(CONFIG_ADVANCED_POWERONMEM)
                 try:
-                  thermostat.set_advanced(loop_mode, sensor_mode, external_sensor_temprange, deadzone_sensor_temprange, max_temp, min_temp, roomtemp_offset, anti_freeze_function, poweron_mem)
+                  await thermostat.async_set_advanced(loop_mode, sensor_mode, external_sensor_temprange, deadzone_sensor_temprange, max_temp, min_temp, roomtemp_offset, anti_freeze_function, poweron_mem)
                 except Exception as error:
                   _LOGGER.error("Failed to send Advanced setup to Broadlink Hysen Climate device:%s,:",entity_id,error)
                   return False
@@ -443,61 +596,9 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
                if thermostat.entity_id not in entity_id:
                   _LOGGER.error("Broadlink Hysen Climate device entity_id not found:%s",entity_id)
                   return False
-               WEEK_PERIOD1_START  = service.data.get(CONFIG_WEEK_PERIOD1_START)
-               WEEK_PERIOD1_TEMP   = service.data.get(CONFIG_WEEK_PERIOD1_TEMP)
-               WEEK_PERIOD2_START  = service.data.get(CONFIG_WEEK_PERIOD2_START)
-               WEEK_PERIOD2_TEMP   = service.data.get(CONFIG_WEEK_PERIOD2_TEMP)
-               WEEK_PERIOD3_START  = service.data.get(CONFIG_WEEK_PERIOD3_START)
-               WEEK_PERIOD3_TEMP   = service.data.get(CONFIG_WEEK_PERIOD3_TEMP)
-               WEEK_PERIOD4_START  = service.data.get(CONFIG_WEEK_PERIOD4_START)
-               WEEK_PERIOD4_TEMP   = service.data.get(CONFIG_WEEK_PERIOD4_TEMP)
-               WEEK_PERIOD5_START  = service.data.get(CONFIG_WEEK_PERIOD5_START)
-               WEEK_PERIOD5_TEMP   = service.data.get(CONFIG_WEEK_PERIOD5_TEMP)
-               WEEK_PERIOD6_START  = service.data.get(CONFIG_WEEK_PERIOD6_START)
-               WEEK_PERIOD6_TEMP   = service.data.get(CONFIG_WEEK_PERIOD6_TEMP)
-               WEEKEND_PERIOD1_START  = service.data.get(CONFIG_WEEKEND_PERIOD1_START)
-               WEEKEND_PERIOD1_TEMP   = service.data.get(CONFIG_WEEKEND_PERIOD1_TEMP)
-               WEEKEND_PERIOD2_START  = service.data.get(CONFIG_WEEKEND_PERIOD2_START)
-               WEEKEND_PERIOD2_TEMP   = service.data.get(CONFIG_WEEKEND_PERIOD2_TEMP)
-               week_period_1 = dict()
-               week_period_1["start_hour"] = int(WEEK_PERIOD1_START.strftime('%H'))
-               week_period_1["start_minute"] = int(WEEK_PERIOD1_START.strftime('%M'))
-               week_period_1["temp"] = float(WEEK_PERIOD1_TEMP)
-               week_period_2 = dict()
-               week_period_2["start_hour"] = int(WEEK_PERIOD2_START.strftime('%H'))
-               week_period_2["start_minute"] = int(WEEK_PERIOD2_START.strftime('%M'))
-               week_period_2["temp"] = float(WEEK_PERIOD2_TEMP)
-               week_period_3 = dict()
-               week_period_3["start_hour"] = int(WEEK_PERIOD3_START.strftime('%H'))
-               week_period_3["start_minute"] = int(WEEK_PERIOD3_START.strftime('%M'))
-               week_period_3["temp"] = float(WEEK_PERIOD3_TEMP)
-               week_period_4 = dict()
-               week_period_4["start_hour"] = int(WEEK_PERIOD4_START.strftime('%H'))
-               week_period_4["start_minute"] = int(WEEK_PERIOD4_START.strftime('%M'))
-               week_period_4["temp"] = float(WEEK_PERIOD4_TEMP)
-               week_period_5 = dict()
-               week_period_5["start_hour"] = int(WEEK_PERIOD5_START.strftime('%H'))
-               week_period_5["start_minute"] = int(WEEK_PERIOD5_START.strftime('%M'))
-               week_period_5["temp"] = float(WEEK_PERIOD5_TEMP)
-               week_period_6 = dict()
-               week_period_6["start_hour"] = int(WEEK_PERIOD6_START.strftime('%H'))
-               week_period_6["start_minute"] = int(WEEK_PERIOD6_START.strftime('%M'))
-               week_period_6["temp"] = float(WEEK_PERIOD6_TEMP)
-               weekend_period_1 = dict()
-               weekend_period_1["start_hour"] = int(WEEKEND_PERIOD1_START.strftime('%H'))
-               weekend_period_1["start_minute"] = int(WEEKEND_PERIOD1_START.strftime('%M'))
-               weekend_period_1["temp"] = float(WEEKEND_PERIOD1_TEMP)
-               weekend_period_2 = dict()
-               weekend_period_2["start_hour"] = int(WEEKEND_PERIOD2_START.strftime('%H'))
-               weekend_period_2["start_minute"] = int(WEEKEND_PERIOD2_START.strftime('%M'))
-               weekend_period_2["temp"] = float(WEEKEND_PERIOD2_TEMP)
-
-               weekday = [week_period_1, week_period_2,
-                          week_period_3, week_period_4,
-                          week_period_5, week_period_6]
-               weekend = [weekend_period_1, weekend_period_2]
+               weekday, weekend = schedule_from_service_data(service.data)
                try:
-                    thermostat.set_schedule(weekday, weekend)
+                    await thermostat.async_set_schedule(weekday, weekend)
                except Exception as error:
                    _LOGGER.error("Failed to send Time schedule setup to Broadlink Hysen Climate device:%s,:",entity_id,error)
                    return False
@@ -517,13 +618,108 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
                   return False
                 tamper_lock = service.data.get(CONFIG_REMOTELOCK)
                 try:
-                  thermostat.set_lock(tamper_lock)
+                  await thermostat.async_set_lock(tamper_lock)
                 except Exception as error:
                   _LOGGER.error("Failed to send Tamper Lock setting to Broadlink Hysen Climate device:%s,:",entity_id,error)
                   return False
                 _LOGGER.info("Remote Lock setting sent to Broadlink Hysen Climate device:%s",entity_id)
                 return True
 
+    #Example for service call (hysen_set_timeschedule_bulk), same periods as hysen_set_timeschedule
+    #for every Hysen thermostat, or the ones in entity_id. Thermostats already on the schedule are skipped
+    #unless force is set. Returns per thermostat status (sent, unchanged, failed, unavailable, not_found) and latency.
+    """
+    data:
+    week_period1_start: '06:00'
+    week_period1_temp: 20
+    ...
+    weekend_period2_temp: 16
+    max_concurrent: 8
+    """
+    async def async_hysen_set_time_schedule_bulk(service):
+        hysen_data = hass.data[HYSEN_DOMAIN]
+        poller = hysen_data[DATA_POLLER]
+        entity_ids = service.data.get(ATTR_ENTITY_ID)
+        max_concurrent = service.data.get(CONFIG_SCHEDULE_MAX_CONCURRENT, poller.max_concurrent_polls)
+        force = service.data.get(CONFIG_SCHEDULE_FORCE)
+
+        # Encoded once for the whole fleet
+        weekday, weekend = schedule_from_service_data(service.data)
+        schedule_payload = build_hysen_schedule_payload(weekday, weekend)
+
+        entities = {entity.entity_id: entity for entity in poller.entities}
+        if entity_ids == 'all':
+            entity_ids = list(entities)
+        semaphore = asyncio.Semaphore(max_concurrent)
+        results = {}
+
+        async def async_push(entity_id):
+            entity = entities.get(entity_id)
+            if entity is None:
+                results[entity_id] = {'status': 'not_found'}
+                return
+            if not entity.available:
+                results[entity_id] = {'status': 'unavailable'}
+                return
+            if not force and entity.schedule_matches(schedule_payload):
+                results[entity_id] = {'status': 'unchanged'}
+                return
+            async with semaphore:
+                started = time.monotonic()
+                error = await entity.async_send_schedule_payload(schedule_payload)
+                latency = round((time.monotonic() - started) * 1000, 1)
+            if error is None:
+                results[entity_id] = {'status': 'sent', 'latency_ms': latency}
+            else:
+                results[entity_id] = {'status': 'failed', 'latency_ms': latency, 'error': str(error)}
+
+        started = time.monotonic()
+        await asyncio.gather(*(async_push(entity_id) for entity_id in entity_ids))
+        counts = collections.Counter(result['status'] for result in results.values())
+        _LOGGER.info("Time schedule pushed to %s Broadlink Hysen Climate device(s) in %.1fs: %s",
+                     len(results), time.monotonic() - started, dict(counts))
+        return {'results': results, **{status: counts[status] for status in ('sent', 'unchanged', 'failed', 'unavailable', 'not_found')}}
+
+    #Example for service call (hysen_profile), profiles the event loop until cycles poll cycles are done
+    #or duration seconds have passed, writes hysen_profile_<time>.pstats (deterministic) or .collapsed
+    #(sampling, one line per stack for flamegraph tools) to the config dir and logs the top functions.
+    """
+    data:
+    mode: deterministic
+    duration: 300
+    cycles: 5
+    top: 20
+    """
+    async def async_hysen_profile(service):
+        # Runs in the background, the service call returns straight away
+        hass.async_create_background_task(hass.data[HYSEN_DOMAIN][DATA_PROFILER].async_profile(
+            service.data.get(CONFIG_PROFILE_MODE), service.data.get(CONFIG_PROFILE_DURATION),
+            service.data.get(CONFIG_PROFILE_CYCLES), service.data.get(CONFIG_PROFILE_TOP)), 'hysen profile')
+
+    #Example for service call (hysen_capture), writes every datagram to and from the thermostats, with
+    #the plaintext, to hysen_capture_<time>.bin in the config dir for duration seconds. The file holds the
+    #session keys. Replay it with benchmarks/replay_capture.py.
+    """
+    data:
+    duration: 300
+    """
+    async def async_hysen_capture(service):
+        # Runs in the background, the service call returns straight away
+        hass.async_create_background_task(async_capture_hysen_packets(hass, service.data.get(CONFIG_CAPTURE_DURATION)),
+                                          'hysen capture')
+
+    #Example for service call (hysen_get_history), returns the polled room, external and target temperature
+    #and heating (share of polls with the heating on) of the last hours from memory, every poll of the last
+    #couple of hours, 5 minute averages for the last day and hourly averages for the last week.
+    """
+    data:
+    entity_id: climate.bathroom
+    hours: 24
+    """
+    async def async_hysen_get_history(thermostat,service):
+                hours = service.data.get(CONFIG_HISTORY_HOURS)
+                return thermostat.history.series(0 if hours is None else thermostat.history.now() - hours * 3600)
+
     hass.data[DOMAIN].async_register_entity_service(
         SERVICE_SET_WIFI, SET_WIFI_SCHEMA,
         async_hysen_set_wifi
@@ -544,22 +740,710 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
         async_hysen_set_remotelock
         )
 
-    hass_devices = await devices_from_config(config, hass)
+    hass.data[DOMAIN].async_register_entity_service(
+        SERVICE_GET_HISTORY, GET_HISTORY_SCHEMA,
+        async_hysen_get_history, supports_response=SupportsResponse.ONLY
+        )
+
+    hysen_data = hass.data.setdefault(HYSEN_DOMAIN, {})
+    first_platform = DATA_SETUP not in hysen_data
+    if first_platform:
+        # hysen platform blocks are set up concurrently, the others wait for the shared poller and stores
+        hysen_data[DATA_SETUP] = hass.async_create_task(async_setup_hysen_data(
+            hass, config.get(CONF_SCAN_INTERVAL, MIN_TIME_BETWEEN_SCANS), config.get(CONF_MAX_CONCURRENT_POLLS),
+            config.get(CONF_DISCOVERY_NETWORKS, [])))
+    await hysen_data[DATA_SETUP]
+    poller = hysen_data[DATA_POLLER]
+    if first_platform:
+        hass.services.async_register(
+            DOMAIN, SERVICE_SET_TIME_SCHEDULE_BULK, async_hysen_set_time_schedule_bulk,
+            schema=SET_TIME_SCHEDULE_BULK_SCHEMA, supports_response=SupportsResponse.OPTIONAL)
+        hass.services.async_register(DOMAIN, SERVICE_PROFILE, async_hysen_profile, schema=PROFILE_SCHEMA)
+        hass.services.async_register(DOMAIN, SERVICE_CAPTURE, async_hysen_capture, schema=CAPTURE_SCHEMA)
+        async_load_hysen_sensors(hass, {'fleet': True})
+
+        @callback
+        def async_shutdown(event):
+            poller.async_stop()
+            close_hysen_shared_socket()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_shutdown)
+    else:
+        # Every hysen platform block shares the poller of the first one, only the discovery networks add up
+        scan_interval = config.get(CONF_SCAN_INTERVAL, MIN_TIME_BETWEEN_SCANS).total_seconds()
+        max_concurrent_polls = config.get(CONF_MAX_CONCURRENT_POLLS, DEFAULT_MAX_CONCURRENT_POLLS)
+        if scan_interval != poller.scan_interval or max_concurrent_polls != poller.max_concurrent_polls:
+            _LOGGER.warning("Broadlink Hysen scan_interval %ss and max_concurrent_polls %s of this hysen platform are ignored, "
+                            "all Hysen devices are polled every %ss with %s polls in flight as set by the first hysen platform",
+                            scan_interval, max_concurrent_polls, poller.scan_interval, poller.max_concurrent_polls)
+        hysen_data[DATA_DISCOVERY].async_add_networks(config.get(CONF_DISCOVERY_NETWORKS, []))
+
+    # Entities are added straight away as unavailable, the devices are set up in the background.
+    hass_devices = devices_from_config(config, hass)
 
     if hass_devices:
-        async_add_devices(hass_devices)
+        async_add_devices([hass_device[0] for hass_device in hass_devices])
+
+        # A diagnostic transport sensor per thermostat
+        async_load_hysen_sensors(hass, {'entities': [(hass_device[0].entity_id, hass_device[0].name) for hass_device in hass_devices]})
+        hass.async_create_background_task(
+            async_start_hysen_devices(hass, hass_devices, config.get(CONF_MAX_CONCURRENT_POLLS, DEFAULT_MAX_CONCURRENT_POLLS)),
+            'hysen startup')
+
+async def async_setup_hysen_data(hass, scan_interval, max_concurrent_polls, discovery_networks):
+    """Create the poller, stores and discovery shared by every Hysen entity in hass.data."""
+    hysen_data = hass.data.setdefault(HYSEN_DOMAIN, {})
+    poller = HASS_Hysen_Fleet_Poller(hass, scan_interval, max_concurrent_polls)
+    hysen_data[DATA_POLLER] = poller
+
+    hysen_data[DATA_PROFILER] = HASS_Hysen_Profiler(hass, poller)
+
+    analytics = HASS_Hysen_Fleet_Analytics(scan_interval)
+    poller.async_add_cycle_listener(analytics.async_cycle_done)
+    hysen_data[DATA_ANALYTICS] = analytics
+
+    hysteresis_restores = HASS_Hysen_Hysteresis_Restores(hass)
+    await hysteresis_restores.async_load()
+    hysen_data[DATA_HYSTERESIS_RESTORES] = hysteresis_restores
+
+    hysen_data[DATA_STARTUP_REPORT] = {}
+
+    session_keys = HASS_Hysen_Session_Keys(hass)
+    await session_keys.async_load()
+    hysen_data[DATA_SESSION_KEYS] = session_keys
+
+    discovery = HASS_Hysen_Discovery(hass, discovery_networks)
+    await discovery.async_load()
+    hysen_data[DATA_DISCOVERY] = discovery
+    return hysen_data
+
+# Load the hysen sensor platform with discovery_info once the sensor integration is up
+@callback
+def async_load_hysen_sensors(hass, discovery_info):
+    async def async_load(hass, component):
+        await ha_discovery.async_load_platform(hass, 'sensor', HYSEN_DOMAIN, discovery_info, {})
+    async_when_setup(hass, 'sensor', async_load)
+
+######################################################################################################################################
+######################################################################################################################################
+# Per device circuit breaker.
+# Closed: polled every scan interval. Open: not polled until the probe time.
+# Half open: one probe poll in flight, success closes the breaker and failure
+# opens it again with twice the backoff.
+class HASS_Hysen_Circuit_Breaker():
+    def __init__(self, name, base_backoff, max_backoff=BREAKER_MAX_BACKOFF.total_seconds(),
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD):
+        self.name = name
+        self.base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._failure_threshold = failure_threshold
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.backoff = 0
+        self.probe_at = None
+        self.opened_count = 0
+        self.probe_count = 0
+
+    def allow_poll(self, now):
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN and now >= self.probe_at:
+            self.state = BREAKER_HALF_OPEN
+            self.probe_count = self.probe_count + 1
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != BREAKER_CLOSED:
+            _LOGGER.info("Broadlink Hysen Climate device:%s is back after %s probes, polling again", self.name, self.probe_count)
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.backoff = 0
+        self.probe_at = None
+        self.probe_count = 0
+
+    def record_failure(self, now):
+        self.failures = self.failures + 1
+        if self.state == BREAKER_HALF_OPEN:
+            self._open(now, min(self.backoff * 2, self._max_backoff))
+        elif self.state == BREAKER_CLOSED and self.failures >= self._failure_threshold:
+            _LOGGER.info("Broadlink Hysen Climate device:%s failed %s polls in a row, only probing it from now on", self.name, self.failures)
+            self.opened_count = self.opened_count + 1
+            self._open(now, self.base_backoff)
+
+    # Probe on the next cycle, e.g. after the device was found at another address
+    def probe_now(self):
+        if self.state == BREAKER_OPEN:
+            self.probe_at = 0
+
+    def _open(self, now, backoff):
+        self.state = BREAKER_OPEN
+        self.backoff = backoff
+        # Jitter, so devices that went down together are not probed together
+        self.probe_at = now + backoff * random.uniform(1 - BREAKER_JITTER, 1 + BREAKER_JITTER)
+
+    def as_dict(self, now):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'backoff': self.backoff,
+            'next_probe_in': None if self.probe_at is None else max(0, round(self.probe_at - now, 1)),
+            'opened_count': self.opened_count,
+        }
+
+######################################################################################################################################
+######################################################################################################################################
+# Fleet wide polling.
+# Instead of every entity being polled by HA at the same moment, one poller owns
+# all Hysen entities, gives each a fixed phase offset inside the scan interval
+# and caps the number of device requests in flight.
+class HASS_Hysen_Fleet_Poller():
+    def __init__(self, hass, scan_interval, max_concurrent_polls):
+        self._hass = hass
+        self.scan_interval = scan_interval.total_seconds()
+        self._semaphore = asyncio.Semaphore(max_concurrent_polls)
+        self._entities = []
+        self._task = None
+
+        self.max_concurrent_polls = max_concurrent_polls
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.cycle_count = 0
+        self.last_cycle_time = None
+        self.last_cycle_polls = 0
+        self.last_cycle_skipped = 0
+        self._skipped = 0
+        self._cycle_listeners = []
+
+    @property
+    def stats(self):
+        """Return the poller statistics of the last completed cycle."""
+        return {
+            'devices': len(self._entities),
+            'scan_interval': self.scan_interval,
+            'max_concurrent_polls': self.max_concurrent_polls,
+            'cycle_count': self.cycle_count,
+            'last_cycle_time': self.last_cycle_time,
+            'last_cycle_polls': self.last_cycle_polls,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'in_flight': self.in_flight,
+            'last_cycle_skipped': self.last_cycle_skipped,
+            'breakers': self.breaker_stats,
+        }
+
+    @property
+    def breaker_stats(self):
+        """Return the number of devices per circuit breaker state."""
+        states = {BREAKER_CLOSED: 0, BREAKER_OPEN: 0, BREAKER_HALF_OPEN: 0}
+        for entity in self._entities:
+            states[entity.circuit_breaker.state] = states[entity.circuit_breaker.state] + 1
+        return states
+
+    @property
+    def entities(self):
+        return list(self._entities)
+
+    @callback
+    def async_add_entity(self, entity):
+        self._entities.append(entity)
+        # An open circuit breaker first probes one scan interval later
+        entity.circuit_breaker.base_backoff = self.scan_interval
+        if self._task is None:
+            self._task = self._hass.async_create_background_task(self._async_run(), 'hysen fleet poller')
+
+    @callback
+    def async_remove_entity(self, entity):
+        if entity in self._entities:
+            self._entities.remove(entity)
+
+    # Called after every completed poll cycle, returns the function that removes it again
+    @callback
+    def async_add_cycle_listener(self, listener):
+        self._cycle_listeners.append(listener)
+        return lambda: self._cycle_listeners.remove(listener)
+
+    @callback
+    def async_stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _async_run(self):
+        loop = self._hass.loop
+        while True:
+            cycle_start = loop.time()
+            entities = list(self._entities)
+            if entities:
+                # Device n of N is polled n/N of the way into the interval.
+                spacing = self.scan_interval / len(entities)
+                self.max_queue_depth = 0
+                self._skipped = 0
+                await asyncio.gather(*(self._async_poll(entity, cycle_start + index * spacing)
+                                       for index, entity in enumerate(entities)))
+                self.cycle_count = self.cycle_count + 1
+                self.last_cycle_time = loop.time() - cycle_start
+                self.last_cycle_skipped = self._skipped
+                self.last_cycle_polls = len(entities) - self._skipped
+                if self.last_cycle_time > self.scan_interval:
+                    _LOGGER.warning("Broadlink Hysen poll cycle of %s devices took %.1fs, longer than the %.0fs scan interval (max queue depth %s, %s skipped by open circuit breakers)",
+                                    len(entities), self.last_cycle_time, self.scan_interval, self.max_queue_depth, self._skipped)
+                else:
+                    _LOGGER.debug("Broadlink Hysen poll cycle of %s devices took %.1fs (max queue depth %s, %s skipped by open circuit breakers)",
+                                  len(entities), self.last_cycle_time, self.max_queue_depth, self._skipped)
+                for listener in self._cycle_listeners:
+                    listener()
+            await asyncio.sleep(max(0, cycle_start + self.scan_interval - loop.time()))
+
+    async def _async_poll(self, entity, poll_at):
+        await asyncio.sleep(max(0, poll_at - self._hass.loop.time()))
+        if entity not in self._entities:
+            return
+        probe = entity.circuit_breaker.state != BREAKER_CLOSED
+        if not entity.circuit_breaker.allow_poll(self._hass.loop.time()):
+            self._skipped = self._skipped + 1
+            return
+        if probe:
+            # A device that is probably still gone does not hold up the cycle
+            self._hass.async_create_background_task(self._async_poll_now(entity), 'hysen circuit breaker probe')
+            return
+        await self._async_poll_now(entity)
+
+    async def _async_poll_now(self, entity):
+        self.queue_depth = self.queue_depth + 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        async with self._semaphore:
+            self.queue_depth = self.queue_depth - 1
+            self.in_flight = self.in_flight + 1
+            try:
+                await entity.async_poll()
+            except Exception as error:
+                _LOGGER.error("Failed to poll Broadlink Hysen Climate device:%s, :%s", entity.entity_id, error)
+            finally:
+                self.in_flight = self.in_flight - 1
+
+######################################################################################################################################
+######################################################################################################################################
+# On demand profiling of the event loop, for the hysen_profile service.
+# Nothing is hooked in while no profile runs. Deterministic mode runs cProfile on
+# the event loop thread, where async_update, async_send_packet, encrypt/decrypt,
+# the CRC and get_full_status all run, and writes a .pstats file. Sampling mode takes the loop thread
+# stack every PROFILE_SAMPLE_INTERVAL from another thread instead, which costs
+# less per call, and writes the stacks collapsed (frame;frame;frame count).
+class HASS_Hysen_Profiler():
+    def __init__(self, hass, poller):
+        self._hass = hass
+        self._poller = poller
+        self.running = False
+
+    async def async_profile(self, mode, duration, cycles, top):
+        if self.running:
+            _LOGGER.error("Broadlink Hysen profile already running, not starting another")
+            return
+        self.running = True
+        try:
+            if mode == PROFILE_MODE_SAMPLING:
+                await self._async_profile_sampling(duration, cycles, top)
+            else:
+                await self._async_profile_deterministic(duration, cycles, top)
+        except Exception as error:
+            _LOGGER.error("Failed to profile Broadlink Hysen Climate device(s):%s",error)
+        finally:
+            self.running = False
+
+    async def _async_window(self, duration, cycles):
+        """Wait until cycles more poll cycles are done or duration seconds have passed."""
+        loop = self._hass.loop
+        deadline = loop.time() + duration
+        last_cycle = None if cycles is None else self._poller.cycle_count + cycles
+        while loop.time() < deadline and (last_cycle is None or self._poller.cycle_count < last_cycle):
+            await asyncio.sleep(min(1, deadline - loop.time()))
+
+    def _profile_path(self, extension):
+        return self._hass.config.path(time.strftime('hysen_profile_%Y%m%d_%H%M%S.') + extension)
+
+    async def _async_profile_deterministic(self, duration, cycles, top):
+        profile = cProfile.Profile()
+        start_cycles = self._poller.cycle_count
+        started = time.monotonic()
+        profile.enable()
+        try:
+            await self._async_window(duration, cycles)
+        finally:
+            profile.disable()
+        elapsed = time.monotonic() - started
+        path = self._profile_path('pstats')
+        await self._hass.async_add_executor_job(profile.dump_stats, path)
+        summary = io.StringIO()
+        # Only the functions of this integration in the log, the file has everything
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats('hysen', top)
+        _LOGGER.warning("Broadlink Hysen profile of %s poll cycles in %.1fs written to %s\n%s",
+                        self._poller.cycle_count - start_cycles, elapsed, path, summary.getvalue())
+
+    async def _async_profile_sampling(self, duration, cycles, top):
+        thread_id = threading.get_ident()
+        stop = threading.Event()
+        start_cycles = self._poller.cycle_count
+        started = time.monotonic()
+        sampler = self._hass.async_add_executor_job(hysen_sample_stacks, thread_id, stop, PROFILE_SAMPLE_INTERVAL)
+        try:
+            await self._async_window(duration, cycles)
+        finally:
+            stop.set()
+        stacks = await sampler
+        elapsed = time.monotonic() - started
+        path = self._profile_path('collapsed')
+        await self._hass.async_add_executor_job(write_collapsed_stacks, path, stacks)
+        total = sum(stacks.values())
+        # Samples with the function anywhere on the stack, and as the running (leaf) function
+        inclusive = collections.Counter()
+        leaf = collections.Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            for frame in set(frames):
+                inclusive[frame] += count
+            leaf[frames[-1]] += count
+        summary = ['%8s %8s  %s' % ('total%', 'self%', 'function')]
+        for frame, count in inclusive.most_common():
+            if len(summary) > top:
+                break
+            if 'climate.py' in frame:
+                summary.append('%7.1f%% %7.1f%%  %s' % (100 * count / total, 100 * leaf[frame] / total, frame))
+        _LOGGER.warning("Broadlink Hysen profile of %s poll cycles in %.1fs, %s samples written to %s\n%s",
+                        self._poller.cycle_count - start_cycles, elapsed, total, path, '\n'.join(summary))
+
+# Stack samples of thread_id every interval seconds until stop is set, as a Counter
+# of collapsed stacks, outermost frame first: 'file:function;file:function' -> samples
+def hysen_sample_stacks(thread_id, stop, interval):
+    stacks = collections.Counter()
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        frames = []
+        while frame is not None:
+            frames.append('%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            frame = frame.f_back
+        if frames:
+            stacks[';'.join(reversed(frames))] += 1
+    return stacks
+
+def write_collapsed_stacks(path, stacks):
+    with open(path, 'w') as collapsed_file:
+        for stack, count in stacks.items():
+            collapsed_file.write('%s %d\n' % (stack, count))
+
+# Packet capture for the hysen_capture service, see broadlink_hysen_packet_capture
+async def async_capture_hysen_packets(hass, duration):
+    if hysen_packet_capture_running():
+        _LOGGER.error("Broadlink Hysen packet capture already running, not starting another")
+        return
+    path = hass.config.path(time.strftime('hysen_capture_%Y%m%d_%H%M%S.bin'))
+    try:
+        await hass.async_add_executor_job(start_hysen_packet_capture, path)
+    except Exception as error:
+        _LOGGER.error("Failed to start Broadlink Hysen packet capture to %s:%s",path,error)
+        return
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        records = await hass.async_add_executor_job(stop_hysen_packet_capture)
+    _LOGGER.warning("Broadlink Hysen packet capture of %.0fs, %s datagrams written to %s", duration, records, path)
+
+######################################################################################################################################
+######################################################################################################################################
+# Fleet analytics.
+# The latest status of every thermostat in one numpy array, a row per entity and a
+# column per field, written as each poll comes in. Once per poll cycle the room
+# metrics of the whole fleet are computed with array operations, and the fleet
+# sensors are told:
+#   setpoint_error      room - target temperature, while on
+#   heating_duty_cycle  share of polls with the heating active, moving average over ANALYTICS_DUTY_CYCLE_WINDOW
+#   temperature_spread  external - room temperature, for devices reporting an external temperature
+#   time_to_setpoint    how long the last warm up took from below the target temperature to reaching it
+ANALYTICS_DUTY_CYCLE_WINDOW = timedelta(hours=1)
+ANALYTICS_STATUS_FIELDS = ('room_temp', 'external_temp', 'target_temp', 'active', 'power')
+# Kept per entity next to the status: last poll, duty cycle average, warm up start and duration
+ANALYTICS_FIELDS = ANALYTICS_STATUS_FIELDS + ('updated', 'duty_cycle', 'below_since', 'time_to_setpoint')
+ANALYTICS_METRICS = ('setpoint_error', 'heating_duty_cycle', 'temperature_spread', 'time_to_setpoint')
+# Metrics where the mean and the room furthest out go by absolute value
+ANALYTICS_MAGNITUDE_METRICS = [True, False, True, False]
+# Rows allocated up front, enough for most fleets, the array grows in place beyond that
+ANALYTICS_INITIAL_ROOMS = 64
+# Devices without a poll in this many scan intervals are left out
+ANALYTICS_STALE_INTERVALS = 3
+
+class HASS_Hysen_Fleet_Analytics():
+    def __init__(self, scan_interval):
+        scan_interval = scan_interval.total_seconds()
+        self._duty_cycle_alpha = min(1.0, scan_interval / ANALYTICS_DUTY_CYCLE_WINDOW.total_seconds())
+        self._stale_after = scan_interval * ANALYTICS_STALE_INTERVALS
+        self.entity_ids = []
+        self._rows = {}
+        # The entity ids again as an array, to pick the rooms of a metric without a Python loop
+        self._entity_ids = numpy.empty(ANALYTICS_INITIAL_ROOMS, dtype=object)
+        self._rooms = numpy.full((ANALYTICS_INITIAL_ROOMS, len(ANALYTICS_FIELDS)), numpy.nan)
+        self.metrics = {}
+        self._listeners = []
+
+    def _row(self, entity_id):
+        row = self._rows.get(entity_id)
+        if row is None:
+            row = self._rows[entity_id] = len(self.entity_ids)
+            self.entity_ids.append(entity_id)
+            if row >= len(self._rooms):
+                # Double in place, no views of the arrays are kept between calls
+                capacity = 2 * len(self._rooms)
+                self._rooms.resize((capacity, len(ANALYTICS_FIELDS)), refcheck=False)
+                self._rooms[row:] = numpy.nan
+                self._entity_ids.resize(capacity, refcheck=False)
+            self._entity_ids[row] = entity_id
+        return row
+
+    @callback
+    def async_record(self, entity_id, room_temp, external_temp, target_temp, active, power):
+        self._rooms[self._row(entity_id), :len(ANALYTICS_STATUS_FIELDS) + 1] = (
+            room_temp, external_temp, target_temp, active, power, time.monotonic())
+
+    @callback
+    def async_remove(self, entity_id):
+        row = self._rows.get(entity_id)
+        if row is not None:
+            # Drop the last poll and the per entity state, a re-added entity starts afresh
+            self._rooms[row, len(ANALYTICS_STATUS_FIELDS):] = numpy.nan
+
+    @callback
+    def async_add_listener(self, listener):
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    @callback
+    def async_cycle_done(self):
+        count = len(self.entity_ids)
+        if not count:
+            return
+        now = time.monotonic()
+        # Column views of the filled rows, the per entity state is updated through them
+        (room_temp, external_temp, target_temp, active, power,
+         updated, duty_cycle, below_since, time_to_setpoint) = self._rooms[:count].T
+        with numpy.errstate(invalid='ignore'):
+            # nan, never polled or removed, compares False
+            valid = now - updated <= self._stale_after
+            on = valid & (power == HYSEN_POWERON)
+
+            first = valid & numpy.isnan(duty_cycle)
+            duty_cycle[first] = active[first]
+            duty_cycle[valid] += self._duty_cycle_alpha * (active[valid] - duty_cycle[valid])
+
+            below = on & (room_temp < target_temp)
+            below_since[below & numpy.isnan(below_since)] = now
+            reached = on & ~below & ~numpy.isnan(below_since)
+            time_to_setpoint[reached] = now - below_since[reached]
+            below_since[~below] = numpy.nan
+
+            # One row per metric, in ANALYTICS_METRICS order, nan for the rooms it does not cover
+            values = numpy.array((numpy.where(on, room_temp - target_temp, numpy.nan),
+                                  numpy.where(valid, duty_cycle * 100, numpy.nan),
+                                  numpy.where(valid & (external_temp > 0), external_temp - room_temp, numpy.nan),
+                                  numpy.where(valid, time_to_setpoint / 60, numpy.nan)))
+
+        self.metrics = self._summaries(values, count)
+        self.metrics['heating_duty_cycle']['heating_now'] = int(numpy.count_nonzero(valid & (active == 1)))
+        self.metrics['time_to_setpoint']['warming_up'] = int(numpy.count_nonzero(~numpy.isnan(below_since)))
+        for listener in self._listeners:
+            listener()
+
+    def _summaries(self, values, count):
+        """Fleet mean and the room furthest out of every metric, all metrics in one pass."""
+        known = ~numpy.isnan(values)
+        size = values.copy()
+        size[ANALYTICS_MAGNITUDE_METRICS] = numpy.abs(size[ANALYTICS_MAGNITUDE_METRICS])
+        size[~known] = 0
+        totals = numpy.add.reduce(size, axis=1)
+        size[~known] = -numpy.inf
+        furthest = size.argmax(axis=1)
+        rounded = values.round(2)
+        entity_ids = self._entity_ids[:count]
+        summaries = {}
+        for index, (metric, rooms, total, room) in enumerate(zip(
+                ANALYTICS_METRICS, known.sum(axis=1).tolist(), totals.tolist(), furthest.tolist())):
+            if not rooms:
+                summaries[metric] = {'mean': None, 'max': None, 'max_room': None, 'rooms': {}}
+                continue
+            summaries[metric] = {
+                'mean': round(total / rooms, 2),
+                'max': rounded[index, room].item(),
+                'max_room': self.entity_ids[room],
+                'rooms': dict(zip(entity_ids[known[index]].tolist(), rounded[index, known[index]].tolist())),
+            }
+        return summaries
+
+######################################################################################################################################
+######################################################################################################################################
+# Setpoints waiting to be put back after a HA hysteresis nudge.
+# Kept in HA storage, so a restart between the nudge and the restore can not
+# leave a thermostat at the nudged setpoint.
+class HASS_Hysen_Hysteresis_Restores():
+    def __init__(self, hass):
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY_HYSTERESIS_RESTORES)
+        self._restores = {}
+
+    async def async_load(self):
+        self._restores = await self._store.async_load() or {}
+
+    def get(self, entity_id):
+        return self._restores.get(entity_id)
+
+    async def async_set(self, entity_id, target_temp):
+        self._restores[entity_id] = target_temp
+        await self._store.async_save(self._restores)
+
+    async def async_remove(self, entity_id):
+        if self._restores.pop(entity_id, None) is not None:
+            await self._store.async_save(self._restores)
+
+# Session id and AES key negotiated by async_auth(), by device MAC.
+# A restart tries the stored session first instead of authenticating again.
+class HASS_Hysen_Session_Keys():
+    def __init__(self, hass):
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY_SESSION_KEYS)
+        self._sessions = {}
+
+    async def async_load(self):
+        self._sessions = await self._store.async_load() or {}
+
+    def get(self, mac):
+        session = self._sessions.get(mac)
+        if session is None:
+            return None
+        return bytes.fromhex(session['id']), bytes.fromhex(session['key'])
+
+    @callback
+    def async_set(self, mac, device_id, key):
+        session = {'id': bytes(device_id).hex(), 'key': bytes(key).hex()}
+        if self._sessions.get(mac) != session:
+            self._sessions[mac] = session
+            self._store.async_delay_save(lambda: self._sessions, SESSION_KEYS_SAVE_DELAY)
+
+######################################################################################################################################
+######################################################################################################################################
+# Discovery.
+# One sweep at a time, over every local subnet and the configured discovery_networks,
+# shared by everything waiting on it, with each
+# device handed out as soon as it answers. Addresses found are kept in HA storage
+# by MAC, so a restart only sweeps for devices not seen within DISCOVERY_CACHE_TTL.
+class HASS_Hysen_Discovery():
+    def __init__(self, hass, networks=()):
+        self._hass = hass
+        self._networks = list(networks)
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY_DISCOVERED_HOSTS)
+        self._hosts = {}
+        self._sweep = None
+        self._last_sweep = None
+        self._found = {}
+        self._waiters = {}
+        # Entities whose address comes from discovery, by MAC
+        self._entities = {}
+
+    async def async_load(self):
+        self._hosts = await self._store.async_load() or {}
+
+    def get(self, mac):
+        """Return the cached (ip, port) for mac, None if unknown or older than DISCOVERY_CACHE_TTL."""
+        host = self._hosts.get(mac)
+        if host is None or time.time() - host['seen'] > DISCOVERY_CACHE_TTL.total_seconds():
+            return None
+        return (host['host'], host['port'])
+
+    @callback
+    def async_track(self, entity):
+        self._entities[entity.mac_address] = entity
+
+    @callback
+    def async_add_networks(self, networks):
+        """Also sweep the networks of another hysen platform block."""
+        self._networks.extend(network for network in networks if network not in self._networks)
+
+    async def async_find(self, mac, timeout):
+        """Return the (ip, port) of mac as soon as it answers a sweep, None if it does not."""
+        sweep = self.async_sweep(timeout)
+        if mac in self._found:
+            return self._found[mac].host
+        waiter = self._hass.loop.create_future()
+        self._waiters.setdefault(mac, []).append(waiter)
+        await asyncio.wait((waiter, sweep), return_when=asyncio.FIRST_COMPLETED)
+        return waiter.result() if waiter.done() else None
+
+    @callback
+    def async_sweep(self, timeout=DEFAULT_TIMEOUT):
+        """Start a sweep unless one is running, returns the task with the list of devices found."""
+        if self._sweep is None:
+            self._found = {}
+            self._sweep = self._hass.async_create_background_task(self._async_run_sweep(timeout), 'hysen discovery')
+        return self._sweep
+
+    @callback
+    def async_device_lost(self, mac):
+        """A device stopped answering, sweep again if its address came from discovery."""
+        if mac not in self._entities or self._sweep is not None:
+            return
+        if self._last_sweep is not None and self._hass.loop.time() - self._last_sweep < MIN_TIME_BETWEEN_REDISCOVERY.total_seconds():
+            return
+        _LOGGER.info("Broadlink Hysen Climate device:%s stopped answering, discovering devices again", mac)
+        self.async_sweep(self._entities[mac].broadlink_hysen_climate_device.timeout)
+
+    async def _async_run_sweep(self, timeout):
+        try:
+            # Every local subnet and configured network in the same timeout window
+            targets = await self._hass.async_add_executor_job(hysen_discovery_targets, self._networks)
+            async for hysen_device in async_broadlink_hysen_climate_device_discover(timeout, targets=targets):
+                self._async_found(hysen_device)
+        except Exception as error:
+            _LOGGER.error("Failed to discover Broadlink Hysen Climate device(s):%s",error)
+        finally:
+            self._sweep = None
+            self._last_sweep = self._hass.loop.time()
+            waiters, self._waiters = self._waiters, {}
+            for mac_waiters in waiters.values():
+                for waiter in mac_waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        return list(self._found.values())
+
+    @callback
+    def _async_found(self, hysen_device):
+        mac = ':'.join(format(x, '02X') for x in hysen_device.mac)
+        self._found[mac] = hysen_device
+        self._hosts[mac] = {'host': hysen_device.host[0], 'port': hysen_device.host[1],
+                            'name': hysen_device.name, 'seen': time.time()}
+        self._store.async_delay_save(lambda: self._hosts, DISCOVERED_HOSTS_SAVE_DELAY)
+        for waiter in self._waiters.pop(mac, []):
+            if not waiter.done():
+                waiter.set_result(hysen_device.host)
+        entity = self._entities.get(mac)
+        if entity is not None and entity.broadlink_hysen_climate_device.host not in (None, hysen_device.host):
+            _LOGGER.warning("Broadlink Hysen Climate device:%s moved to %s",entity.entity_id,hysen_device.host[0])
+            entity.broadlink_hysen_climate_device.host = hysen_device.host
+            entity.circuit_breaker.probe_now()
 
 ######################################################################################################################################
 ######################################################################################################################################
 class HASS_Hysen_Climate_Device(ClimateEntity):
+    # Keep the thermostat clock and the schedule lists out of the recorder database
+    _unrecorded_attributes = frozenset({'clock_hour', 'clock_min', 'clock_sec', 'day_of_week', 'week_day', 'week_end',
+                                        'rtt_statistics'})
+
     def __init__(self, entity_id, hass, name, broadlink_hysen_climate_device, target_temp_default,
-                 target_temp_step, operation_list,sync_clock_time_per_day,get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high):
+                 target_temp_step, operation_list,sync_clock_time_per_day,get_current_temp_from_sensor_override,use_HA_for_hysteresis,HA_hysteresis_bais_high,HA_hysteresis_bais_low,HA_hysteresis_sample_count_target_low,HA_hysteresis_sample_count_target_high,
+                 full_status_every=1):
         """Initialize the Broadlink Hysen Climate device."""
         self.entity_id = entity_id
         self._hass = hass
         self._name = name
-        self._HysenData = []
+        self._HysenData = None
         self._broadlink_hysen_climate_device = broadlink_hysen_climate_device
+        # Polls in between full status reads only read the live registers
+        self._full_status_every = full_status_every
+        self._live_status_polls = 0
 
 
         self._sync_clock_time_per_day = sync_clock_time_per_day
@@ -570,6 +1454,9 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
         self._HA_hysteresis_sample_count_target_low = HA_hysteresis_sample_count_target_low
         self._HA_hysteresis_sample_count_target_high = HA_hysteresis_sample_count_target_high
         self._use_HA_for_hysteresis_sample_count = 0
+        self._hysteresis_restore_temp = None
+        self._hysteresis_restore_retries = 0
+        self._hysteresis_restore_cancel = None
 
         self._current_day_of_week = 0
 
@@ -613,9 +1500,24 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
         self._week_end = ""
         
         self._update_error_count = 0
+        self.circuit_breaker = HASS_Hysen_Circuit_Breaker(entity_id, MIN_TIME_BETWEEN_SCANS.total_seconds())
         
-        self._available = True 
-        self.update(no_throttle=True)
+        # Unavailable until async_startup has authenticated and read the device
+        self._available = False
+        self._started = False
+
+        self._published_state = None
+        self._published_clock_time = 0
+
+        self._command_batch = None
+        # Status fields written by a command, shown straight away and confirmed by the next poll
+        self._pending_commands = {}
+        self._pending_commands_sent = None
+        # Last status read from the device, to put values back when a write fails
+        self._device_status = None
+        # Polled temperatures and heating state, for the hysen_get_history service
+        self.history = hysen_history()
+        self._analytics = None
 
 ######################################################################################################################################
 ######################################################################################################################################
@@ -624,6 +1526,19 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
         """Return the name of the climate device."""
         return self._name
 
+    @property
+    def broadlink_hysen_climate_device(self):
+        return self._broadlink_hysen_climate_device
+
+    @property
+    def mac_address(self):
+        return ':'.join(format(x, '02X') for x in self._broadlink_hysen_climate_device.mac)
+
+    @property
+    def should_poll(self):
+        """Polling is done by the fleet poller, not by HA."""
+        return False
+
     @property
     def available(self) -> bool:
         """Return True if the device is currently available."""
@@ -732,94 +1647,171 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
         attr['day_of_week'] = self._day_of_week
         attr['week_day'] = str(self._week_day).replace("'",'"')
         attr['week_end'] = str(self._week_end).replace("'",'"')
+        attr['rtt_statistics'] = self._broadlink_hysen_climate_device.rtt.as_dict()
         return attr
 
 ######################################################################################################################################
 ######################################################################################################################################
-    def turn_on(self):
-        self.send_power_command(HYSEN_POWERON,self._remote_lock)
-        self._away_mode = False
+    async def async_turn_on(self):
+        async with self._async_command_batch():
+            await self.async_send_power_command(HYSEN_POWERON,self._remote_lock)
+            self._away_mode = False
         return True
 
-    def turn_off(self):
-        self.send_power_command(HYSEN_POWEROFF,self._remote_lock)
-        self._away_mode = False
+    async def async_turn_off(self):
+        async with self._async_command_batch():
+            await self.async_send_power_command(HYSEN_POWEROFF,self._remote_lock)
+            self._away_mode = False
         return True
 
-    def set_temperature(self, **kwargs):
+    async def async_set_temperature(self, **kwargs):
         """Set new target temperatures."""
         if kwargs.get(ATTR_TEMPERATURE) is not None:
             self._target_temperature = kwargs.get(ATTR_TEMPERATURE)
+            # A new setpoint from the user replaces any pending hysteresis restore.
+            await self._async_clear_hysteresis_restore()
             if (self._power_state == HYSEN_POWERON):
-                self.send_tempset_command(self._target_temperature)
+                await self.async_send_tempset_command(self._target_temperature)
 
-    def set_hvac_mode(self, operation_mode):
+    async def async_set_hvac_mode(self, hvac_mode):
         """Set new opmode """
-        self._current_operation = operation_mode
-        if self._away_mode == True:
-            self.set_preset_mode(PRESET_NONE)
-        self.set_operation_mode_command(operation_mode)
+        self._current_operation = hvac_mode
+        async with self._async_command_batch():
+            if self._away_mode == True:
+                await self.async_set_preset_mode(PRESET_NONE)
+            await self.async_set_operation_mode_command(hvac_mode)
 
-    def set_preset_mode(self, preset_mode):
+    async def async_set_preset_mode(self, preset_mode):
         if preset_mode == PRESET_AWAY:
             if self._away_mode == False:
                 self._awaymodeLastState = self._current_operation
                 self._away_mode = True
-                self.set_operation_mode_command(HVACMode.OFF)
+                await self.async_set_operation_mode_command(HVACMode.OFF)
         elif preset_mode == PRESET_NONE:
             if self._away_mode == True:
                 self._away_mode = False
-                self.set_operation_mode_command(self._awaymodeLastState)
+                await self.async_set_operation_mode_command(self._awaymodeLastState)
 
 ######################################################################################################################################
-    def set_operation_mode_command(self, operation_mode):
-        if operation_mode == HVACMode.HEAT:
-            if self._power_state == HYSEN_POWEROFF:
-                self.send_power_command(HYSEN_POWERON,self._remote_lock)
-            self.send_mode_command(HYSEN_MANUALMODE, self._loop_mode,self._sensor_mode)
-        elif operation_mode == HVACMode.AUTO:
-            if self._power_state == HYSEN_POWEROFF:
-                self.send_power_command(HYSEN_POWERON,self._remote_lock)
-            self.send_mode_command(HYSEN_AUTOMODE, self._loop_mode,self._sensor_mode)
-        elif operation_mode == HVACMode.OFF:
-                  self.send_power_command(HYSEN_POWEROFF,self._remote_lock)
+    # All register writes of one user action go out together when the outermost
+    # batch ends. The written values are shown at once and left pending until a
+    # poll started after the write confirms them, or rolls them back.
+    @contextlib.asynccontextmanager
+    async def _async_command_batch(self):
+        if self._command_batch is not None:
+            yield self._command_batch
+            return
+        batch = self._command_batch = broadlink_hysen_command_batch()
+        try:
+            yield batch
+        finally:
+            self._command_batch = None
+        if not batch:
+            return
+        expected = batch.expected()
+        self._pending_commands.update(expected)
+        self._pending_commands_sent = None
+        # The next poll has to copy every field to reconcile them
+        self._HysenData = None
+        self._apply_pending_commands()
+        self.async_write_ha_state()
+        try:
+            await self._broadlink_hysen_climate_device.async_send_command_batch(batch)
+        except Exception as error:
+            _LOGGER.error("Failed to send %s to Broadlink Hysen Climate device:%s, :%s",batch,self.entity_id,error)
+            batch.error = error
+            for field in expected:
+                self._pending_commands.pop(field, None)
+            actual = None
+            if self._device_status is not None:
+                actual = {field: getattr(self._device_status, field) for field in expected}
+                self._apply_command_fields(actual)
+                self._apply_command_fields(self._pending_commands)
+            self._fire_command_rollback('write_failed', expected, actual)
+            await self.async_force_update()
+            return
+        self._pending_commands_sent = time.monotonic()
+
+    def _apply_pending_commands(self):
+        self._apply_command_fields(self._pending_commands)
+
+    def _apply_command_fields(self, fields):
+        for field, value in fields.items():
+            attribute = HYSEN_PENDING_ATTRIBUTES.get(field)
+            if attribute is not None:
+                setattr(self, attribute, value)
+        schedule_times = fields.get('schedule_times')
+        if schedule_times is not None:
+            schedule_temps = fields['schedule_temps']
+            self._week_day = hysen_schedule(schedule_times, schedule_temps, 0, 6)
+            self._week_end = hysen_schedule(schedule_times, schedule_temps, 6, 8)
+        if self._power_state == HYSEN_POWERON:
+            self._current_operation = HVACMode.HEAT if self._auto_state == HYSEN_MANUALMODE else HVACMode.AUTO
         else:
-            _LOGGER.error("Unknown command for Broadlink Hysen Climate device: %s",self.entity_id)
-        self.force_update()
+            self._current_operation = HVACMode.OFF
 
-    def send_tempset_command(self, target_temperature):
-        try:        
-            self._broadlink_hysen_climate_device.set_temp(target_temperature)
-        except Exception as error:
-            _LOGGER.error("Failed to send SetTemp command to Broadlink Hysen Climate device:%s, :%s",self.entity_id,error)
-            self._available = False
-        self.force_update()
+    def _reconcile_pending_commands(self, HysenData, poll_started):
+        """Confirm or roll back pending command values against a status read."""
+        if self._pending_commands_sent is None or poll_started < self._pending_commands_sent:
+            # The read may have been answered before the write landed, keep showing the written values.
+            self._apply_pending_commands()
+            return False
+        rolled_back = {field: value for field, value in self._pending_commands.items()
+                       if getattr(HysenData, field) != value}
+        if rolled_back:
+            _LOGGER.warning("Broadlink Hysen Climate device:%s did not take %s, showing the device values",self.entity_id,rolled_back)
+            self._fire_command_rollback('device_disagrees', rolled_back,
+                                        {field: getattr(HysenData, field) for field in rolled_back})
+        self._pending_commands = {}
+        self._pending_commands_sent = None
+        return True
 
-    def send_power_command(self, target_state,remote_lock):
-        try:        
-             self._broadlink_hysen_climate_device.set_power(target_state,remote_lock)
-        except Exception as error:
-            _LOGGER.error("Failed to send Power command to Broadlink Hysen Climate device:%s, :%s",self.entity_id,error)
-            self._available = False
-        self.force_update()
+    def _fire_command_rollback(self, reason, expected, actual):
+        def event_value(value):
+            return list(value) if isinstance(value, bytes) else value
+        self._hass.bus.async_fire(EVENT_HYSEN_COMMAND_ROLLBACK, {
+            'entity_id': self.entity_id,
+            'reason': reason,
+            'expected': {field: event_value(value) for field, value in expected.items()},
+            'actual': None if actual is None else {field: event_value(value) for field, value in actual.items()},
+        })
 
-    def send_mode_command(self, target_state, loopmode, sensor):
-        try:        
-            self._broadlink_hysen_climate_device.set_mode(target_state, loopmode, sensor)
-        except Exception as error:
-            _LOGGER.error("Failed to send OpMode-Heat/Manual command to Broadlink Hysen Climate device:%s, :%s",self.entity_id,error)
-            self._available = False
-        self.force_update()
+    async def async_set_operation_mode_command(self, operation_mode):
+        async with self._async_command_batch():
+            if operation_mode == HVACMode.HEAT:
+                if self._power_state == HYSEN_POWEROFF:
+                    await self.async_send_power_command(HYSEN_POWERON,self._remote_lock)
+                await self.async_send_mode_command(HYSEN_MANUALMODE, self._loop_mode,self._sensor_mode)
+            elif operation_mode == HVACMode.AUTO:
+                if self._power_state == HYSEN_POWEROFF:
+                    await self.async_send_power_command(HYSEN_POWERON,self._remote_lock)
+                await self.async_send_mode_command(HYSEN_AUTOMODE, self._loop_mode,self._sensor_mode)
+            elif operation_mode == HVACMode.OFF:
+                      await self.async_send_power_command(HYSEN_POWEROFF,self._remote_lock)
+            else:
+                _LOGGER.error("Unknown command for Broadlink Hysen Climate device: %s",self.entity_id)
+
+    async def async_send_tempset_command(self, target_temperature):
+        async with self._async_command_batch() as batch:
+            batch.set_temp(target_temperature)
+
+    async def async_send_power_command(self, target_state,remote_lock):
+        async with self._async_command_batch() as batch:
+            batch.set_power(target_state,remote_lock)
 
-    def set_time(self, hour, minute, second, day):
+    async def async_send_mode_command(self, target_state, loopmode, sensor):
+        async with self._async_command_batch() as batch:
+            batch.set_mode(target_state, loopmode, sensor)
+
+    async def async_set_time(self, hour, minute, second, day):
         try:        
-           self._broadlink_hysen_climate_device.set_time(hour, minute, second, day)
+           await self._broadlink_hysen_climate_device.async_set_time(hour, minute, second, day)
         except Exception as error:
             _LOGGER.error("Failed to send Set Time command to Broadlink Hysen Climate device: %s, :%s",self.entity_id,error)
             self._available = False
-        self.force_update()
+        await self.async_force_update()
 
-    def set_advanced(self, loop_mode=None, sensor=None, osv=None, dif=None,
+    async def async_set_advanced(self, loop_mode=None, sensor=None, osv=None, dif=None,
                      svh=None, svl=None, adj=None, fre=None, poweronmem=None):
         loop_mode = self._loop_mode if loop_mode is None else loop_mode
         sensor = self._sensor_mode if sensor is None else sensor
@@ -839,75 +1831,226 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
         mode_byte = ( (loop_mode + 1) << 4) + current_mode
 
         try:        
-            self._broadlink_hysen_climate_device.set_advanced(mode_byte, sensor, osv, dif, svh, svl, adj, fre, poweronmem)
+            await self._broadlink_hysen_climate_device.async_set_advanced(mode_byte, sensor, osv, dif, svh, svl, adj, fre, poweronmem)
         except Exception as error:
             _LOGGER.error("Failed to send Set Advanced to Broadlink Hysen Climate device: %s, :%s",self.entity_id,error)
             self._available = False
-        self.force_update()
+        await self.async_force_update()
 
-    def set_schedule(self, weekday, weekend):
-        try:        
-            self._broadlink_hysen_climate_device.set_schedule(weekday, weekend)
+    async def async_set_schedule(self, weekday, weekend):
+        try:
+            schedule_payload = self._broadlink_hysen_climate_device.build_schedule_payload(weekday, weekend)
         except Exception as error:
            _LOGGER.error("Failed to send Set Schedule to Broadlink Hysen Climate device: %s, :%s",self.entity_id,error)
-           self._available = False
-        self.force_update()
+           return
+        async with self._async_command_batch() as batch:
+            batch.set_schedule(schedule_payload)
+
+    async def async_send_schedule_payload(self, schedule_payload):
+        """Write an encoded schedule, returns None or the error if the write failed."""
+        async with self._async_command_batch() as batch:
+            batch.set_schedule(schedule_payload)
+        return batch.error
+
+    def schedule_matches(self, schedule_payload):
+        """True if the last status read from the device already has this schedule."""
+        if self._device_status is None or self._pending_commands:
+            return False
+        return (self._device_status.schedule_times == bytes(schedule_payload[7:23]) and
+                self._device_status.schedule_temps == bytes(schedule_payload[23:31]))
 
-    def set_lock(self, remote_lock):
-        try:        
+    async def async_set_lock(self, remote_lock):
+        async with self._async_command_batch() as batch:
             if self._away_mode == False:
-                self._broadlink_hysen_climate_device.set_power(self._power_state, remote_lock)
+                batch.set_power(self._power_state, remote_lock)
             else:
-                self._broadlink_hysen_climate_device.set_power(0, remote_lock)
-        except Exception as error:
-            _LOGGER.error("Failed to send Set Lock to Broadlink Hysen Climate device: %s, :%s",self.entity_id,error)
-            self._available = False
-        self.force_update()
+                batch.set_power(0, remote_lock)
 
 ######################################################################################################################################
 ######################################################################################################################################
-    def force_update(self):
-        self.update(no_throttle=True)
-        self.schedule_update_ha_state(True)
+    async def async_force_update(self):
+        # Commands set some state locally, so copy everything from the next read.
+        self._HysenData = None
+        await self.async_update(no_throttle=True)
+        self.async_write_ha_state()
+
+    async def async_startup(self, session=None):
+        """First auth and status read, the fleet poller takes over afterwards."""
+        if session is not None:
+            # Try the session from the last run without an auth round trip,
+            # async_send_request authenticates again if the device rejects it.
+            self._broadlink_hysen_climate_device.set_session(*session)
+            self._available = True
+        await self.async_update(no_throttle=True)
+        if self._update_error_count:
+            # No answer with the cached session either
+            self._available = False
+        self._started = True
+        self.async_write_ha_state()
+
+    async def async_poll(self):
+        """Called by the fleet poller once per scan interval."""
+        if not self._started:
+            return
+        await self.async_update(no_throttle=True)
+        # Only write to the state machine when something shown in HA changed,
+        # a poll where just the thermostat clock moved is written now and again.
+        if (self._visible_state() != self._published_state or
+                time.monotonic() - self._published_clock_time >= MIN_TIME_BETWEEN_CLOCK_UPDATES.total_seconds()):
+            self.async_write_ha_state()
+
+    def _visible_state(self):
+        """Everything the entity shows in HA apart from the thermostat clock."""
+        return (self._available, self._current_operation, self._is_heating_active, self._room_temp,
+                self._external_temp, self._target_temperature, self._min_temp, self._max_temp,
+                self._away_mode, self._power_state, self._auto_state, self._auto_override, self._sensor_mode,
+                self._external_sensor_temprange, self._deadzone_sensor_temprange, self._loop_mode,
+                self._roomtemp_offset, self._anti_freeze_function, self._poweron_mem, self._remote_lock,
+                self._week_day, self._week_end)
+
+    @callback
+    def async_write_ha_state(self):
+        self._published_state = self._visible_state()
+        self._published_clock_time = time.monotonic()
+        super().async_write_ha_state()
+
+    async def async_added_to_hass(self):
+        self._hass.data[HYSEN_DOMAIN][DATA_POLLER].async_add_entity(self)
+        self._analytics = self._hass.data[HYSEN_DOMAIN][DATA_ANALYTICS]
+        self._broadlink_hysen_climate_device.session_changed = self._async_session_changed
+        # Put back a setpoint that was still nudged when HA stopped, once the device is set up.
+        restore_temp = self._hass.data[HYSEN_DOMAIN][DATA_HYSTERESIS_RESTORES].get(self.entity_id)
+        if restore_temp is not None:
+            self._hysteresis_restore_temp = restore_temp
+
+    @callback
+    def _async_session_changed(self, device_id, key):
+        self._hass.data[HYSEN_DOMAIN][DATA_SESSION_KEYS].async_set(self.mac_address, device_id, key)
+
+    async def async_will_remove_from_hass(self):
+        self._hass.data[HYSEN_DOMAIN][DATA_POLLER].async_remove_entity(self)
+        self._analytics.async_remove(self.entity_id)
+        if self._hysteresis_restore_cancel is not None:
+            self._hysteresis_restore_cancel()
+            self._hysteresis_restore_cancel = None
+
+######################################################################################################################################
+    async def _async_schedule_hysteresis_restore(self, target_temp):
+        self._hysteresis_restore_temp = target_temp
+        self._hysteresis_restore_retries = 0
+        await self._hass.data[HYSEN_DOMAIN][DATA_HYSTERESIS_RESTORES].async_set(self.entity_id, target_temp)
+        self._async_call_hysteresis_restore(HA_HYSTERSIS_RESTORE_DELAY)
+
+    @callback
+    def _async_call_hysteresis_restore(self, delay):
+        if self._hysteresis_restore_cancel is not None:
+            self._hysteresis_restore_cancel()
+        self._hysteresis_restore_cancel = async_call_later(self._hass, delay, self._async_hysteresis_restore)
+
+    # From the timer set when the setpoint was nudged, and from async_update for a restore
+    # that failed or was loaded at startup, once a poll reached the device again.
+    async def _async_hysteresis_restore(self, now=None):
+        target_temp = self._hysteresis_restore_temp
+        if target_temp is None:
+            self._hysteresis_restore_cancel = None
+            return
+        try:
+            await self._broadlink_hysen_climate_device.async_set_temp(target_temp)
+        except Exception as error:
+            # No timer of its own, the next successful poll tries again: a device that does not
+            # answer is only tried as often as the circuit breaker lets the poller reach it.
+            self._hysteresis_restore_retries = self._hysteresis_restore_retries + 1
+            if self._hysteresis_restore_retries == 1:
+                _LOGGER.error("HA force thermostate state change in heating failed to set back to value :%s, :%s, retrying on the next poll",target_temp,error)
+            return
+        finally:
+            # Cleared once the attempt is over, so a poll does not start a second one meanwhile
+            self._hysteresis_restore_cancel = None
+        if self._hysteresis_restore_temp == target_temp:
+            _LOGGER.warning("HA force thermostate state change in heating Set Temp to Orignal %s",target_temp)
+            await self._async_clear_hysteresis_restore()
+
+    async def _async_clear_hysteresis_restore(self):
+        if self._hysteresis_restore_cancel is not None:
+            self._hysteresis_restore_cancel()
+            self._hysteresis_restore_cancel = None
+        if self._hysteresis_restore_temp is not None:
+            self._hysteresis_restore_temp = None
+            self._hysteresis_restore_retries = 0
+            await self._hass.data[HYSEN_DOMAIN][DATA_HYSTERESIS_RESTORES].async_remove(self.entity_id)
+
+    def _record_poll_failure(self):
+        self.circuit_breaker.record_failure(self._hass.loop.time())
+        if self.circuit_breaker.state == BREAKER_OPEN:
+            # Look for the device again in case it came back at another address
+            self._hass.data[HYSEN_DOMAIN][DATA_DISCOVERY].async_device_lost(self.mac_address)
 
     @util.Throttle(MIN_TIME_BETWEEN_SCANS,MIN_TIME_BETWEEN_FORCED_SCANS)
-    def update(self):
+    async def async_update(self):
         """If the device has gone unavailable try to re-authticate""" 
+        metrics = self._broadlink_hysen_climate_device.metrics
         if (self._available == False):
             try:
-                if (self._broadlink_hysen_climate_device.auth() == False):
+                with metrics.phase('auth'):
+                    authenticated = await self._broadlink_hysen_climate_device.async_auth()
+                if (authenticated == False):
                     raise Exception('broadlink_response_error:','auth failed for device')
             except Exception as error:
                 _LOGGER.info("Failed to Re-Authenticate with Broadlink Hysen Climate device:%s , %s ",self.entity_id, error)
+                # No answer to the auth, a status read would only wait out another timeout.
+                # Counted as a failed poll, so the circuit breaker opens as for failed reads.
+                self._record_poll_failure()
+                return
         """Get the latest data from the thermostat."""        
         try:
-            self._HysenData = self._broadlink_hysen_climate_device.get_full_status()
+            poll_started = time.monotonic()
+            # Full status on the first poll, after a command or error, and every full_status_every polls.
+            with metrics.phase('request'):
+                if self._HysenData is None or self._live_status_polls + 1 >= self._full_status_every:
+                    HysenData = await self._broadlink_hysen_climate_device.async_get_full_status()
+                    self._live_status_polls = 0
+                else:
+                    HysenData = await self._broadlink_hysen_climate_device.async_get_live_status(self._HysenData)
+                    self._live_status_polls = self._live_status_polls + 1
             self._update_error_count = 0
-            if self._HysenData is not None:
-                self._room_temp = self._HysenData['room_temp']
-                self._target_temperature = self._HysenData['thermostat_temp']                
-                self._min_temp = self._HysenData['svl']
-                self._max_temp = self._HysenData['svh']
-                self._loop_mode = int(self._HysenData['loop_mode'])-1
-                self._power_state = self._HysenData['power']
-                self._auto_state = self._HysenData['auto_mode']
-                self._is_heating_active = self._HysenData['active']
-
-                self._remote_lock = self._HysenData['remote_lock']
-                self._auto_override = self._HysenData['temp_manual']
-                self._sensor_mode = self._HysenData['sensor']
-                self._external_sensor_temprange = self._HysenData['osv']
-                self._deadzone_sensor_temprange = self._HysenData['dif']
-                self._roomtemp_offset = self._HysenData['room_temp_adj']
-                self._anti_freeze_function = self._HysenData['fre']
-                self._poweron_mem = self._HysenData['poweron']
-                self._external_temp = self._HysenData['external_temp']
-                self._clock_hour = self._HysenData['hour']
-                self._clock_min = self._HysenData['min']
-                self._clock_sec = self._HysenData['sec']
-                self._day_of_week = self._HysenData['dayofweek']
-                self._week_day = self._HysenData['weekday']
-                self._week_end = self._HysenData['weekend']
+            self.circuit_breaker.record_success()
+            if HysenData is not None:
+                self._clock_hour = HysenData.hour
+                self._clock_min = HysenData.min
+                self._clock_sec = HysenData.sec
+                self._day_of_week = HysenData.dayofweek
+                # Only copy the rest out of the record when something other than the clock changed.
+                if not HysenData.same_settings(self._HysenData):
+                    self._room_temp = HysenData.room_temp
+                    self._target_temperature = HysenData.thermostat_temp
+                    self._min_temp = HysenData.svl
+                    self._max_temp = HysenData.svh
+                    self._loop_mode = int(HysenData.loop_mode)-1
+                    self._power_state = HysenData.power
+                    self._auto_state = HysenData.auto_mode
+                    self._is_heating_active = HysenData.active
+
+                    self._remote_lock = HysenData.remote_lock
+                    self._auto_override = HysenData.temp_manual
+                    self._sensor_mode = HysenData.sensor
+                    self._external_sensor_temprange = HysenData.osv
+                    self._deadzone_sensor_temprange = HysenData.dif
+                    self._roomtemp_offset = HysenData.room_temp_adj
+                    self._anti_freeze_function = HysenData.fre
+                    self._poweron_mem = HysenData.poweron
+                    self._external_temp = HysenData.external_temp
+                    self._week_day = HysenData.weekday
+                    self._week_end = HysenData.weekend
+                self._HysenData = HysenData
+                self._device_status = HysenData
+                self.history.add(self.history.now(), (HysenData.room_temp, HysenData.external_temp,
+                                               HysenData.thermostat_temp, HysenData.active))
+                if self._analytics is not None:
+                    self._analytics.async_record(self.entity_id, HysenData.room_temp, HysenData.external_temp,
+                                                 HysenData.thermostat_temp, HysenData.active, HysenData.power)
+                if self._pending_commands and not self._reconcile_pending_commands(HysenData, poll_started):
+                    # Still waiting for confirmation, copy every field again next poll
+                    self._HysenData = None
 
                 self._available = True
                 
@@ -919,7 +2062,10 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
                     
                     ##################################################################
                     #Add HA hysteresis control
-                    if self._use_HA_for_hysteresis:
+                    if self._hysteresis_restore_temp is not None:
+                        # The thermostat is still at the nudged setpoint, report the one it goes back to.
+                        self._target_temperature = self._hysteresis_restore_temp
+                    elif self._use_HA_for_hysteresis:
                         Control_active = False
                         newtarget_temp = 0 
                         original_set_target_temp = self._target_temperature
@@ -946,20 +2092,14 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
                                 self._use_HA_for_hysteresis_sample_count = self._use_HA_for_hysteresis_sample_count - 1
                         
                         if Control_active == True:
-                           self._broadlink_hysen_climate_device.set_temp(newtarget_temp) # Force thermostat change in heating state
+                          with metrics.phase('hysteresis'):
+                           # heating active is now assumed, take it from the next poll even if nothing else changed
+                           self._HysenData = None
+                           await self._broadlink_hysen_climate_device.async_set_temp(newtarget_temp) # Force thermostat change in heating state
                            self._use_HA_for_hysteresis_sample_count = 0
                            _LOGGER.warning("HA force thermostate state change in heating / Current_temp %s Current_target temp %s, HA changing Set Temp to %s",self._room_temp,original_set_target_temp,newtarget_temp)
-                           #Force heating back to orignal set temp.
-                           try:
-                                time.sleep(4)
-                                self._broadlink_hysen_climate_device.set_temp(original_set_target_temp)
-                                _LOGGER.warning("HA force thermostate state change in heating Set Temp to Orignal %s",original_set_target_temp)
-                           except Exception as error:
-                                try:                                
-                                    time.sleep(4)
-                                    self._broadlink_hysen_climate_device.set_temp(original_set_target_temp)
-                                except Exception as error:
-                                       _LOGGER.error("HA force thermostate state change in heating failed to set back to value after retry :%s, :%s",original_set_target_temp,error)
+                           #Force heating back to orignal set temp, from a timed callback so the poll returns now.
+                           await self._async_schedule_hysteresis_restore(original_set_target_temp)
                         #####################################################################
 
                 elif self._power_state == HYSEN_POWEROFF:
@@ -968,12 +2108,18 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
                 else:
                      self._current_operation = HVACMode.OFF
                      self._available = False
+
+                if self._hysteresis_restore_temp is not None and self._hysteresis_restore_cancel is None and self._available:
+                    with metrics.phase('hysteresis'):
+                        await self._async_hysteresis_restore()
             else:
                 _LOGGER.warning("Failed to get Update from Broadlink Hysen Climate device: %s, GetFullStatus returned None!",self.entity_id)
+                self._HysenData = None
                 self._current_operation = HVACMode.OFF
                 self._available = False
 
         except Exception as error:
+            self._record_poll_failure()
             self._update_error_count = self._update_error_count + 1
             if (self._update_error_count>=UPDATE_RETRY_BEFORE_ERROR):
                 _LOGGER.error("Failed to get Data from Broadlink Hysen Climate device more than %s times :%s,:%s",UPDATE_RETRY_BEFORE_ERROR,self.entity_id,error)
@@ -981,6 +2127,7 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
                 self._room_temp = 0
                 self._external_temp = 0
                 self._available = False
+                self._HysenData = None
                 self._update_error_count = 0
                 return
 
@@ -992,7 +2139,8 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
                 currentDT = datetime.datetime.now()
                 updateDT = datetime.time(hour=3)
                 if currentDT.time() > updateDT: #Set am 3am
-                    self._broadlink_hysen_climate_device.set_time(currentDT.hour, currentDT.minute, currentDT.second, now_day_of_the_week)
+                    with metrics.phase('clock_sync'):
+                        await self._broadlink_hysen_climate_device.async_set_time(currentDT.hour, currentDT.minute, currentDT.second, now_day_of_the_week)
                     self._current_day_of_week = now_day_of_the_week
                     _LOGGER.info("Broadlink Hysen Climate device:%s Clock Sync Success...",self.entity_id)
         except Exception as error:
@@ -1003,12 +2151,22 @@ class HASS_Hysen_Climate_Device(ClimateEntity):
 ######################################################################################################################################
 ######################################################################################################################################
 # Cut down sourced version just for Broadlink Hysen devices from https://github.com/mjg59/python-broadlink/tree/master/broadlink
+import bisect
 import codecs
+import array
+import collections
+import ipaddress
+import itertools
 import json
 import random
 import struct
 import threading
+import weakref
 from cryptography.hazmat.backends import default_backend
+try:
+    import ifaddr
+except ImportError:
+    ifaddr = None
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 FIRMWARE_ERRORS = {
     0xffff: ("Authentication failed"),
@@ -1023,6 +2181,481 @@ FIRMWARE_ERRORS = {
     0xfff6: ("Read error"),
     0xfff5: ("SSID could not be found in AP configuration"),
 }
+
+# The device no longer knows the session id/key, async_auth() has to run again
+BROADLINK_SESSION_ERRORS = (0xfff9, 0xfffe)
+
+class broadlink_hysen_response_error(ValueError):
+    """Firmware error code in a device response, see FIRMWARE_ERRORS."""
+    def __init__(self, error_code, msg):
+        super().__init__('broadlink_response_error:', msg)
+        self.error_code = error_code
+
+# CRC16 (Modbus, reflected polynomial 0xA001) lookup table, built once at import.
+def _build_crc16_table():
+    table = []
+    for i in range(0, 256):
+        crc = i
+        for j in range(0, 8):
+            if (crc & 0x0001):
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _build_crc16_table()
+
+# CRC16 of a bytes, bytearray or memoryview, without copying the input.
+def hysen_crc16(data):
+    table = CRC16_TABLE
+    crc = 0xffff
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+    return crc
+
+# Broadlink additive checksum, summed in C by sum() rather than byte by byte.
+def broadlink_checksum(data):
+    return (0xbeaf + sum(data)) & 0xffff
+
+# Packet header: magic at 0x00, devtype at 0x24 and MAC at 0x2a set once per device (id at
+# 0x30 after auth), checksum at 0x20, command at 0x26, count at 0x28 and payload checksum
+# at 0x34 per packet.
+BROADLINK_PACKET_MAGIC = bytes([0x5a, 0xa5, 0xaa, 0x55, 0x5a, 0xa5, 0xaa, 0x55])
+BROADLINK_PACKET_HEADER = struct.Struct('<8s28xH4x6s')
+BROADLINK_PACKET_FIELDS = struct.Struct('<BxH')
+BROADLINK_PACKET_CHECKSUM = struct.Struct('<H')
+
+BROADLINK_DEFAULT_KEY = bytes([0x09, 0x76, 0x28, 0x34, 0x3f, 0xe9, 0x9e, 0x23, 0x76, 0x5c, 0x15, 0x13, 0xac, 0xcf, 0x8b, 0x02])
+BROADLINK_IV = bytes([0x56, 0x2e, 0x17, 0x99, 0x6d, 0x09, 0x3d, 0x28, 0xdd, 0xb3, 0xba, 0x69, 0x5a, 0x2e, 0x6f, 0x58])
+
+# AES-128-CBC with a fixed IV, built once per key.
+# The AES contexts are opened in ECB mode and kept for the life of the session,
+# CBC chaining is done here on whole ints, so a packet costs no Cipher, context
+# or finalize allocation. Sessions are shared by every device with the same key,
+# only used from the event loop.
+class broadlink_aes_session():
+    def __init__(self, key, iv):
+        cipher = Cipher(algorithms.AES(bytes(key)), modes.ECB(), backend=default_backend())
+        self.encryptor = cipher.encryptor()
+        self.decryptor = cipher.decryptor()
+        self.iv = int.from_bytes(iv, 'big')
+
+    def encrypt(self, payload):
+        if len(payload) % 16:
+            raise ValueError('The length of the provided data is not a multiple of the block length.')
+        ciphertext = bytearray()
+        previous = self.iv
+        for i in range(0, len(payload), 16):
+            block = self.encryptor.update(
+                (int.from_bytes(payload[i:i + 16], 'big') ^ previous).to_bytes(16, 'big'))
+            ciphertext += block
+            previous = int.from_bytes(block, 'big')
+        return bytes(ciphertext)
+
+    def decrypt(self, payload):
+        length = len(payload)
+        if length % 16:
+            raise ValueError('The length of the provided data is not a multiple of the block length.')
+        if not length:
+            return b''
+        plaintext = self.decryptor.update(payload)
+        # Each plaintext block is XORed with the previous ciphertext block (the IV for the first).
+        chain = (self.iv << (8 * (length - 16))) | int.from_bytes(payload[:-16], 'big')
+        return (int.from_bytes(plaintext, 'big') ^ chain).to_bytes(length, 'big')
+
+
+_aes_sessions = weakref.WeakValueDictionary()
+
+def get_broadlink_aes_session(key, iv=BROADLINK_IV):
+    """Return the shared AES session for key, creating it on first use."""
+    session_key = bytes(key) + bytes(iv)
+    session = _aes_sessions.get(session_key)
+    if session is None:
+        session = broadlink_aes_session(key, iv)
+        _aes_sessions[session_key] = session
+    return session
+
+# Every device starts on the default key, keep its session alive between auths.
+BROADLINK_DEFAULT_SESSION = get_broadlink_aes_session(BROADLINK_DEFAULT_KEY)
+
+# Full status read (0x16 registers) after the 0x01, 0x03, byte count prefix:
+# lock, power/active/manual, room temp, setpoint, loop/auto mode, sensor, osv, dif, svh, svl,
+# signed room temp adjust, fre, poweron, unknown, external temp, hour, min, sec, day of week,
+# 8 schedule start times (hour, minute) and 8 schedule temps.
+HYSEN_STATUS_STRUCT = struct.Struct('>10Bh8B16s8s')
+# The first 8 registers, everything up to the external temp
+HYSEN_LIVE_STATUS_STRUCT = struct.Struct('>10Bh4B')
+HYSEN_STATUS_OFFSET = 3
+HYSEN_STATUS_CLOCK = slice(15, 19)
+
+# Schedule periods start..stop as the list of dicts used by get_full_status and set_schedule
+def hysen_schedule(schedule_times, schedule_temps, start, stop):
+    return [{'start_hour': schedule_times[2 * i], 'start_minute': schedule_times[2 * i + 1],
+             'temp': schedule_temps[i] / 2.0} for i in range(start, stop)]
+
+class hysen_status(collections.namedtuple('hysen_status', [
+        'lock_byte', 'power_byte', 'room_temp_raw', 'thermostat_temp_raw', 'mode_byte', 'sensor', 'osv', 'dif',
+        'svh', 'svl', 'room_temp_adj_raw', 'fre', 'poweron', 'unknown', 'external_temp_raw',
+        'hour', 'min', 'sec', 'dayofweek', 'schedule_times', 'schedule_temps'])):
+    """Raw register values of one full status read, unpacked in one go.
+
+    A plain tuple, so two polls compare with == without looking at each field.
+    Decoded values are properties named like the keys get_full_status used to return.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def decode(cls, payload):
+        return cls._make(HYSEN_STATUS_STRUCT.unpack_from(payload, HYSEN_STATUS_OFFSET))
+
+    def same_settings(self, other):
+        """Equal apart from the thermostat clock, which moves on every poll."""
+        return (other is not None and self[:HYSEN_STATUS_CLOCK.start] == other[:HYSEN_STATUS_CLOCK.start]
+                and self[HYSEN_STATUS_CLOCK.stop:] == other[HYSEN_STATUS_CLOCK.stop:])
+
+    @property
+    def remote_lock(self):
+        return self.lock_byte & 1
+
+    @property
+    def power(self):
+        return self.power_byte & 1
+
+    @property
+    def active(self):
+        return (self.power_byte >> 4) & 1
+
+    @property
+    def temp_manual(self):
+        return (self.power_byte >> 6) & 1
+
+    @property
+    def room_temp(self):
+        return self.room_temp_raw / 2.0
+
+    @property
+    def thermostat_temp(self):
+        return self.thermostat_temp_raw / 2.0
+
+    @property
+    def auto_mode(self):
+        return self.mode_byte & 15
+
+    @property
+    def loop_mode(self):
+        return (self.mode_byte >> 4) & 15
+
+    @property
+    def room_temp_adj(self):
+        return self.room_temp_adj_raw / 2.0
+
+    @property
+    def external_temp(self):
+        return self.external_temp_raw / 2.0
+
+    @property
+    def weekday(self):
+        return hysen_schedule(self.schedule_times, self.schedule_temps, 0, 6)
+
+    @property
+    def weekend(self):
+        return hysen_schedule(self.schedule_times, self.schedule_temps, 6, 8)
+
+    def as_dict(self):
+        """The dict get_full_status returned before the status record."""
+        return {key: getattr(self, key) for key in HYSEN_STATUS_DICT_KEYS}
+
+HYSEN_STATUS_DICT_KEYS = ('remote_lock', 'power', 'active', 'temp_manual', 'room_temp', 'thermostat_temp',
+                          'auto_mode', 'loop_mode', 'sensor', 'osv', 'dif', 'svh', 'svl', 'room_temp_adj',
+                          'fre', 'poweron', 'unknown', 'external_temp', 'hour', 'min', 'sec', 'dayofweek',
+                          'weekday', 'weekend')
+
+# Polled values kept in memory per thermostat, in fixed size rings of arrays. Each
+# poll goes into the raw tier, and into the running average of each coarser tier,
+# which keeps one averaged row per bucket of its resolution. heating is the share
+# of polls with the heating active, the duty cycle in the coarser tiers.
+HISTORY_FIELDS = ('room_temp', 'external_temp', 'target_temp', 'heating')
+# (resolution in seconds, rows), resolution 0 keeps every poll: 2 hours at a 30s
+# scan interval, 5 minute averages for a day, hourly averages for a week.
+HISTORY_TIERS = ((0, 240), (300, 288), (3600, 168))
+
+class hysen_history_ring():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.columns = tuple(array.array('f', bytes(4 * capacity)) for _ in HISTORY_FIELDS)
+        self.next = 0
+        self.size = 0
+
+    def append(self, timestamp, values):
+        index = self.next
+        self.times[index] = timestamp
+        for column, value in zip(self.columns, values):
+            column[index] = value
+        self.next = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def oldest(self):
+        return self.times[(self.next - self.size) % self.capacity] if self.size else None
+
+    def rows(self, start, stop):
+        """Times and columns of the rows with start <= time < stop, oldest first."""
+        def ordered(values):
+            if self.size < self.capacity:
+                return values[:self.size]
+            return values[self.next:] + values[:self.next]
+        times = ordered(self.times)
+        first = bisect.bisect_left(times, start)
+        last = bisect.bisect_left(times, stop)
+        return times[first:last], [ordered(column)[first:last] for column in self.columns]
+
+class hysen_history():
+    def __init__(self, tiers=HISTORY_TIERS):
+        self.tiers = [(resolution, hysen_history_ring(rows)) for resolution, rows in tiers]
+        # resolution: [bucket start, polls, sum of each field]
+        self._buckets = {}
+        # The rings are searched with bisect, so times must never go back: samples are
+        # stamped with the monotonic clock, set to the wall clock once. An NTP or manual
+        # clock step afterwards shifts the reported times, it can not reorder them.
+        self._clock_offset = time.time() - time.monotonic()
+
+    def now(self):
+        """The time to stamp a sample with, and to give series() since in."""
+        return time.monotonic() + self._clock_offset
+
+    def add(self, timestamp, values):
+        for resolution, ring in self.tiers:
+            if not resolution:
+                ring.append(timestamp, values)
+                continue
+            bucket_start = timestamp - timestamp % resolution
+            bucket = self._buckets.get(resolution)
+            if bucket is not None and bucket[0] != bucket_start:
+                ring.append(bucket[0], [total / bucket[1] for total in bucket[2:]])
+                bucket = None
+            if bucket is None:
+                bucket = self._buckets[resolution] = [bucket_start, 0] + [0.0] * len(values)
+            bucket[1] += 1
+            for index, value in enumerate(values):
+                bucket[2 + index] += value
+
+    def series(self, since=0):
+        """Rows polled since, oldest first, each tier filling in before the next finer one starts."""
+        chunks = []
+        stop = float('inf')
+        for resolution, ring in self.tiers:
+            chunks.append(ring.rows(since, stop))
+            oldest = ring.oldest()
+            if oldest is not None:
+                stop = min(stop, oldest)
+        series = {'time': [round(timestamp, 1) for times, _ in reversed(chunks) for timestamp in times]}
+        for index, field in enumerate(HISTORY_FIELDS):
+            # heating is 0 or 1 in the raw tier, a fraction in the averaged ones
+            digits = 3 if field == 'heating' else 2
+            series[field] = [round(value, digits) for _, columns in reversed(chunks) for value in columns[index]]
+        return series
+
+# Register writes collected from one user action. A register written twice
+# is only sent once with its last value, registers are written in order.
+def build_hysen_schedule_payload(weekday, weekend):
+    """Modbus write of the schedule registers 0x0a-0x15, see set_schedule."""
+    # Begin with some magic values ...
+    input_payload = bytearray([0x01, 0x10, 0x00, 0x0a, 0x00, 0x0c, 0x18])
+
+    # Now simply append times/temps
+    # weekday times
+    for i in range(0, 6):
+        input_payload.append(weekday[i]['start_hour'])
+        input_payload.append(weekday[i]['start_minute'])
+
+    # weekend times
+    for i in range(0, 2):
+        input_payload.append(weekend[i]['start_hour'])
+        input_payload.append(weekend[i]['start_minute'])
+
+    # weekday temperatures
+    for i in range(0, 6):
+        input_payload.append(int(weekday[i]['temp'] * 2))
+
+    # weekend temperatures
+    for i in range(0, 2):
+        input_payload.append(int(weekend[i]['temp'] * 2))
+
+    return input_payload
+
+class broadlink_hysen_command_batch():
+    def __init__(self):
+        self.writes = {}
+        # Set by the sender if the writes did not go through
+        self.error = None
+
+    def __bool__(self):
+        return bool(self.writes)
+
+    def __str__(self):
+        return ', '.join(write[0] for write in self.writes.values()) + ' command'
+
+    # Each write also records the hysen_status fields it should leave on the device
+    def set_power(self, power=1, remote_lock=0):
+        self.writes[0x00] = ('Power', bytearray([0x01, 0x06, 0x00, 0x00, remote_lock, power]),
+                             {'remote_lock': remote_lock & 1, 'power': power & 1})
+
+    def set_temp(self, temp):
+        self.writes[0x01] = ('SetTemp', bytearray([0x01, 0x06, 0x00, 0x01, 0x00, int(temp * 2)]),
+                             {'thermostat_temp': int(temp * 2) / 2.0})
+
+    def set_mode(self, auto_mode, loop_mode, sensor=0):
+        mode_byte = ((loop_mode + 1) << 4) + auto_mode
+        self.writes[0x02] = ('OpMode-Heat/Manual', bytearray([0x01, 0x06, 0x00, 0x02, mode_byte, sensor]),
+                             {'auto_mode': auto_mode & 15})
+
+    def set_schedule(self, schedule_payload):
+        self.writes[0x0a] = ('Set Schedule', schedule_payload,
+                             {'schedule_times': bytes(schedule_payload[7:23]),
+                              'schedule_temps': bytes(schedule_payload[23:31])})
+
+    def requests(self):
+        return [self.writes[register][1] for register in sorted(self.writes)]
+
+    def expected(self):
+        expected = {}
+        for register in sorted(self.writes):
+            expected.update(self.writes[register][2])
+        return expected
+
+# Retransmission timeout from the measured round trip time, as TCP does (RFC 6298):
+# smoothed RTT and RTT variance, only sampled from requests answered without a
+# retransmit (Karn's algorithm), and doubled after each timeout until a new sample.
+BROADLINK_RTO_INITIAL = 1.0
+BROADLINK_RTO_MIN = 0.2
+BROADLINK_RTO_MAX = 4.0
+BROADLINK_RTT_ALPHA = 1 / 8
+BROADLINK_RTT_BETA = 1 / 4
+# Transmits of a request on a device with update_timeout 0, bounded by the RTO alone
+BROADLINK_MAX_TRANSMITS = 4
+
+class broadlink_hysen_rtt_estimator():
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = BROADLINK_RTO_INITIAL
+        self.backoff = 0
+        self.samples = 0
+        self.last_rtt = None
+        self.min_rtt = None
+        self.max_rtt = None
+        self.retransmits = 0
+        self.timeouts = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += BROADLINK_RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += BROADLINK_RTT_ALPHA * (rtt - self.srtt)
+        self.rto = min(max(self.srtt + 4 * self.rttvar, BROADLINK_RTO_MIN), BROADLINK_RTO_MAX)
+        self.backoff = 0
+        self.samples += 1
+        self.last_rtt = rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+
+    # Wait before the next transmit, backed off by earlier losses
+    def retransmit_timeout(self):
+        return min(self.rto * (1 << self.backoff), BROADLINK_RTO_MAX)
+
+    def lost(self):
+        self.retransmits += 1
+        self.backoff = min(self.backoff + 1, 8)
+
+    # Gave up on a request, the next one starts with the backed off timeout
+    def timed_out(self):
+        self.timeouts += 1
+        self.backoff = min(self.backoff + 1, 8)
+
+    def as_dict(self):
+        def ms(value):
+            return None if value is None else round(value * 1000, 1)
+        return {
+            'srtt_ms': ms(self.srtt),
+            'rttvar_ms': ms(self.rttvar),
+            'rto_ms': ms(self.retransmit_timeout()),
+            'last_rtt_ms': ms(self.last_rtt),
+            'min_rtt_ms': ms(self.min_rtt),
+            'max_rtt_ms': ms(self.max_rtt),
+            'samples': self.samples,
+            'retransmits': self.retransmits,
+            'timeouts': self.timeouts,
+        }
+
+# Request latency histogram, upper bounds in seconds, the last bucket is everything slower
+BROADLINK_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BROADLINK_LATENCY_LABELS = tuple('<=%gms' % (bound * 1000) for bound in BROADLINK_LATENCY_BUCKETS) + \
+                           ('>%gms' % (BROADLINK_LATENCY_BUCKETS[-1] * 1000),)
+
+# Per device transport counters, next to the retransmits and timeouts of the rtt estimator:
+# request latency from the first transmit to the response (retransmitted requests included),
+# CRC failures, firmware errors by FIRMWARE_ERRORS message, auths, and the time spent in
+# each update phase. A phase only counts its own time, not the phases run inside it.
+class broadlink_hysen_transport_metrics():
+    def __init__(self):
+        self.requests = 0
+        self.latency_buckets = [0] * len(BROADLINK_LATENCY_LABELS)
+        self.crc_errors = 0
+        self.firmware_errors = collections.Counter()
+        self.auths = 0
+        # name: [count, total seconds, max seconds]
+        self.phases = {}
+        self._phase_time = 0.0
+
+    def request(self, latency):
+        self.requests += 1
+        self.latency_buckets[bisect.bisect_left(BROADLINK_LATENCY_BUCKETS, latency)] += 1
+
+    def firmware_error(self, error_code):
+        self.firmware_errors[FIRMWARE_ERRORS.get(error_code, hex(error_code))] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        counted = self._phase_time
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start - (self._phase_time - counted)
+            self._phase_time += elapsed
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = [0, 0.0, 0.0]
+            phase[0] += 1
+            phase[1] += elapsed
+            phase[2] = max(phase[2], elapsed)
+
+    # Upper bound of the histogram bucket holding the given fraction of requests
+    def latency_percentile(self, fraction):
+        if not self.requests:
+            return None
+        total = 0
+        for index, count in enumerate(self.latency_buckets):
+            total += count
+            if total >= self.requests * fraction:
+                return BROADLINK_LATENCY_LABELS[index]
+        return BROADLINK_LATENCY_LABELS[-1]
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'latency_histogram': dict(zip(BROADLINK_LATENCY_LABELS, self.latency_buckets)),
+            'latency_p95': self.latency_percentile(0.95),
+            'crc_errors': self.crc_errors,
+            'firmware_errors': dict(self.firmware_errors),
+            'auths': self.auths,
+            'phases': {name: {'count': count, 'mean_ms': round(total / count * 1000, 2), 'max_ms': round(longest * 1000, 2)}
+                       for name, (count, total, longest) in self.phases.items()},
+        }
+
 class broadlink_hysen_climate_device():
     def __init__(self, host, mac, timeout=10, name=None):
         self.type = "Hysen heating controller"
@@ -1033,14 +2666,20 @@ class broadlink_hysen_climate_device():
         
         self.timeout = timeout
         self.count = random.randrange(0xffff)
-        self.iv = bytearray([0x56, 0x2e, 0x17, 0x99, 0x6d, 0x09, 0x3d, 0x28, 0xdd, 0xb3, 0xba, 0x69, 0x5a, 0x2e, 0x6f, 0x58])
+        self.iv = bytearray(BROADLINK_IV)
+        # Packet buffer, the header fields that only change with auth filled in once
+        self._packet = bytearray(0x38 + 0x60)
+        BROADLINK_PACKET_HEADER.pack_into(self._packet, 0, BROADLINK_PACKET_MAGIC, self.devtype, bytes(self.mac))
         self.id = bytearray([0, 0, 0, 0])
         
-        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+        self.rtt = broadlink_hysen_rtt_estimator()
+        self.metrics = broadlink_hysen_transport_metrics()
 
         self.aes = None
-        key = bytearray([0x09, 0x76, 0x28, 0x34, 0x3f, 0xe9, 0x9e, 0x23, 0x76, 0x5c, 0x15, 0x13, 0xac, 0xcf, 0x8b, 0x02])
-        self.update_aes(key)
+        self.update_aes(BROADLINK_DEFAULT_KEY)
+        # Called with (id, key) after each successful async_auth
+        self.session_changed = None
 
     # Send a request
     # input_payload should be a bytearray, usually 6 bytes, e.g. bytearray([0x01,0x06,0x00,0x02,0x10,0x00])
@@ -1057,45 +2696,36 @@ class broadlink_hysen_climate_device():
         except KeyError:
             msg = "Unknown error: " + hex(error_code)
         if error_code:
-                raise ValueError('broadlink_response_error:', msg)
+                self.metrics.firmware_error(error_code)
+                raise broadlink_hysen_response_error(error_code, msg)
 
 
     def calculate_crc16(self, input_data):
-        from ctypes import c_ushort
-        crc16_tab = []
-        crc16_constant = 0xA001
-
-        for i in range(0, 256):
-            crc = c_ushort(i).value
-            for j in range(0, 8):
-                if (crc & 0x0001):
-                    crc = c_ushort(crc >> 1).value ^ crc16_constant
-                else:
-                    crc = c_ushort(crc >> 1).value
-            crc16_tab.append(hex(crc))
+        if isinstance(input_data, str):
+            input_data = input_data.encode('latin-1')
+        return hysen_crc16(input_data)
 
+    async def async_send_request(self, input_payload):
+        request_payload = self.build_request_payload(input_payload)
+        response = await self.async_send_packet(0x6a, request_payload)
         try:
-            is_string = isinstance(input_data, str)
-            is_bytes = isinstance(input_data, bytes)
-
-            if not is_string and not is_bytes:
-                raise Exception("Please provide a string or a byte sequence "
-                                "as argument for calculation.")
-
-            crcValue = 0xffff
-
-            for c in input_data:
-                d = ord(c) if is_string else c
-                tmp = crcValue ^ d
-                rotated = c_ushort(crcValue >> 8).value
-                crcValue = rotated ^ int(crc16_tab[(tmp & 0x00ff)], 0)
-
-            return crcValue
-        except Exception as e:
-            print("EXCEPTION(calculate): {}".format(e))
-
-    def send_request(self, input_payload):
-        crc = self.calculate_crc16(bytes(input_payload))
+            with self.metrics.phase('decode'):
+                return self.parse_request_response(response)
+        except broadlink_hysen_response_error as error:
+            if error.error_code not in BROADLINK_SESSION_ERRORS:
+                raise
+            _LOGGER.debug("Broadlink Hysen device %s rejected the session (%s), authenticating again", self.host, error.args[1])
+        # Session expired, or a stored session from before a device restart
+        with self.metrics.phase('auth'):
+            authenticated = await self.async_auth()
+        if not authenticated:
+            raise Exception('broadlink_response_error: ','auth failed for device')
+        response = await self.async_send_packet(0x6a, request_payload)
+        with self.metrics.phase('decode'):
+            return self.parse_request_response(response)
+
+    def build_request_payload(self, input_payload):
+        crc = hysen_crc16(input_payload)
 
         # first byte is length, +2 for CRC16
         request_payload = bytearray([len(input_payload) + 2, 0x00])
@@ -1104,75 +2734,57 @@ class broadlink_hysen_climate_device():
         # append CRC
         request_payload.append(crc & 0xFF)
         request_payload.append((crc >> 8) & 0xFF)
+        return request_payload
 
-        # send to device
-        response = self.send_packet(0x6a, request_payload)
-        self.check_error(response[0x22:0x24])
+    def parse_request_response(self, response):
         # check for error
-        response_payload = bytearray(self.decrypt(bytes(response[0x38:])))
+        self.check_error(response[0x22:0x24])
+        response_payload = self.decrypt(response[0x38:])
 
         # experimental check on CRC in response (first 2 bytes are len, and trailing bytes are crc)
         response_payload_len = response_payload[0]
         if response_payload_len + 2 > len(response_payload):
+            # Usually a payload decrypted with the wrong key, counted as a CRC failure
+            self.metrics.crc_errors += 1
             raise ValueError('hysen_response_error', 'first byte of response is not length')
-        crc = self.calculate_crc16(bytes(response_payload[2:response_payload_len]))
+        crc = hysen_crc16(memoryview(response_payload)[2:response_payload_len])
         if (response_payload[response_payload_len] == crc & 0xFF) and (
                 response_payload[response_payload_len + 1] == (crc >> 8) & 0xFF):
             return response_payload[2:response_payload_len]
+        self.metrics.crc_errors += 1
         raise ValueError('hysen_response_error', 'CRC check on response failed')
 
     # Get current room temperature in degrees celsius
-    def get_temp(self):
-        payload = self.send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x08]))
+    async def async_get_temp(self):
+        payload = await self.async_send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x08]))
         return payload[0x05] / 2.0
 
     # Get current external temperature in degrees celsius
-    def get_external_temp(self):
-        payload = self.send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x08]))
+    async def async_get_external_temp(self):
+        payload = await self.async_send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x08]))
         return payload[18] / 2.0
 
-    # Get full status (including timer schedule)
-    def get_full_status(self):
-        payload = self.send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x16]))
-        data = {}
-        data['remote_lock'] = payload[3] & 1
-        data['power'] = payload[4] & 1
-        data['active'] = (payload[4] >> 4) & 1
-        data['temp_manual'] = (payload[4] >> 6) & 1
-        data['room_temp'] = (payload[5] & 255) / 2.0
-        data['thermostat_temp'] = (payload[6] & 255) / 2.0
-        data['auto_mode'] = payload[7] & 15
-        data['loop_mode'] = (payload[7] >> 4) & 15
-        data['sensor'] = payload[8]
-        data['osv'] = payload[9]
-        data['dif'] = payload[10]
-        data['svh'] = payload[11]
-        data['svl'] = payload[12]
-        data['room_temp_adj'] = ((payload[13] << 8) + payload[14]) / 2.0
-        if data['room_temp_adj'] > 32767:
-            data['room_temp_adj'] = 32767 - data['room_temp_adj']
-        data['fre'] = payload[15]
-        data['poweron'] = payload[16]
-        data['unknown'] = payload[17]
-        data['external_temp'] = (payload[18] & 255) / 2.0
-        data['hour'] = payload[19]
-        data['min'] = payload[20]
-        data['sec'] = payload[21]
-        data['dayofweek'] = payload[22]
-
-        weekday = []
-        for i in range(0, 6):
-            weekday.append(
-                {'start_hour': payload[2 * i + 23], 'start_minute': payload[2 * i + 24], 'temp': payload[i + 39] / 2.0})
-
-        data['weekday'] = weekday
-        weekend = []
-        for i in range(6, 8):
-            weekend.append(
-                {'start_hour': payload[2 * i + 23], 'start_minute': payload[2 * i + 24], 'temp': payload[i + 39] / 2.0})
-
-        data['weekend'] = weekend
-        return data
+    # Get the live registers (power, active, temps, setpoint, mode and advanced settings) only,
+    # the clock and schedule are carried over from status, the last full status record.
+    async def async_get_live_status(self, status):
+        payload = await self.async_send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x08]))
+        return self.decode_live_status(payload, status)
+
+    def decode_live_status(self, payload, status):
+        if len(payload) < HYSEN_STATUS_OFFSET + HYSEN_LIVE_STATUS_STRUCT.size:
+            raise ValueError('hysen_response_error', 'live status response is too short')
+        return hysen_status._make(HYSEN_LIVE_STATUS_STRUCT.unpack_from(payload, HYSEN_STATUS_OFFSET)
+                                  + status[HYSEN_STATUS_CLOCK.start:])
+
+    # Get full status (including timer schedule) as a hysen_status record, as_dict() gives the old dict
+    async def async_get_full_status(self):
+        payload = await self.async_send_request(bytearray([0x01, 0x03, 0x00, 0x00, 0x00, 0x16]))
+        return self.decode_full_status(payload)
+
+    def decode_full_status(self, payload):
+        if len(payload) < HYSEN_STATUS_OFFSET + HYSEN_STATUS_STRUCT.size:
+            raise ValueError('hysen_response_error', 'full status response is too short')
+        return hysen_status.decode(payload)
 
     # Change controller mode
     # auto_mode = 1 for auto (scheduled/timed) mode, 0 for manual mode.
@@ -1182,9 +2794,9 @@ class broadlink_hysen_climate_device():
     # E.g. loop_mode = 0 ("12345,67") means Saturday and Sunday follow the "weekend" schedule
     # loop_mode = 2 ("1234567") means every day (including Saturday and Sunday) follows the "weekday" schedule
     # The sensor command is currently experimental
-    def set_mode(self, auto_mode, loop_mode, sensor=0):
+    async def async_set_mode(self, auto_mode, loop_mode, sensor=0):
         mode_byte = ((loop_mode + 1) << 4) + auto_mode
-        self.send_request(bytearray([0x01, 0x06, 0x00, 0x02, mode_byte, sensor]))
+        await self.async_send_request(bytearray([0x01, 0x06, 0x00, 0x02, mode_byte, sensor]))
 
     # Advanced settings
     # Sensor mode (SEN) sensor = 0 for internal sensor, 1 for external sensor,
@@ -1197,32 +2809,39 @@ class broadlink_hysen_climate_device():
     # Anti-freezing function (FrE) fre = 0 for anti-freezing function shut down,
     #  1 for anti-freezing function open. Factory default: 0
     # Power on memory (POn) poweron = 0 for power on memory off, 1 for power on memory on. Factory default: 0
-    def set_advanced(self, loop_mode, sensor, osv, dif, svh, svl, adj, fre, poweron):
-        input_payload = bytearray([0x01, 0x10, 0x00, 0x02, 0x00, 0x05, 0x0a, loop_mode, sensor, osv, dif, svh, svl,
-                                   (int(adj * 2) >> 8 & 0xff), (int(adj * 2) & 0xff), fre, poweron])
-        self.send_request(input_payload)
+    async def async_set_advanced(self, loop_mode, sensor, osv, dif, svh, svl, adj, fre, poweron):
+        await self.async_send_request(self.build_advanced_payload(loop_mode, sensor, osv, dif, svh, svl, adj, fre, poweron))
+
+    def build_advanced_payload(self, loop_mode, sensor, osv, dif, svh, svl, adj, fre, poweron):
+        return bytearray([0x01, 0x10, 0x00, 0x02, 0x00, 0x05, 0x0a, loop_mode, sensor, osv, dif, svh, svl,
+                          (int(adj * 2) >> 8 & 0xff), (int(adj * 2) & 0xff), fre, poweron])
 
-    # For backwards compatibility only.  Prefer calling set_mode directly.
+    # For backwards compatibility only.  Prefer calling async_set_mode directly.
     # Note this function invokes loop_mode=0 and sensor=0.
-    def switch_to_auto(self):
-        self.set_mode(auto_mode=1, loop_mode=0)
+    async def async_switch_to_auto(self):
+        await self.async_set_mode(auto_mode=1, loop_mode=0)
 
-    def switch_to_manual(self):
-        self.set_mode(auto_mode=0, loop_mode=0)
+    async def async_switch_to_manual(self):
+        await self.async_set_mode(auto_mode=0, loop_mode=0)
 
     # Set temperature for manual mode (also activates manual mode if currently in automatic)
-    def set_temp(self, temp):
-        self.send_request(bytearray([0x01, 0x06, 0x00, 0x01, 0x00, int(temp * 2)]))
+    async def async_set_temp(self, temp):
+        await self.async_send_request(bytearray([0x01, 0x06, 0x00, 0x01, 0x00, int(temp * 2)]))
 
     # Set device on(1) or off(0), does not deactivate Wifi connectivity.
     # Remote lock disables control by buttons on thermostat.
-    def set_power(self, power=1, remote_lock=0):
-        self.send_request(bytearray([0x01, 0x06, 0x00, 0x00, remote_lock, power]))
+    async def async_set_power(self, power=1, remote_lock=0):
+        await self.async_send_request(bytearray([0x01, 0x06, 0x00, 0x00, remote_lock, power]))
+
+    # Send the register writes collected in a broadlink_hysen_command_batch
+    async def async_send_command_batch(self, batch):
+        for request in batch.requests():
+            await self.async_send_request(request)
 
     # set time on device
     # n.b. day=1 is Monday, ..., day=7 is Sunday
-    def set_time(self, hour, minute, second, day):
-        self.send_request(bytearray([0x01, 0x10, 0x00, 0x08, 0x00, 0x02, 0x04, hour, minute, second, day]))
+    async def async_set_time(self, hour, minute, second, day):
+        await self.async_send_request(bytearray([0x01, 0x10, 0x00, 0x08, 0x00, 0x02, 0x04, hour, minute, second, day]))
 
     # Set timer schedule
     # Format is the same as you get from get_full_status.
@@ -1230,47 +2849,55 @@ class broadlink_hysen_climate_device():
     # {'start_hour':17, 'start_minute':30, 'temp': 22 }
     # Each one specifies the thermostat temp that will become effective at start_hour:start_minute
     # weekend is similar but only has 2 (e.g. switch on in morning and off in afternoon)
-    def set_schedule(self, weekday, weekend):
-        # Begin with some magic values ...
-        input_payload = bytearray([0x01, 0x10, 0x00, 0x0a, 0x00, 0x0c, 0x18])
-
-        # Now simply append times/temps
-        # weekday times
-        for i in range(0, 6):
-            input_payload.append(weekday[i]['start_hour'])
-            input_payload.append(weekday[i]['start_minute'])
+    async def async_set_schedule(self, weekday, weekend):
+        await self.async_send_request(self.build_schedule_payload(weekday, weekend))
 
-        # weekend times
-        for i in range(0, 2):
-            input_payload.append(weekend[i]['start_hour'])
-            input_payload.append(weekend[i]['start_minute'])
-
-        # weekday temperatures
-        for i in range(0, 6):
-            input_payload.append(int(weekday[i]['temp'] * 2))
-
-        # weekend temperatures
-        for i in range(0, 2):
-            input_payload.append(int(weekend[i]['temp'] * 2))
-
-        self.send_request(input_payload)
+    def build_schedule_payload(self, weekday, weekend):
+        return build_hysen_schedule_payload(weekday, weekend)
 
 ######################################################################################################
 ######################################################################################################
 #Common broadlink device functions
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, device_id):
+        self._id = bytearray(device_id)
+        self._packet[0x30:0x34] = self._id
+        # Packet checksum over the fixed header fields, build_packet adds the rest
+        self._header_checksum = (0xbeaf + sum(BROADLINK_PACKET_MAGIC) + (self.devtype & 0xff) + (self.devtype >> 8) +
+                                 sum(self.mac) + sum(self._id))
+
     def update_aes(self, key):
-        self.aes = Cipher(algorithms.AES(key), modes.CBC(self.iv),
-                          backend=default_backend())
+        self.key = bytes(key)
+        self.aes = get_broadlink_aes_session(key, self.iv)
+
+    # Use a session id and key from an earlier async_auth()
+    def set_session(self, device_id, key):
+        self.id = bytearray(device_id)
+        self.update_aes(key)
 
     def encrypt(self, payload):
-        encryptor = self.aes.encryptor()
-        return encryptor.update(payload) + encryptor.finalize()
+        return self.aes.encrypt(payload)
 
     def decrypt(self, payload):
-        decryptor = self.aes.decryptor()
-        return decryptor.update(payload) + decryptor.finalize()
+        return self.aes.decrypt(payload)
+
+    async def async_auth(self):
+        self.metrics.auths += 1
+        response = await self.async_send_packet(0x65, self.build_auth_payload())
+        if not self.parse_auth_response(response):
+            return False
+        if self.session_changed is not None:
+            self.session_changed(self.id, self.key)
+        return True
 
-    def auth(self):
+    def build_auth_payload(self):
+        # auth runs on the default key and id, also when a session is already set up
+        self.id = bytearray([0, 0, 0, 0])
+        self.update_aes(BROADLINK_DEFAULT_KEY)
         payload = bytearray(0x50)
         payload[0x04] = 0x31
         payload[0x05] = 0x31
@@ -1296,8 +2923,9 @@ class broadlink_hysen_climate_device():
         payload[0x34] = ord(' ')
         payload[0x35] = ord(' ')
         payload[0x36] = ord('1')
+        return payload
 
-        response = self.send_packet(0x65, payload)
+    def parse_auth_response(self, response):
         self.check_error(response[0x22:0x24])
         payload = self.decrypt(response[0x38:])
 
@@ -1309,113 +2937,389 @@ class broadlink_hysen_climate_device():
         self.update_aes(key)
         return True
 
-    def get_fwversion(self):
+    async def async_get_fwversion(self):
         packet = bytearray([0x68])
-        response = self.send_packet(0x6a, packet)
+        response = await self.async_send_packet(0x6a, packet)
         payload = self.decrypt(response[0x38:])
         self.check_error(response[0x22:0x24])
         return payload[0x4] | payload[0x5] << 8 
 
-    def set_name(self, name):
+    async def async_set_name(self, name):
         packet = bytearray(4)
         packet += name.encode('utf-8')
         packet += bytearray(0x50 - len(packet))
-        packet[0x43] = None
-        response = self.send_packet(0x6a, packet)
+        packet[0x43] = 0
+        response = await self.async_send_packet(0x6a, packet)
         self.check_error(response[0x22:0x24])
 
     def get_type(self):
         return self.type
 
-    def send_packet(self, command, payload):
+    async def async_send_packet(self, command, payload):
+        loop = asyncio.get_running_loop()
+        shared_socket = await async_get_hysen_shared_socket()
+        async with self.async_lock:
+            # Built under the lock: the packet buffer is reused and the count must match
+            # the response expected below, whatever else is queued for the device.
+            packet = self.build_packet(command, payload)
+            capture = _hysen_packet_capture
+            start_time = loop.time()
+            deadline = start_time + self.timeout if self.timeout else None
+            # Resend after the backed off retransmission timeout until a response arrives
+            # or the device timeout passes. Without a device timeout the request gets
+            # BROADLINK_MAX_TRANSMITS transmits, each waiting its retransmission timeout.
+            response = shared_socket.expect_response(self.host, self.count)
+            transmits = 0
+            try:
+                while True:
+                    sent_time = loop.time()
+                    shared_socket.sendto(packet, self.host)
+                    transmits += 1
+                    if capture is not None:
+                        capture.record(HYSEN_CAPTURE_REQUEST, self.host, self.mac, packet, payload)
+                    wait = self.rtt.retransmit_timeout()
+                    if deadline is None:
+                        last = transmits >= BROADLINK_MAX_TRANSMITS
+                    else:
+                        # Too little time left for another backed off wait, wait out the timeout
+                        last = deadline - sent_time < 2 * wait
+                        if last:
+                            wait = max(deadline - sent_time, 0)
+                    done, _ = await asyncio.wait((response,), timeout=wait)
+                    if done:
+                        if transmits == 1:
+                            self.rtt.sample(loop.time() - sent_time)
+                        self.metrics.request(loop.time() - start_time)
+                        if capture is not None:
+                            capture.record(HYSEN_CAPTURE_RESPONSE, self.host, self.mac, response.result(),
+                                           self.decrypt(response.result()[0x38:]))
+                        break
+                    if last:
+                        self.rtt.timed_out()
+                        raise Exception('broadlink_response_error: ',FIRMWARE_ERRORS[0xfffd])
+                    self.rtt.lost()
+            finally:
+                shared_socket.discard_response(self.host, self.count, response)
+        return response.result()
+
+    # Fill in the per request fields of the device packet buffer: count, command,
+    # checksums and the encrypted payload after the header template.
+    # Returns a memoryview of the buffer, valid until the next build_packet, so
+    # callers build and send under the device async_lock.
+    def build_packet(self, command, payload):
         self.count = (self.count + 1) & 0xffff
-        packet = bytearray(0x38)
-        packet[0x00] = 0x5a
-        packet[0x01] = 0xa5
-        packet[0x02] = 0xaa
-        packet[0x03] = 0x55
-        packet[0x04] = 0x5a
-        packet[0x05] = 0xa5
-        packet[0x06] = 0xaa
-        packet[0x07] = 0x55
-        packet[0x24] = self.devtype & 0xff # Hysen
-        packet[0x25] = self.devtype >> 8
-        packet[0x26] = command
-        packet[0x28] = self.count & 0xff
-        packet[0x29] = self.count >> 8
-        packet[0x2a] = self.mac[0]
-        packet[0x2b] = self.mac[1]
-        packet[0x2c] = self.mac[2]
-        packet[0x2d] = self.mac[3]
-        packet[0x2e] = self.mac[4]
-        packet[0x2f] = self.mac[5]
-        packet[0x30] = self.id[0]
-        packet[0x31] = self.id[1]
-        packet[0x32] = self.id[2]
-        packet[0x33] = self.id[3]
-
-        # pad the payload for AES encryption
-        if payload:
-            payload += bytearray((16 - len(payload)) % 16)
-
-        checksum = 0xbeaf
-        for b in payload:
-            checksum = (checksum + b) & 0xffff
-
-        packet[0x34] = checksum & 0xff
-        packet[0x35] = checksum >> 8
 
+        # pad the payload for AES encryption, zero padding leaves the checksum as is
+        checksum = broadlink_checksum(payload)
+        if len(payload) % 16:
+            payload = bytes(payload) + bytes(16 - len(payload) % 16)
         payload = self.encrypt(payload)
-        for i in range(len(payload)):
-            packet.append(payload[i])
-
-        checksum = 0xbeaf
-        for b in packet:
-            checksum = (checksum + b) & 0xffff
-
-        packet[0x20] = checksum & 0xff
-        packet[0x21] = checksum >> 8
-
-        start_time = time.time()
-        with self.lock:
-            cs = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            cs.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            cs.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            while True:
-                try:
-                    cs.sendto(packet, self.host)
-                    cs.settimeout(2)
-                    response = cs.recvfrom(2048)
-                    break
-                except socket.timeout:
-                    if (time.time() - start_time) > self.timeout:
-                        cs.close()
-                        raise Exception('broadlink_response_error: ',FIRMWARE_ERRORS[0xfffd])
-            cs.close()
-        return bytearray(response[0])
 
+        length = 0x38 + len(payload)
+        if len(self._packet) < length:
+            self._packet.extend(bytes(length - len(self._packet)))
+        packet = self._packet
+        packet[0x38:length] = payload
+        BROADLINK_PACKET_FIELDS.pack_into(packet, 0x26, command, self.count)
+        BROADLINK_PACKET_CHECKSUM.pack_into(packet, 0x34, checksum)
+        packet_checksum = (self._header_checksum + command + (self.count & 0xff) + (self.count >> 8) +
+                           (checksum & 0xff) + (checksum >> 8) + sum(payload))
+        BROADLINK_PACKET_CHECKSUM.pack_into(packet, 0x20, packet_checksum & 0xffff)
+        return memoryview(packet)[:length]
+
+
+# One long lived UDP socket shared by every Hysen device in the process, used by
+# broadlink_hysen_climate_device.async_send_packet.
+# Responses are routed back to the waiting request by (source address, source port, packet
+# count at 0x28). The port is part of the key, devices behind one address (NAT, the
+# simulator) have their own. The MAC at 0x2a-0x2f is not: the devices answer with their
+# own MAC byte order, which does not always match the MAC configured in HA. Each device
+# only has one request in flight (async_lock), so address, port and count are unique, and
+# late answers to requests that already timed out are dropped.
+class broadlink_hysen_shared_socket(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        pending, self.pending = self.pending, {}
+        for response in pending.values():
+            if not response.done():
+                response.set_exception(exc or ConnectionError('broadlink_response_error: shared socket closed'))
+
+    def is_closing(self):
+        return self.transport is None or self.transport.is_closing()
+
+    def sendto(self, packet, host):
+        self.transport.sendto(packet, host)
+
+    def expect_response(self, host, count):
+        response = asyncio.get_running_loop().create_future()
+        self.pending[(host[0], host[1], count)] = response
+        return response
+
+    def discard_response(self, host, count, response):
+        key = (host[0], host[1], count)
+        if self.pending.get(key) is response:
+            del self.pending[key]
+
+    def datagram_received(self, data, addr):
+        if len(data) < 0x38:
+            return
+        response = self.pending.pop((addr[0], addr[1], data[0x28] | data[0x29] << 8), None)
+        if response is not None and not response.done():
+            response.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP errors can not be matched to a request, the retry loop handles the loss.
+        _LOGGER.debug("Broadlink Hysen shared socket error:%s", exc)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+_hysen_shared_socket = None
+
+
+async def async_get_hysen_shared_socket():
+    """Return the process wide Hysen UDP socket, opening it on first use."""
+    global _hysen_shared_socket
+    loop = asyncio.get_running_loop()
+    if _hysen_shared_socket is None or _hysen_shared_socket[0] is not loop or _hysen_shared_socket_closed():
+        opening = loop.create_task(loop.create_datagram_endpoint(
+            broadlink_hysen_shared_socket, local_addr=('0.0.0.0', 0), allow_broadcast=True))
+        _hysen_shared_socket = (loop, opening)
+    opening = _hysen_shared_socket[1]
+    try:
+        _, shared_socket = await opening
+    except Exception:
+        if _hysen_shared_socket is not None and _hysen_shared_socket[1] is opening:
+            _hysen_shared_socket = None
+        raise
+    return shared_socket
+
+
+def _hysen_shared_socket_closed():
+    opening = _hysen_shared_socket[1]
+    if not opening.done():
+        return False
+    return opening.cancelled() or opening.exception() is not None or opening.result()[1].is_closing()
+
+
+def close_hysen_shared_socket():
+    global _hysen_shared_socket
+    if _hysen_shared_socket is not None and not _hysen_shared_socket_closed():
+        if _hysen_shared_socket[1].done():
+            _hysen_shared_socket[1].result()[1].close()
+        else:
+            _hysen_shared_socket[1].cancel()
+    _hysen_shared_socket = None
+
+
+def use_hysen_replay_socket(replay_socket):
+    """Answer async_send_packet of every device from replay_socket instead of the network."""
+    global _hysen_shared_socket
+    close_hysen_shared_socket()
+    opening = asyncio.get_running_loop().create_future()
+    opening.set_result((None, replay_socket))
+    _hysen_shared_socket = (opening.get_loop(), opening)
+
+
+# Packet capture file: HYSEN_CAPTURE_HEADER, then per datagram a HYSEN_CAPTURE_RECORD
+# (time.time(), kind, IPv4 address, port, MAC, datagram length, plaintext length)
+# followed by the datagram as sent or received and the decrypted payload. Discovery
+# datagrams are not encrypted and have no plaintext.
+HYSEN_CAPTURE_MAGIC = b'HYSENCAP'
+HYSEN_CAPTURE_VERSION = 1
+HYSEN_CAPTURE_HEADER = struct.Struct('<8sH')
+HYSEN_CAPTURE_RECORD = struct.Struct('<dB4sH6sHH')
+HYSEN_CAPTURE_REQUEST = 0
+HYSEN_CAPTURE_RESPONSE = 1
+HYSEN_CAPTURE_DISCOVERY_REQUEST = 2
+HYSEN_CAPTURE_DISCOVERY_RESPONSE = 3
+
+hysen_capture_record = collections.namedtuple('hysen_capture_record',
+                                              ['time', 'kind', 'host', 'mac', 'datagram', 'plaintext'])
+
+# Writes the datagrams of every device in the process while set as the capture, by
+# async_send_packet and both discover functions. Records go through the
+# file buffer, so capturing does not wait on the disk for every datagram.
+class broadlink_hysen_packet_capture():
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(HYSEN_CAPTURE_HEADER.pack(HYSEN_CAPTURE_MAGIC, HYSEN_CAPTURE_VERSION))
+
+    def record(self, kind, host, mac, datagram, plaintext=b''):
+        header = HYSEN_CAPTURE_RECORD.pack(time.time(), kind, socket.inet_aton(host[0]), host[1], bytes(mac),
+                                           len(datagram), len(plaintext))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(header)
+            self._file.write(datagram)
+            self._file.write(plaintext)
+            self.records += 1
 
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
 
-# Discover a new Hysen Broadlink device.
-def broadlink_hysen_climate_device_discover(timeout=None, local_ip_address=None, discover_ip_address='255.255.255.255'):
-    if local_ip_address is None:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.connect(('8.8.8.8', 53))  # connecting to a UDP address doesn't send packets
-            local_ip_address = s.getsockname()[0]
 
-    address = local_ip_address.split('.')
-    cs = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    cs.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    cs.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    cs.bind((local_ip_address, 0))
-    port = cs.getsockname()[1]
-    starttime = time.time()
-    hysen_devices = []
-    
+_hysen_packet_capture = None
+
+
+def start_hysen_packet_capture(path):
+    """Capture every datagram to path until stop_hysen_packet_capture."""
+    global _hysen_packet_capture
+    stop_hysen_packet_capture()
+    _hysen_packet_capture = broadlink_hysen_packet_capture(path)
+    return _hysen_packet_capture
+
+
+def stop_hysen_packet_capture():
+    """Stop capturing, returns the number of datagrams written."""
+    global _hysen_packet_capture
+    capture, _hysen_packet_capture = _hysen_packet_capture, None
+    if capture is None:
+        return 0
+    capture.close()
+    return capture.records
+
 
+def hysen_packet_capture_running():
+    return _hysen_packet_capture is not None
+
+
+def capture_discovery(kind, host, datagram):
+    capture = _hysen_packet_capture
+    if capture is None:
+        return
+    # The MAC of a discovery answer as parse_discovery_response reads it
+    mac = datagram[0x3f:0x39:-1] if kind == HYSEN_CAPTURE_DISCOVERY_RESPONSE and len(datagram) >= 0x40 else bytes(6)
+    capture.record(kind, host, mac, datagram)
+
+
+def read_hysen_capture(path):
+    """Yield the hysen_capture_record of each datagram in a capture file."""
+    with open(path, 'rb') as capture_file:
+        magic, version = HYSEN_CAPTURE_HEADER.unpack(capture_file.read(HYSEN_CAPTURE_HEADER.size))
+        if magic != HYSEN_CAPTURE_MAGIC or version != HYSEN_CAPTURE_VERSION:
+            raise ValueError('hysen_capture_error', 'not a Hysen packet capture: ' + path)
+        while True:
+            header = capture_file.read(HYSEN_CAPTURE_RECORD.size)
+            if len(header) < HYSEN_CAPTURE_RECORD.size:
+                return
+            timestamp, kind, address, port, mac, datagram_length, plaintext_length = HYSEN_CAPTURE_RECORD.unpack(header)
+            datagram = capture_file.read(datagram_length)
+            plaintext = capture_file.read(plaintext_length)
+            yield hysen_capture_record(timestamp, kind, (socket.inet_ntoa(address), port), mac, datagram, plaintext)
+
+
+# One captured request and its answer, response None when the device never answered it
+hysen_capture_exchange = collections.namedtuple('hysen_capture_exchange',
+                                                ['command', 'request', 'response', 'plaintext', 'latency'])
+
+# Stands in for the shared socket (use_hysen_replay_socket) and answers each request
+# with a captured response of the same device. The next exchange in capture order with
+# the same command and request payload is used, or else the next with the same command,
+# so a client that polls differently still gets answers. Captured requests that went
+# unanswered are not answered either. The captured plaintext is encrypted again with
+# the client session key, which the client takes from the replayed auth answers.
+# realtime answers after the captured round trip time, otherwise straight away.
+class broadlink_hysen_replay_socket(broadlink_hysen_shared_socket):
+    def __init__(self, records, realtime=True, timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.realtime = realtime
+        self.closed = False
+        self.answered = 0
+        self.unanswered = 0
+        self.devices = {}
+        self.discovered = []
+        self._exchanges = {}
+        self._positions = {}
+        sent = {}
+        for record in records:
+            if record.kind == HYSEN_CAPTURE_DISCOVERY_RESPONSE:
+                hysen_device = parse_discovery_response(record.datagram, record.host)
+                if hysen_device is not None:
+                    self.discovered.append(hysen_device)
+                continue
+            if record.kind not in (HYSEN_CAPTURE_REQUEST, HYSEN_CAPTURE_RESPONSE) or len(record.datagram) < 0x38:
+                continue
+            key = (record.host, record.datagram[0x28] | record.datagram[0x29] << 8)
+            if record.kind == HYSEN_CAPTURE_REQUEST:
+                if record.host not in self.devices:
+                    self.devices[record.host] = broadlink_hysen_climate_device(record.host, record.mac, timeout=timeout)
+                # Requests match on the padded payload, as decrypted from the client packet
+                request = record.plaintext + bytes(-len(record.plaintext) % 16)
+                sent[key] = (len(self._exchanges.setdefault(record.host, [])), record.time)
+                self._exchanges[record.host].append(hysen_capture_exchange(record.datagram[0x26], request, None, None, None))
+            elif key in sent:
+                index, sent_time = sent.pop(key)
+                self._exchanges[record.host][index] = self._exchanges[record.host][index]._replace(
+                    response=record.datagram, plaintext=record.plaintext, latency=record.time - sent_time)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def sendto(self, packet, host):
+        device = self.devices.get(host)
+        exchange = None if device is None else self._next_exchange(host, packet[0x26], device.decrypt(bytes(packet[0x38:])))
+        if exchange is None or exchange.response is None:
+            self.unanswered += 1
+            return
+        self.answered += 1
+        response = bytearray(exchange.response)
+        response[0x28:0x2a] = packet[0x28:0x2a]
+        if exchange.plaintext:
+            plaintext = exchange.plaintext + bytes(-len(exchange.plaintext) % 16)
+            response[0x38:] = device.encrypt(plaintext)
+            BROADLINK_PACKET_CHECKSUM.pack_into(response, 0x34, broadlink_checksum(plaintext))
+        response[0x20:0x22] = bytes(2)
+        BROADLINK_PACKET_CHECKSUM.pack_into(response, 0x20, broadlink_checksum(response))
+        if self.realtime:
+            asyncio.get_running_loop().call_later(exchange.latency, self.datagram_received, bytes(response), host)
+        else:
+            asyncio.get_running_loop().call_soon(self.datagram_received, bytes(response), host)
+
+    def _next_exchange(self, host, command, request):
+        exchanges = self._exchanges[host]
+        position = self._positions.get(host, 0)
+        def order():
+            # Wraps around, a replay can run longer than the capture
+            return itertools.chain(range(position, len(exchanges)), range(position))
+        index = next((index for index in order() if exchanges[index].command == command and exchanges[index].request == request), None)
+        if index is None:
+            index = next((index for index in order() if exchanges[index].command == command), None)
+            if index is None:
+                return None
+        self._positions[host] = index + 1
+        return exchanges[index]
+
+
+
+BROADLINK_DISCOVERY_PORT = 80
+
+def build_discovery_packet(local_ip_address, port):
+    """Discovery request, devices answer to local_ip_address:port (0.0.0.0: to the sender)."""
+    address = local_ip_address.split('.')
     timezone = int(time.timezone / -3600)
     packet = bytearray(0x30)
-    year = datetime.datetime.now().year
+    now = datetime.datetime.now()
+    year = now.year
 
     if timezone < 0:
         packet[0x08] = 0xff + timezone - 1
@@ -1429,13 +3333,13 @@ def broadlink_hysen_climate_device_discover(timeout=None, local_ip_address=None,
         packet[0x0b] = 0
     packet[0x0c] = year & 0xff
     packet[0x0d] = year >> 8
-    packet[0x0e] = datetime.datetime.now().minute
-    packet[0x0f] = datetime.datetime.now().hour
+    packet[0x0e] = now.minute
+    packet[0x0f] = now.hour
     subyear = str(year)[2:]
     packet[0x10] = int(subyear)
-    packet[0x11] = datetime.datetime.now().isoweekday()
-    packet[0x12] = datetime.datetime.now().day
-    packet[0x13] = datetime.datetime.now().month
+    packet[0x11] = now.isoweekday()
+    packet[0x12] = now.day
+    packet[0x13] = now.month
     packet[0x18] = int(address[0])
     packet[0x19] = int(address[1])
     packet[0x1a] = int(address[2])
@@ -1443,28 +3347,42 @@ def broadlink_hysen_climate_device_discover(timeout=None, local_ip_address=None,
     packet[0x1c] = port & 0xff
     packet[0x1d] = port >> 8
     packet[0x26] = 6
-    
-    checksum = 0xbeaf
-    for b in packet:
-        checksum = (checksum + b) & 0xffff
+
+    checksum = broadlink_checksum(packet)
 
     packet[0x20] = checksum & 0xff
     packet[0x21] = checksum >> 8
+    return packet
+
+def parse_discovery_response(responsepacket, host):
+    """Return a broadlink_hysen_climate_device for a Hysen discovery answer, None for anything else."""
+    if len(responsepacket) < 0x40:
+        return None
+    devtype = responsepacket[0x34] | responsepacket[0x35] << 8
+    if devtype != 0x4EAD:  # Add only Hysen device
+        return None
+    mac = responsepacket[0x3f:0x39:-1]
+    name = bytes(responsepacket[0x40:]).split(b'\x00')[0].decode('utf-8', 'replace')
+    return broadlink_hysen_climate_device(host, mac, name=name)
+
+# Discover a new Hysen Broadlink device.
+def broadlink_hysen_climate_device_discover(timeout=None, local_ip_address='0.0.0.0', discover_ip_address='255.255.255.255'):
+    cs = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    cs.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    cs.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    cs.bind((local_ip_address, 0))
+    port = cs.getsockname()[1]
+    starttime = time.time()
+    hysen_devices = []
 
-    cs.sendto(packet, (discover_ip_address, 80))
+    packet = build_discovery_packet(local_ip_address, port)
+    cs.sendto(packet, (discover_ip_address, BROADLINK_DISCOVERY_PORT))
+    capture_discovery(HYSEN_CAPTURE_DISCOVERY_REQUEST, (discover_ip_address, BROADLINK_DISCOVERY_PORT), packet)
     if timeout is None:
         response = cs.recvfrom(1024)
-        responsepacket = bytearray(response[0])
-        host = response[1]
-        devtype = responsepacket[0x34] | responsepacket[0x35] << 8
-        mac = responsepacket[0x3f:0x39:-1]
-        name = responsepacket[0x40:].split(b'\x00')[0].decode('utf-8')
-        if devtype == 0x4EAD :  # Add only Hysen device
-            hysen_device = broadlink_hysen_climate_device(host, mac, name=name)
-        else:
-            hysen_device = None
         cs.close()
-        return hysen_device
+        capture_discovery(HYSEN_CAPTURE_DISCOVERY_RESPONSE, response[1], response[0])
+        return parse_discovery_response(bytearray(response[0]), response[1])
 
     while (time.time() - starttime) < timeout:
         cs.settimeout(timeout - (time.time() - starttime))
@@ -1473,18 +3391,117 @@ def broadlink_hysen_climate_device_discover(timeout=None, local_ip_address=None,
         except socket.timeout:
             cs.close()
             return hysen_devices
-        responsepacket = bytearray(response[0])
-        host = response[1]
-        devtype = responsepacket[0x34] | responsepacket[0x35] << 8
-        mac = responsepacket[0x3f:0x39:-1]
-        name = responsepacket[0x40:].split(b'\x00')[0].decode('utf-8')
-        if devtype == 0x4EAD :  #Add only Hysen device
-            hysen_device = broadlink_hysen_climate_device(host, mac, name=name)
+        capture_discovery(HYSEN_CAPTURE_DISCOVERY_RESPONSE, response[1], response[0])
+        hysen_device = parse_discovery_response(bytearray(response[0]), response[1])
+        if hysen_device is not None:
             hysen_devices.append(hysen_device)
     cs.close()
     return hysen_devices
 
 
+# Largest number of addresses a discovery sweep sends to one at a time
+BROADLINK_DISCOVERY_MAX_UNICAST = 4096
+
+def hysen_discovery_targets(networks=()):
+    """Return [(local_ip_address, [discover_ip_address, ...])] for a discovery sweep.
+
+    The broadcast address of every IPv4 network on a local interface, sent from that
+    interface, and every address in networks (CIDR strings) as unicast. Without ifaddr,
+    or without interfaces, the limited broadcast 255.255.255.255.
+    """
+    targets = []
+    if ifaddr is not None:
+        for adapter in ifaddr.get_adapters():
+            for adapter_ip in adapter.ips:
+                if not isinstance(adapter_ip.ip, str):
+                    continue  # IPv6
+                interface = ipaddress.IPv4Interface('%s/%s' % (adapter_ip.ip, adapter_ip.network_prefix))
+                if interface.ip.is_loopback or interface.ip.is_link_local or interface.network.prefixlen >= 31:
+                    continue
+                targets.append((str(interface.ip), [str(interface.network.broadcast_address)]))
+    if not targets:
+        targets.append(('0.0.0.0', ['255.255.255.255']))
+    unicast = []
+    truncated = False
+    for network in networks:
+        try:
+            addresses = ipaddress.ip_network(network, strict=False).hosts()
+        except ValueError as error:
+            # A bad network does not stop the sweep of the others and the local broadcast
+            _LOGGER.error("Broadlink Hysen discovery skips network %s: %s", network, error)
+            continue
+        for address in addresses:
+            if len(unicast) >= BROADLINK_DISCOVERY_MAX_UNICAST:
+                truncated = True
+                break
+            unicast.append(str(address))
+        if truncated:
+            break
+    if truncated:
+        _LOGGER.warning("Broadlink Hysen discovery sweeps only the first %s addresses of %s",
+                        BROADLINK_DISCOVERY_MAX_UNICAST, ', '.join(str(network) for network in networks))
+    if unicast:
+        targets.append(('0.0.0.0', unicast))
+    return targets
+
+
+class broadlink_hysen_discovery_protocol(asyncio.DatagramProtocol):
+    def __init__(self, responses):
+        self.responses = responses
+
+    def datagram_received(self, data, addr):
+        self.responses.put_nowait((data, addr))
+
+    def error_received(self, exc):
+        _LOGGER.debug("Broadlink Hysen discovery socket error:%s", exc)
+
+
+async def async_broadlink_hysen_climate_device_discover(timeout, local_ip_address='0.0.0.0', discover_ip_address='255.255.255.255',
+                                                        discover_port=BROADLINK_DISCOVERY_PORT, targets=None):
+    """Send discovery packets and yield each Hysen device as it answers, until timeout.
+
+    targets, as returned by hysen_discovery_targets, sends from several local addresses
+    to several destinations at once; answers are merged and each MAC is yielded once.
+    """
+    loop = asyncio.get_running_loop()
+    if targets is None:
+        targets = [(local_ip_address, [discover_ip_address])]
+    responses = asyncio.Queue()
+    transports = []
+    try:
+        for local_address, discover_addresses in targets:
+            try:
+                transport, _ = await loop.create_datagram_endpoint(lambda: broadlink_hysen_discovery_protocol(responses),
+                                                                   local_addr=(local_address, 0), allow_broadcast=True)
+            except OSError as error:
+                _LOGGER.warning("Broadlink Hysen discovery can not send from %s:%s", local_address, error)
+                continue
+            transports.append(transport)
+            packet = build_discovery_packet(local_address, transport.get_extra_info('sockname')[1])
+            for index, discover_address in enumerate(discover_addresses):
+                transport.sendto(packet, (discover_address, discover_port))
+                capture_discovery(HYSEN_CAPTURE_DISCOVERY_REQUEST, (discover_address, discover_port), packet)
+                if index % 256 == 255:
+                    # Let the socket drain on long unicast sweeps
+                    await asyncio.sleep(0)
+        deadline = loop.time() + timeout
+        seen = set()
+        while transports:
+            try:
+                data, host = await asyncio.wait_for(responses.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return
+            capture_discovery(HYSEN_CAPTURE_DISCOVERY_RESPONSE, host, data)
+            hysen_device = parse_discovery_response(data, host)
+            # A device can answer more than once, e.g. to a subnet broadcast and a unicast
+            if hysen_device is not None and bytes(hysen_device.mac) not in seen:
+                seen.add(bytes(hysen_device.mac))
+                yield hysen_device
+    finally:
+        for transport in transports:
+            transport.close()
+
+
 
 # Setup a new Broadlink device via AP Mode. Review the README to see how to enter AP Mode.
 def broadlink_hysen_climate_device_setup(ssid, password, security_mode):
@@ -1508,9 +3525,7 @@ def broadlink_hysen_climate_device_setup(ssid, password, security_mode):
     payload[0x85] = pass_length  # Character length of password
     payload[0x86] = security_mode  # Type of encryption (00 - none, 01 = WEP, 02 = WPA1, 03 = WPA2, 04 = WPA1/2)
 
-    checksum = 0xbeaf
-    for b in payload:
-        checksum = (checksum + b) & 0xffff
+    checksum = broadlink_checksum(payload)
 
     payload[0x20] = checksum & 0xff  # Checksum 1 position
     payload[0x21] = checksum >> 8  # Checksum 2 position
@@ -0,0 +1,154 @@
+"""
+Sensors set up by the hysen climate platform.
+Diagnostic transport sensors, one per thermostat: the smoothed round trip time as
+state, and the request latency histogram, retransmits, timeouts, CRC and firmware
+errors, auths and update phase timings as attributes, to find the slow devices
+and bad access points of a fleet.
+Fleet analytics sensors, one per room metric: the fleet mean as state, and the
+room furthest out and the value of every room as attributes, updated once per
+poll cycle.
+A fleet poll cycle sensor: the wall time of the last poll cycle as state, and
+the queue depth, polls in flight and circuit breaker counts as attributes, to
+size the scan interval and max_concurrent_polls of a large fleet.
+"""
+import logging
+
+from datetime import timedelta
+
+from homeassistant.components.climate.const import DOMAIN as CLIMATE_DOMAIN
+from homeassistant.components.sensor import SensorDeviceClass, SensorEntity, SensorStateClass
+from homeassistant.const import PERCENTAGE, EntityCategory, UnitOfTemperature, UnitOfTime
+from homeassistant.core import callback
+
+from .climate import DATA_ANALYTICS, DATA_POLLER, HYSEN_DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+# Only reads counters kept by the climate entity, no device requests
+SCAN_INTERVAL = timedelta(minutes=1)
+
+# Fleet analytics metric, name, unit and icon
+FLEET_ANALYTICS_SENSORS = (
+    ('setpoint_error', 'Hysen fleet setpoint error', UnitOfTemperature.CELSIUS, 'mdi:thermometer-alert'),
+    ('heating_duty_cycle', 'Hysen fleet heating duty cycle', PERCENTAGE, 'mdi:radiator'),
+    ('temperature_spread', 'Hysen fleet external temperature spread', UnitOfTemperature.CELSIUS, 'mdi:thermometer-lines'),
+    ('time_to_setpoint', 'Hysen fleet time to setpoint', UnitOfTime.MINUTES, 'mdi:timer-outline'),
+)
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Set up the transport sensors of the thermostats passed by the climate platform, or the fleet sensors."""
+    if discovery_info is None:
+        return
+    if discovery_info.get('fleet'):
+        analytics = hass.data[HYSEN_DOMAIN][DATA_ANALYTICS]
+        async_add_entities([HASS_Hysen_Fleet_Analytics_Sensor(analytics, metric, name, unit, icon)
+                            for metric, name, unit, icon in FLEET_ANALYTICS_SENSORS] +
+                           [HASS_Hysen_Fleet_Poller_Sensor(hass.data[HYSEN_DOMAIN][DATA_POLLER])])
+        return
+    async_add_entities([HASS_Hysen_Transport_Sensor(hass, climate_entity_id, name)
+                        for climate_entity_id, name in discovery_info['entities']])
+
+######################################################################################################################################
+######################################################################################################################################
+class HASS_Hysen_Transport_Sensor(SensorEntity):
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_device_class = SensorDeviceClass.DURATION
+    _attr_native_unit_of_measurement = UnitOfTime.MILLISECONDS
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_icon = 'mdi:lan-connect'
+    # The counters change every poll, keep them out of the recorder database
+    _unrecorded_attributes = frozenset({'host', 'circuit_breaker', 'rtt', 'requests', 'latency_histogram',
+                                        'latency_p95', 'crc_errors', 'firmware_errors', 'auths', 'phases'})
+
+    def __init__(self, hass, climate_entity_id, name):
+        """Initialize the transport sensor of a Hysen climate entity."""
+        self.entity_id = 'sensor.' + climate_entity_id.split('.', 1)[1] + '_transport'
+        self._hass = hass
+        self._climate_entity_id = climate_entity_id
+        self._attr_name = name + ' transport'
+        self._attr_available = False
+        self._attr_native_value = None
+        self._attr_extra_state_attributes = {}
+
+    async def async_update(self):
+        """Copy the transport counters of the climate entity."""
+        entity = self._hass.data[CLIMATE_DOMAIN].get_entity(self._climate_entity_id)
+        if entity is None:
+            self._attr_available = False
+            return
+        device = entity.broadlink_hysen_climate_device
+        rtt = device.rtt.as_dict()
+        attr = {}
+        attr['host'] = None if device.host is None else device.host[0]
+        attr['circuit_breaker'] = entity.circuit_breaker.state
+        attr['rtt'] = rtt
+        attr.update(device.metrics.as_dict())
+        self._attr_available = True
+        self._attr_native_value = rtt['srtt_ms']
+        self._attr_extra_state_attributes = attr
+
+######################################################################################################################################
+######################################################################################################################################
+class HASS_Hysen_Fleet_Analytics_Sensor(SensorEntity):
+    _attr_should_poll = False
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    # One value per room, keep them out of the recorder database
+    _unrecorded_attributes = frozenset({'rooms', 'max', 'max_room', 'heating_now', 'warming_up'})
+
+    def __init__(self, analytics, metric, name, unit, icon):
+        """Initialize a fleet analytics sensor."""
+        self.entity_id = 'sensor.hysen_fleet_' + metric
+        self._analytics = analytics
+        self._metric = metric
+        self._attr_name = name
+        self._attr_native_unit_of_measurement = unit
+        self._attr_icon = icon
+        if unit == UnitOfTime.MINUTES:
+            self._attr_device_class = SensorDeviceClass.DURATION
+        self._attr_native_value = None
+        self._attr_extra_state_attributes = {}
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self._analytics.async_add_listener(self._async_metrics_updated))
+
+    @callback
+    def _async_metrics_updated(self):
+        metric = self._analytics.metrics.get(self._metric)
+        if metric is None:
+            return
+        attr = dict(metric)
+        self._attr_native_value = attr.pop('mean')
+        self._attr_extra_state_attributes = attr
+        self.async_write_ha_state()
+
+######################################################################################################################################
+######################################################################################################################################
+class HASS_Hysen_Fleet_Poller_Sensor(SensorEntity):
+    _attr_should_poll = False
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_device_class = SensorDeviceClass.DURATION
+    _attr_native_unit_of_measurement = UnitOfTime.SECONDS
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_icon = 'mdi:timer-sync-outline'
+    # The counters change every cycle, keep them out of the recorder database
+    _unrecorded_attributes = frozenset({'devices', 'scan_interval', 'max_concurrent_polls', 'cycle_count',
+                                        'last_cycle_polls', 'queue_depth', 'max_queue_depth', 'in_flight',
+                                        'last_cycle_skipped', 'breakers'})
+
+    def __init__(self, poller):
+        """Initialize the fleet poll cycle sensor."""
+        self.entity_id = 'sensor.hysen_fleet_poll_cycle'
+        self._poller = poller
+        self._attr_name = 'Hysen fleet poll cycle'
+        self._attr_native_value = None
+        self._attr_extra_state_attributes = {}
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self._poller.async_add_cycle_listener(self._async_cycle_done))
+
+    @callback
+    def _async_cycle_done(self):
+        attr = self._poller.stats
+        self._attr_native_value = round(attr.pop('last_cycle_time'), 3)
+        self._attr_extra_state_attributes = attr
+        self.async_write_ha_state()